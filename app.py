@@ -1,22 +1,47 @@
-from flask import Flask, render_template, request, redirect, flash, jsonify, session, g, url_for, Blueprint
+from flask import Flask, render_template, request, redirect, flash, jsonify, session, g, url_for, Blueprint, Response, has_request_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_wtf.csrf import CSRFProtect, generate_csrf, validate_csrf
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_migrate import Migrate
 import os
+import sys
 import secrets
 import re
-from datetime import datetime, timedelta, timezone
+import threading
+import atexit
+import time
+import json
+import urllib.request
+import sqlite3
+import queue
+import heapq
+import gzip
+import shutil
+import click
+from datetime import date, datetime, timedelta, timezone
 from functools import wraps
 import logging
 from logging.handlers import RotatingFileHandler
-from sqlalchemy import func, case, text, and_, or_, extract
-from sqlalchemy.exc import SQLAlchemyError, DatabaseError
+from sqlalchemy import func, case, text, and_, or_, extract, select, insert, update, bindparam
+from sqlalchemy import inspect as sqlalchemy_inspect
+from sqlalchemy import event, create_engine, exists, literal, null, false, union_all
+from sqlalchemy.orm import Session as OrmSession, aliased
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.exc import SQLAlchemyError, DatabaseError, IntegrityError, OperationalError
 from werkzeug.exceptions import BadRequest
 from contextlib import contextmanager
+from collections import Counter, OrderedDict
+from itertools import chain
+try:
+    import fcntl
+except ImportError:  # Windows: لا أقفال ملفات POSIX، ويُفترض تشغيل عملية واحدة
+    fcntl = None
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from decimal import Decimal, ROUND_HALF_UP
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField
-from wtforms.validators import DataRequired
+from wtforms.validators import DataRequired, ValidationError
 from flask_wtf.csrf import CSRFError
 
 # ✅ تهيئة تطبيق Flask
@@ -48,41 +73,354 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 db_path = os.path.join(basedir, 'data', 'database.db')
 os.makedirs(os.path.dirname(db_path), exist_ok=True)
 
-app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
+def _database_url():
+    """رابط قاعدة البيانات: DATABASE_URL (مثل PostgreSQL) أو ملف SQLite المحلي افتراضياً"""
+    url = os.environ.get('DATABASE_URL')
+    if not url:
+        return f'sqlite:///{db_path}'
+    # بعض منصات الاستضافة ما زالت تستخدم المخطط القديم postgres://
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+app.config['SQLALCHEMY_DATABASE_URI'] = _database_url()
+app.config['DATABASE_READ_URL'] = os.environ.get('DATABASE_READ_URL')  # نسخة قراءة اختيارية لخادم قاعدة البيانات
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
-    'pool_size': 10,
-    'pool_recycle': 300,
-    'pool_pre_ping': True
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    # SQLite ملف محلي: لا حاجة لإعادة تدوير الاتصالات أو فحصها كقواعد البيانات الشبكية.
+    # اتصالات هذا المجمع للطلبات (الكتابة)، واستعلامات اللوحات تستخدم مجمع القراءة فقط (get_read_engine)
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': 5,
+        'max_overflow': 10,
+        'pool_timeout': 20
+    }
+else:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+        'pool_timeout': 20,
+        'pool_recycle': 1800,
+        'pool_pre_ping': True
+    }
+
+# ✅ ملف أداء SQLite يُطبق عند فتح كل اتصال
+app.config['SQLITE_PRAGMAS'] = {
+    'auto_vacuum': 'INCREMENTAL',  # يسري على الملفات الجديدة؛ القائمة تُحوّل بـ flask run-maintenance --enable-incremental-vacuum
+    'journal_mode': 'WAL',  # القراء لا يحجبون الكاتب ولا العكس
+    'synchronous': 'NORMAL',  # آمن مع WAL ويقلل عمليات fsync
+    'mmap_size': 268435456,  # 256MB
+    'cache_size': -65536,  # 64MB (القيمة السالبة بالكيلوبايت)
+    'temp_store': 'MEMORY',
+    'busy_timeout': 5000,  # انتظار القفل بالمللي ثانية بدلاً من الفشل الفوري
+    # البيانات الحالية أُدخلت دون فرض المفاتيح الأجنبية؛ يُفعّل بعد التحقق بـ PRAGMA foreign_key_check
+    'foreign_keys': 'OFF'
 }
 
 # ✅ تهيئة SQLAlchemy
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
 
+def configure_sqlite_engine(engine, read_only=False):
+    """تطبيق SQLITE_PRAGMAS على كل اتصال جديد بالمحرك"""
+    if engine.dialect.name != 'sqlite':
+        return
+    pragmas = dict(app.config['SQLITE_PRAGMAS'])
+    if read_only:
+        # وضع السجل والتفريغ خاصيتان دائمتان في الملف يضبطهما اتصال الكتابة فقط
+        pragmas.pop('journal_mode', None)
+        pragmas.pop('auto_vacuum', None)
+        pragmas['query_only'] = 'ON'
+    # مهلة الانتظار أولاً حتى تنتظر بقية الأوامر (مثل journal_mode) القفل بدل الفشل الفوري
+    busy_timeout = pragmas.pop('busy_timeout', None)
+    if busy_timeout is not None:
+        pragmas = {'busy_timeout': busy_timeout, **pragmas}
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            if name == 'journal_mode':
+                # تغيير وضع السجل يحتاج قفلاً حصرياً؛ لا يُطلب إذا كان الملف عليه أصلاً
+                current = cursor.execute("PRAGMA journal_mode").fetchone()[0]
+                if str(current).lower() == str(value).lower():
+                    continue
+            elif name == 'auto_vacuum' and cursor.execute("PRAGMA page_count").fetchone()[0]:
+                # لا أثر له على ملف قائم (التحويل يتم بـ VACUUM) ويحتاج قفل الكتابة
+                continue
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    @event.listens_for(engine, 'checkin')
+    def clear_statement_deadline(dbapi_connection, connection_record):
+        # مهلة الاستعلام (apply_statement_deadline) تخص الجلسة التي ضبطتها فقط
+        if connection_record.info.pop('statement_deadline', False):
+            dbapi_connection.set_progress_handler(None, 0)
+
+with app.app_context():
+    configure_sqlite_engine(db.engine)
+
+# محرك وجلسات القراءة فقط (تُستخدم في المسارات والخيوط التي تضبط g.db_read_only)
+_read_engine = None
+_read_engine_lock = threading.Lock()
+
+def get_read_engine():
+    """محرك قاعدة بيانات للقراءة فقط؛ في SQLite يُفتح الملف بوضع mode=ro، وفي غيرها DATABASE_READ_URL إن وُجد"""
+    global _read_engine
+    with _read_engine_lock:
+        if _read_engine is None:
+            url = db.engine.url
+            if url.get_backend_name() == 'sqlite' and url.database:
+                _read_engine = create_engine(
+                    f"sqlite:///file:{url.database}?mode=ro&uri=true",
+                    pool_size=app.config['DASHBOARD_PANEL_WORKERS'],
+                    connect_args={'check_same_thread': False}
+                )
+                configure_sqlite_engine(_read_engine, read_only=True)
+            elif app.config['DATABASE_READ_URL']:
+                _read_engine = create_engine(app.config['DATABASE_READ_URL'],
+                                             **app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+            else:
+                _read_engine = db.engine
+        return _read_engine
+
+def _begin_immediate(connection):
+    """بدء معاملة SQLite بقفل الكتابة فوراً إن لم تكن قد بدأت"""
+    if not connection.connection.driver_connection.in_transaction:
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+
+@event.listens_for(OrmSession, 'after_begin')
+def _lock_sqlite_write_transaction(session_db, transaction, connection):
+    # المعاملات التالية لـ commit داخل نفس db_session تأخذ القفل أيضاً
+    if session_db.info.get('sqlite_immediate') and connection.dialect.name == 'sqlite':
+        _begin_immediate(connection)
+
+def is_write_session():
+    """جلسات الكتابة: المسارات غير GET والخيوط الخلفية، ما لم تُوجَّه للقراءة فقط"""
+    if g.get('db_read_only'):
+        return False
+    return not has_request_context() or request.method not in ('GET', 'HEAD', 'OPTIONS')
+
+def for_update(session_db, query):
+    """قفل الصفوف المقروءة حتى نهاية المعاملة (SELECT ... FOR UPDATE)
+
+    في SQLite تأخذ جلسات الكتابة قفل قاعدة البيانات كاملة عند البدء، فلا حاجة لقفل الصفوف.
+    """
+    if session_db.get_bind().dialect.name == 'sqlite':
+        return query
+    return query.with_for_update()
+
+def apply_statement_deadline(session_db, deadline):
+    """إيقاف أي استعلام في الجلسة يتجاوز الموعد (time.monotonic) بدلاً من تركه يعمل في الخلفية"""
+    connection = session_db.connection()
+    if connection.dialect.name == 'sqlite':
+        connection.connection.info['statement_deadline'] = True
+        connection.connection.driver_connection.set_progress_handler(
+            lambda: time.monotonic() > deadline, 1000)
+    elif connection.dialect.name == 'postgresql':
+        remaining_ms = max(1, int((deadline - time.monotonic()) * 1000))
+        connection.execute(text("SELECT set_config('statement_timeout', :ms, true)"), {'ms': str(remaining_ms)})
+
 # تعريف مدير السياق لإدارة جلسات قاعدة البيانات
 @contextmanager
 def db_session():
-    session = db.session
+    if g.get('db_read_only'):
+        # جلسة مستقلة على محرك القراءة؛ الكائنات تبقى محمّلة بعد الإغلاق لعرضها في القوالب
+        session = OrmSession(bind=get_read_engine(), expire_on_commit=False)
+        if g.get('db_statement_deadline') is not None:
+            apply_statement_deadline(session, g.db_statement_deadline)
+    else:
+        session = db.session
+    immediate = (session.get_bind().dialect.name == 'sqlite' and is_write_session()
+                 and not session.info.get('sqlite_immediate'))
     try:
+        if immediate:
+            # قفل الكتابة من أول قراءة: فحص الرصيد أو الكمية المرتجعة ثم تعديلها لا يتداخل مع طلب آخر
+            session.info['sqlite_immediate'] = True
+            _begin_immediate(session.connection())
         yield session
         session.commit()
     except Exception as e:
         session.rollback()
         raise e
     finally:
+        if immediate:
+            session.info.pop('sqlite_immediate', None)
         session.close()
 
+DB_ROUTES = ('read', 'write')
+
+def db_route(mode):
+    """توجيه جلسات db_session داخل المسار: 'read' لمحرك القراءة فقط (التقارير) و'write' للمحرك الرئيسي"""
+    if mode not in DB_ROUTES:
+        raise ValueError(f"نوع توجيه غير معروف: {mode}")
+
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapped(*args, **kwargs):
+            previous = g.get('db_read_only', False)
+            g.db_read_only = mode == 'read'
+            try:
+                return view_func(*args, **kwargs)
+            finally:
+                g.db_read_only = previous
+        return wrapped
+    return decorator
+
 # ✅ إعداد السجلات (Logging)
 log_path = os.path.join(basedir, 'inventory.log')
 logging.basicConfig(level=logging.INFO)
 
+def _compress_rotated_log(source, dest):
+    """ضغط ملف السجل المدوّر بـ gzip بدل الاحتفاظ بنسخته النصية"""
+    with open(source, 'rb') as plain, gzip.open(dest, 'wb') as compressed:
+        shutil.copyfileobj(plain, compressed)
+    os.remove(source)
+
 log_handler = RotatingFileHandler(log_path, maxBytes=10000, backupCount=3)
+log_handler.namer = lambda name: f'{name}.gz'
+log_handler.rotator = _compress_rotated_log
 log_handler.setLevel(logging.INFO)
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 log_handler.setFormatter(formatter)
 app.logger.addHandler(log_handler)
 
+# ✅ إعدادات نقاط البيع
+app.config.update(
+    POS_BRANCH_CODE='01',
+    INVOICE_BLOCK_SIZE=50,  # عدد أرقام الفواتير المحجوزة لكل جهاز في كل مرة
+    INVOICE_GAP_GRACE_SECONDS=3600,  # مهلة بعد إغلاق الكتلة قبل مطابقتها مع الفواتير المرحّلة
+    POS_SYNC_MAX_BATCH=200,  # الحد الأقصى للفواتير في طلب مزامنة واحد
+    POS_LOOKUP_MAX_CODES=400,  # الحد الأقصى للأكواد في طلب بحث مجمّع (ضمن حد متغيرات SQLite)
+    BARCODE_INDEX_CHECK_SECONDS=1.0,  # أقصى مدة قبل مقارنة فهرس الباركود بعداد الكتالوج المحفوظ
+    PHONE_COUNTRY_CODE='966',  # مفتاح الدولة الذي يُحذف عند توحيد أرقام الهواتف
+    CUSTOMER_SEARCH_LIMIT=20,
+    POS_STORE_NAME='نظام إدارة المخزون',
+    RECEIPT_CACHE_SIZE=1000,  # عدد الإيصالات المنسقة المحفوظة في الذاكرة
+    POS_ADJUSTMENT_MAX_LINES=500  # أقصى عدد أسطر في طلب مرتجع أو تالف واحد
+)
+
+# ✅ إعدادات ذاكرة لوحة التحكم المؤقتة
+app.config.update(
+    DASHBOARD_CACHE_TTL=30,  # ثوانٍ
+    DASHBOARD_CACHE_SHARED_PATH=None,  # ملف SQLite مشترك بين العمال (مثلاً data/cache.db) عند التشغيل بعدة عمليات
+    DASHBOARD_PANEL_WORKERS=5,  # خيوط تحميل لوحات الشاشة الرئيسية
+    DASHBOARD_PANEL_TIMEOUT=3,  # مهلة اللوحة الواحدة بالثواني
+    DASHBOARD_PANEL_TIMEOUTS={},  # مهلات خاصة لبعض اللوحات، مثل {'recommendations': 5}
+    RECOMMENDATIONS_PER_TYPE=3,  # أكثر المنتجات إلحاحاً لكل نوع توصية
+    RECOMMENDATIONS_LIMIT=10,  # الحد الأقصى لقائمة التوصيات المعروضة
+    RECOMMENDATION_SEASONAL_YEARS=3  # السنوات السابقة الداخلة في متوسط الطلب الموسمي
+)
+
+# ✅ إعدادات شاشات المخزون
+app.config.update(
+    INVENTORY_MOVEMENTS_DAYS=30,  # الفترة الافتراضية لشاشة حركات المخزون
+    INVENTORY_MOVEMENTS_MAX_DAYS=366,  # أقصى فترة يمكن طلبها عبر ?days
+    INVENTORY_MOVEMENTS_PAGE_SIZE=500  # عدد الحركات في الصفحة الواحدة (التالية عبر ?before)
+)
+
+# ✅ إعدادات البث المباشر (SSE)
+app.config.update(
+    EVENT_STREAM_MAX_CLIENTS=100,
+    EVENT_STREAM_QUEUE_SIZE=100,  # أحداث معلقة لكل متصفح قبل إرسال resync
+    EVENT_STREAM_HEARTBEAT=15  # ثوانٍ بين رسائل الإبقاء على الاتصال
+)
+
+# ✅ إعدادات ترتيب الأكثر مبيعاً وأفضل العملاء
+app.config.update(
+    TOP_K_WINDOW_DAYS=30,
+    TOP_K_REFRESH_SECONDS=900  # إعادة التحميل من قاعدة البيانات لمزامنة العمال المتعددين
+)
+
+# ✅ إعدادات الضريبة
+app.config.update(
+    DEFAULT_TAX_RATE=0.15,  # نسبة ضريبة القيمة المضافة عند عدم تحديد نسبة للتصنيف
+    TAX_CLASS_RATES={'exempt': 0.0, 'zero': 0.0},  # فئات ضريبية بنسب ثابتة تتقدم على نسبة التصنيف
+    TAX_RATE_TABLE_TTL=300
+)
+
+# ✅ إعدادات صندوق الرسائل الصادرة (واتساب والإيصالات)
+app.config.update(
+    OUTBOX_TRANSPORT='file',  # file أو http
+    OUTBOX_FILE_PATH=os.path.join(basedir, 'data', 'outbox.jsonl'),
+    OUTBOX_HTTP_URL=None,
+    OUTBOX_HTTP_TIMEOUT=10,
+    OUTBOX_WORKERS=2,
+    OUTBOX_POLL_SECONDS=5,
+    OUTBOX_MAX_ATTEMPTS=5,
+    OUTBOX_RETRY_BASE_SECONDS=15,  # يتضاعف مع كل محاولة فاشلة
+    OUTBOX_LEASE_SECONDS=300  # مدة حجز الرسالة لعامل واحد؛ بعدها تُستعاد إن لم يُسجَّل إرسالها
+)
+
+# ✅ إعدادات خط تسجيل النشاط (سجل التدقيق)
+app.config.update(
+    AUDIT_QUEUE_SIZE=10000,  # عند امتلاء الطابور يُكتب السجل مباشرة بدل فقده
+    AUDIT_BATCH_SIZE=200,
+    AUDIT_FLUSH_INTERVAL=1.0  # أقصى مدة (بالثواني) يبقى فيها السجل في الذاكرة قبل كتابته
+)
+
+# ✅ إعدادات الصيانة الدورية (الاحتفاظ بالسجلات واستعادة المساحة)
+app.config.update(
+    MAINTENANCE_INTERVAL_HOURS=24,  # 0 لإيقاف الجدولة داخل الخادم والاكتفاء بـ flask run-maintenance
+    MAINTENANCE_INITIAL_DELAY_SECONDS=300,  # أول تشغيل بعد الإقلاع (لا ينتظر دورة كاملة بعد كل إعادة تشغيل)
+    MAINTENANCE_LOCK_PATH=os.path.join(basedir, 'data', 'maintenance.lock'),  # عملية واحدة فقط تشغّل الجدولة
+    MAINTENANCE_CHUNK_SIZE=500,
+    MAINTENANCE_CHUNK_PAUSE=0.05,  # مهلة بين الدفعات ليأخذ البيع قفل الكتابة
+    MAINTENANCE_VACUUM_PAGES=1000,  # صفحات تُعاد للنظام في كل خطوة تفريغ تدريجي
+    MAINTENANCE_POLICIES={
+        # keep_days: مدة الاحتفاظ (None لتعطيل الحذف)، rollup: تجميع يومي قبل الحذف (سجل النشاط فقط)
+        'audit_log': {'keep_days': 365, 'rollup': True},
+        # السجلات المحذوفة منطقياً تُنقل إلى الأرشيف (ARCHIVE_POLICIES) وتخضع لنفس الاحتفاظ والتجميع
+        'audit_log_archive': {'keep_days': 365, 'rollup': True},
+        'user_sessions': {'keep_days': 30, 'rollup': False}
+    }
+)
+
+# ✅ إعدادات أرشفة السجلات المحذوفة منطقياً
+app.config.update(
+    ARCHIVE_RETENTION_DAYS=180,  # عمر السجل المؤرشف قبل نقله من الجدول الحي إلى جدول الأرشيف
+    ARCHIVE_BATCH_SIZE=500,
+    ARCHIVE_HISTORY_LIMIT=500  # الحد الأقصى للسجلات في استعلام السجل التاريخي
+)
+
+# ✅ مفاتيح الأيام الرقمية (YYYYMMDD) لأعمدة التواريخ النصية
+_DAY_KEY_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y/%m/%d', '%d/%m/%Y', '%d-%m-%Y')
+
+def day_key(value):
+    """تحويل تاريخ (نص ISO بصيغه المختلفة أو date/datetime) إلى عدد صحيح YYYYMMDD قابل للفهرسة"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc)
+        value = value.date()
+    if not isinstance(value, date):
+        text_value = str(value).strip()
+        try:
+            return day_key(datetime.fromisoformat(text_value.replace('Z', '+00:00')))
+        except ValueError:
+            pass
+        for fmt in _DAY_KEY_FORMATS:
+            try:
+                return day_key(datetime.strptime(text_value, fmt))
+            except ValueError:
+                continue
+        return None
+    return value.year * 10000 + value.month * 100 + value.day
+
+def day_from_key(key):
+    """عكس day_key: نص ISO لليوم"""
+    return f"{key // 10000:04d}-{key // 100 % 100:02d}-{key % 100:02d}" if key else None
+
+def day_key_default(source_column):
+    """قيمة افتراضية لعمود مفتاح اليوم تُحسب من عمود التاريخ في نفس الإدخال (تشمل الإدخالات المجمّعة)"""
+    def compute(context):
+        return day_key(context.get_current_parameters().get(source_column))
+    return compute
+
+def live_index(name, *columns):
+    """فهرس جزئي يغطي السجلات الحية فقط (archived = 0) فلا تُثقله السجلات المؤرشفة"""
+    return db.Index(name, *columns, sqlite_where=text('archived = 0'), postgresql_where=text('NOT archived'))
+
 # ======== تعريف النماذج المحدثة ========
 #class LoginForm(FlaskForm):
 #    username = StringField('اسم المستخدم', validators=[DataRequired()])
@@ -121,7 +459,7 @@ class Category(db.Model):
     category_type = db.Column(db.String(50))
     parent_category_id = db.Column(db.Integer, db.ForeignKey('categories.category_id'))
     description = db.Column(db.Text)
-    tax_rate = db.Column(db.Float, default=0.0)
+    tax_rate = db.Column(db.Float)  # كسر عشري (0.15 = 15%)؛ الفارغ أو الصفر يعني النسبة الافتراضية
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.Text)
     updated_at = db.Column(db.Text)
@@ -175,6 +513,7 @@ class Product(db.Model):
     has_expiry = db.Column(db.Boolean, default=False)
     min_stock_level = db.Column(db.Float, default=0.0)
     created_at = db.Column(db.Text)
+    created_day = db.Column(db.Integer, default=day_key_default('created_at'))
     updated_at = db.Column(db.Text)
     archived = db.Column(db.Boolean, default=False)
     version = db.Column(db.Integer)
@@ -185,6 +524,10 @@ class Product(db.Model):
     stock_qty = db.Column(db.Float, default=0.0)
     purchase_price = db.Column(db.Float, default=0.0)
     min_stock_qty = db.Column(db.Float, default=0.0)
+
+    __table_args__ = (
+        live_index('ix_products_live_name', 'product_name'),
+    )
         
     category = db.relationship('Category', backref='products_in_category')
     unit = db.relationship('Unit', backref='products_in_unit')
@@ -205,8 +548,14 @@ class InventoryLevel(db.Model):
     archived = db.Column(db.Boolean, default=False)
     version = db.Column(db.Integer)
     expiry_date = db.Column(db.Text)
+    expiry_day = db.Column(db.Integer, default=day_key_default('expiry_date'))
     stock_qty = db.Column(db.Float, default=0.0)
 
+    __table_args__ = (
+        db.Index('ix_inventory_levels_product_warehouse', 'product_id', 'warehouse_id'),
+        db.Index('ix_inventory_levels_expiry_day', 'expiry_day'),
+    )
+
     product = db.relationship('Product', backref='inventory_records')
     warehouse = db.relationship('Warehouse', backref='inventory_data')
 
@@ -218,6 +567,7 @@ class InventoryMovement(db.Model):
     movement_type = db.Column(db.String(50), nullable=False)
     transaction_id = db.Column(db.Integer)
     movement_date = db.Column(db.Text)
+    movement_day = db.Column(db.Integer, default=day_key_default('movement_date'))
     quantity_before = db.Column(db.Float)
     quantity_change = db.Column(db.Float)
     quantity_after = db.Column(db.Float)
@@ -235,6 +585,13 @@ class InventoryMovement(db.Model):
     supplier_id = db.Column(db.Integer, db.ForeignKey('entities.entity_id'))
     customer_id = db.Column(db.Integer, db.ForeignKey('entities.entity_id'))
 
+    __table_args__ = (
+        db.Index('ix_inventory_movements_txn_product', 'transaction_id', 'product_id'),
+        live_index('ix_inventory_movements_live_type_date', 'movement_type', 'movement_date'),
+        live_index('ix_inventory_movements_live_type_day', 'movement_type', 'movement_day'),
+        live_index('ix_inventory_movements_live_day', 'movement_day'),
+    )
+
     product = db.relationship('Product', backref='movement_history')
     warehouse = db.relationship('Warehouse', backref='movement_logs')
     supplier = db.relationship('Entity', foreign_keys=[supplier_id])
@@ -342,7 +699,9 @@ class FinancialTransaction(db.Model):
     currency_id = db.Column(db.Integer, db.ForeignKey('currencies.currency_id'))
     exchange_rate_id = db.Column(db.Integer, db.ForeignKey('exchange_rates.rate_id'))
     transaction_date = db.Column(db.Text, nullable=False)
+    transaction_day = db.Column(db.Integer, default=day_key_default('transaction_date'))
     due_date = db.Column(db.Text)
+    due_day = db.Column(db.Integer, default=day_key_default('due_date'))
     reference_number = db.Column(db.String(50))
     subtotal = db.Column(db.Float, default=0.0)
     discount_amount = db.Column(db.Float, default=0.0)
@@ -359,6 +718,13 @@ class FinancialTransaction(db.Model):
     archived = db.Column(db.Boolean, default=False)
     version = db.Column(db.Integer)
 
+    __table_args__ = (
+        db.Index('ix_financial_transactions_code', 'transaction_code'),
+        live_index('ix_financial_transactions_live_type_date', 'transaction_type', 'transaction_date'),
+        db.Index('ix_financial_transactions_type_day', 'transaction_type', 'transaction_day'),
+        db.Index('ix_financial_transactions_due_day', 'due_day'),
+    )
+
     entity = db.relationship('Entity', backref='financial_transactions')
     currency = db.relationship('Currency')
     exchange_rate = db.relationship('ExchangeRate')
@@ -381,6 +747,10 @@ class TransactionDetail(db.Model):
     created_at = db.Column(db.Text)
     archived = db.Column(db.Boolean, default=False)
 
+    __table_args__ = (
+        db.Index('ix_transaction_details_txn_product', 'transaction_id', 'product_id'),
+    )
+
     transaction = db.relationship('FinancialTransaction', backref='line_items')
     product = db.relationship('Product', backref='transaction_items')
 
@@ -674,6 +1044,10 @@ class UserPermission(db.Model):
     granted_by = db.Column(db.Integer, db.ForeignKey('users.user_id'))
     archived = db.Column(db.Boolean, default=False)
 
+    __table_args__ = (
+        live_index('ix_user_permissions_user_active', 'user_id'),
+    )
+
     user = db.relationship('User', foreign_keys=[user_id], backref='user_permissions')
     granter = db.relationship('User', foreign_keys=[granted_by])
 
@@ -688,6 +1062,11 @@ class UserSession(db.Model):
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.Text)
 
+    __table_args__ = (
+        db.Index('ix_user_sessions_user_active', 'user_id', 'is_active'),
+        db.Index('ix_user_sessions_login_time', 'login_time'),
+    )
+
     user = db.relationship('User', backref='sessions')
 
 class AuditLog(db.Model):
@@ -702,8 +1081,27 @@ class AuditLog(db.Model):
     action_timestamp = db.Column(db.Text)
     archived = db.Column(db.Boolean, default=False)
 
+    __table_args__ = (
+        live_index('ix_audit_log_live_user', 'user_id'),
+        db.Index('ix_audit_log_timestamp', 'action_timestamp'),
+    )
+
     user = db.relationship('User', backref='audit_logs')
 
+class AuditLogRollup(db.Model):
+    """عدد عمليات كل مستخدم يومياً لكل جدول ونوع، يبقى بعد حذف سجلات النشاط القديمة"""
+    __tablename__ = 'audit_log_rollups'
+    rollup_id = db.Column(db.Integer, primary_key=True)
+    rollup_day = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, nullable=False, default=0)  # 0 لعمليات النظام
+    action_table = db.Column(db.String(50), nullable=False, default='')
+    action_type = db.Column(db.String(50), nullable=False, default='')
+    action_count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('rollup_day', 'user_id', 'action_table', 'action_type', name='uq_audit_log_rollup'),
+    )
+
 class SystemSetting(db.Model):
     __tablename__ = 'system_settings'
     setting_id = db.Column(db.Integer, primary_key=True)
@@ -748,6 +1146,124 @@ class InitialInventory(db.Model):
     warehouse = db.relationship('Warehouse', backref='initial_inventory')
     product = db.relationship('Product', backref='initial_inventory')
 
+class CatalogVersion(db.Model):
+    """عداد إصدار الكتالوج (صف واحد)؛ قفل الصف عند زيادته يرتب تعديلات المنتجات المتزامنة"""
+    __tablename__ = 'catalog_version'
+    counter_id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+class InvoiceSequence(db.Model):
+    __tablename__ = 'invoice_sequences'
+    prefix = db.Column(db.String(30), primary_key=True)
+    next_value = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(db.Text)
+
+class InvoiceNumberBlock(db.Model):
+    """كتلة أرقام محجوزة لجهاز؛ تُطابق مع الفواتير المرحّلة بعد إغلاقها لتسجيل الأرقام غير المستخدمة"""
+    __tablename__ = 'invoice_number_blocks'
+    block_id = db.Column(db.Integer, primary_key=True)
+    prefix = db.Column(db.String(30), nullable=False)
+    block_day = db.Column(db.Integer, nullable=False)
+    terminal_id = db.Column(db.String(50))
+    first_number = db.Column(db.Integer, nullable=False)
+    last_number = db.Column(db.Integer, nullable=False)
+    issued_through = db.Column(db.Integer)  # آخر رقم صُرف من الكتلة، يُحفظ عند إغلاقها
+    status = db.Column(db.String(20), nullable=False, default='open')  # open, closed, reconciled
+    close_reason = db.Column(db.String(50))
+    reserved_at = db.Column(db.Text)
+    closed_at = db.Column(db.Text)
+
+    __table_args__ = (
+        db.Index('ix_invoice_number_blocks_status', 'status', 'closed_at'),
+    )
+
+class InvoiceNumberGap(db.Model):
+    __tablename__ = 'invoice_number_gaps'
+    gap_id = db.Column(db.Integer, primary_key=True)
+    prefix = db.Column(db.String(30), nullable=False)
+    terminal_id = db.Column(db.String(50))
+    first_number = db.Column(db.Integer, nullable=False)
+    last_number = db.Column(db.Integer, nullable=False)
+    reason = db.Column(db.String(50))
+    reported_at = db.Column(db.Text)
+
+class PosIdempotencyKey(db.Model):
+    __tablename__ = 'pos_idempotency_keys'
+    idempotency_key = db.Column(db.String(64), primary_key=True)
+    terminal_id = db.Column(db.String(50))
+    transaction_id = db.Column(db.Integer, db.ForeignKey('financial_transactions.transaction_id'))
+    status = db.Column(db.String(20))
+    message = db.Column(db.String(255))
+    created_at = db.Column(db.Text)
+
+class EntitySearchTerm(db.Model):
+    __tablename__ = 'entity_search_terms'
+    term_id = db.Column(db.Integer, primary_key=True)
+    entity_id = db.Column(db.Integer, db.ForeignKey('entities.entity_id', ondelete='CASCADE'), nullable=False, index=True)
+    term = db.Column(db.String(255), nullable=False)
+    term_type = db.Column(db.String(10), nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_entity_search_terms_lookup', 'term_type', 'term', 'entity_id'),
+    )
+
+class OutboxMessage(db.Model):
+    __tablename__ = 'outbox_messages'
+    message_id = db.Column(db.Integer, primary_key=True)
+    channel = db.Column(db.String(20), nullable=False)
+    recipient = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text)
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt_at = db.Column(db.Integer)
+    claimed_at = db.Column(db.Integer)
+    last_error = db.Column(db.Text)
+    transaction_id = db.Column(db.Integer, db.ForeignKey('financial_transactions.transaction_id'))
+    created_at = db.Column(db.Text)
+    sent_at = db.Column(db.Text)
+
+    __table_args__ = (
+        db.Index('ix_outbox_messages_due', 'status', 'next_attempt_at'),
+        db.Index('ix_outbox_messages_lease', 'status', 'claimed_at'),
+    )
+
+class DailySalesSummary(db.Model):
+    __tablename__ = 'daily_sales_summary'
+    summary_id = db.Column(db.Integer, primary_key=True)
+    summary_day = db.Column(db.String(10), nullable=False)
+    branch_code = db.Column(db.String(10), nullable=False)
+    transaction_type = db.Column(db.String(50), nullable=False)
+    transaction_count = db.Column(db.Integer, nullable=False, default=0)
+    total_amount = db.Column(db.Float, nullable=False, default=0.0)
+    tax_amount = db.Column(db.Float, nullable=False, default=0.0)
+    updated_at = db.Column(db.Text)
+
+    __table_args__ = (
+        db.UniqueConstraint('summary_day', 'branch_code', 'transaction_type',
+                            name='uq_daily_sales_summary_day_branch_type'),
+    )
+
+# حركات مخزنية بلا فاتورة مالية تُجمع أيضاً في الملخص اليومي
+SUMMARY_MOVEMENT_TYPES = ('return', 'damage')
+
+# أعمدة مفاتيح الأيام: (النموذج، عمود التاريخ النصي، عمود المفتاح الرقمي)
+DAY_KEY_COLUMNS = [
+    (FinancialTransaction, 'transaction_date', 'transaction_day'),
+    (FinancialTransaction, 'due_date', 'due_day'),
+    (InventoryMovement, 'movement_date', 'movement_day'),
+    (InventoryLevel, 'expiry_date', 'expiry_day'),
+    (Product, 'created_at', 'created_day'),
+]
+
+def _sync_day_key(key_column):
+    def on_set(target, value, oldvalue, initiator):
+        setattr(target, key_column, day_key(value))
+    return on_set
+
+# تحديثات ORM لعمود التاريخ تُحدّث مفتاح اليوم تلقائياً؛ الإدخالات المجمّعة تغطيها day_key_default
+for _model, _date_column, _key_column in DAY_KEY_COLUMNS:
+    event.listen(getattr(_model, _date_column), 'set', _sync_day_key(_key_column))
+
 # ======== وظائف مساعدة لإدارة الصلاحيات ========
 def get_all_permissions():
     """الحصول على جميع أسماء الصلاحيات"""
@@ -844,11 +1360,10 @@ def permissions_page():
 def api_get_screens():
     try:
         # استبدال الاستعلام لاستخدام النموذج الموجود
-        screens = db.session.execute(text("""
-            SELECT DISTINCT screen_name, module 
-            FROM permissions 
-            WHERE archived = 0
-        """)).fetchall()
+        screens = db.session.query(
+            Permission.screen_name,
+            Permission.module
+        ).filter(Permission.archived == False).distinct().all()
         
         screens_data = [
             {
@@ -1267,6 +1782,533 @@ def logout():
     flash('تم تسجيل الخروج بنجاح', 'success')
     return redirect('/login')
 
+# ======== ذاكرة التخزين المؤقت للوحة التحكم ========
+class DashboardCache:
+    """ذاكرة مؤقتة لنتائج لوحة التحكم بطبقتين: داخل العملية، وطبقة SQLite اختيارية مشتركة بين العمال
+
+    كل إبطال يرفع رقم الجيل؛ القيم المحفوظة بجيل أقدم تُعامل كمنتهية في جميع العمال.
+    رفع الجيل المشترك يتم في خيط خلفي حتى لا ينتظر مسار الحفظ (مثل إتمام البيع) ملف الذاكرة.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = {}
+        self._generation = 0
+        self._shared_ready = False
+        self._bump_pending = threading.Event()
+        self._bump_thread = None
+        self.stats = {'hits': 0, 'shared_hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def _connect_shared(self):
+        path = app.config['DASHBOARD_CACHE_SHARED_PATH']
+        if not path:
+            return None
+        conn = sqlite3.connect(path, timeout=5)
+        if not self._shared_ready:
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS cache_entries "
+                             "(key TEXT PRIMARY KEY, generation INTEGER, expires_at REAL, value TEXT)")
+                conn.execute("CREATE TABLE IF NOT EXISTS cache_generation "
+                             "(id INTEGER PRIMARY KEY CHECK (id = 1), generation INTEGER NOT NULL)")
+                conn.execute("INSERT OR IGNORE INTO cache_generation VALUES (1, 0)")
+            self._shared_ready = True
+        return conn
+
+    def _shared_call(self, action):
+        """تنفيذ عملية على الطبقة المشتركة؛ تعطلها لا يعطل لوحة التحكم"""
+        conn = None
+        try:
+            conn = self._connect_shared()
+            return action(conn) if conn else None
+        except sqlite3.Error as e:
+            app.logger.warning(f"تعذر الوصول إلى ذاكرة لوحة التحكم المشتركة: {e}")
+            return None
+        finally:
+            if conn:
+                conn.close()
+
+    def get_or_compute(self, key, compute):
+        """إرجاع القيمة المحفوظة أو حسابها وحفظها لمدة DASHBOARD_CACHE_TTL ثانية؛ النتائج الفارغة (أخطاء) لا تُحفظ"""
+        if self._bump_pending.is_set():
+            # قبل أن يرفع الخيط الخلفي الجيل المشترك تكون قيم الطبقة المشتركة أقدم من آخر حفظ في هذه العملية
+            return compute()
+        now = time.time()
+        shared = self._shared_call(lambda conn: (
+            conn.execute("SELECT generation FROM cache_generation WHERE id = 1").fetchone()[0],
+            conn.execute("SELECT value, expires_at, generation FROM cache_entries WHERE key = ? AND expires_at > ?",
+                         (key, now)).fetchone()
+        ))
+        generation = shared[0] if shared else self._generation
+
+        with self._lock:
+            entry = self._local.get(key)
+            if entry and entry[0] > now and entry[1] == generation:
+                self.stats['hits'] += 1
+                return json.loads(entry[2])
+            if shared and shared[1] and shared[1][2] == generation:
+                payload, expires_at, _ = shared[1]
+                self._local[key] = (expires_at, generation, payload)
+                self.stats['shared_hits'] += 1
+                return json.loads(payload)
+
+        value = compute()
+        if not value:
+            return value
+        payload = json.dumps(value, default=str)
+        expires_at = now + app.config['DASHBOARD_CACHE_TTL']
+        with self._lock:
+            self._local = {k: e for k, e in self._local.items() if e[0] > now}
+            self._local[key] = (expires_at, generation, payload)
+            self.stats['misses'] += 1
+
+        def store(conn):
+            with conn:
+                conn.execute("DELETE FROM cache_entries WHERE expires_at <= ?", (now,))
+                conn.execute("INSERT OR REPLACE INTO cache_entries VALUES (?, ?, ?, ?)",
+                             (key, generation, expires_at, payload))
+        if shared:
+            self._shared_call(store)
+        return json.loads(payload)
+
+    def invalidate(self):
+        """إبطال فوري داخل العملية؛ الطبقة المشتركة تُبطل لاحقاً في الخلفية (عدة إبطالات تُدمج في كتابة واحدة)"""
+        with self._lock:
+            self._generation += 1
+            self._local.clear()
+            self.stats['invalidations'] += 1
+            if not app.config['DASHBOARD_CACHE_SHARED_PATH']:
+                return
+            self._bump_pending.set()
+            if self._bump_thread is None:
+                self._bump_thread = threading.Thread(target=self._run_shared_bumps, name='dashboard-cache-bump',
+                                                     daemon=True)
+                self._bump_thread.start()
+
+    def _run_shared_bumps(self):
+        def bump(conn):
+            with conn:
+                conn.execute("UPDATE cache_generation SET generation = generation + 1 WHERE id = 1")
+        while True:
+            self._bump_pending.wait()
+            self._bump_pending.clear()
+            self._shared_call(bump)
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats, entries=len(self._local))
+        lookups = stats['hits'] + stats['shared_hits'] + stats['misses']
+        stats['hit_ratio'] = round((stats['hits'] + stats['shared_hits']) / lookups, 3) if lookups else None
+        stats['shared_tier'] = bool(app.config['DASHBOARD_CACHE_SHARED_PATH'])
+        return stats
+
+dashboard_cache = DashboardCache()
+
+# الجداول التي تؤثر كتابتها على أرقام لوحة التحكم
+DASHBOARD_MODELS = (FinancialTransaction, TransactionDetail, Payment, InventoryMovement,
+                    InventoryLevel, Product, Entity, Stocktake)
+
+def mark_dashboard_dirty(session_db):
+    """تعليم الجلسة لإبطال ذاكرة لوحة التحكم بعد نجاح الحفظ (للكتابات المجمّعة خارج ORM)"""
+    session_db.info['dashboard_dirty'] = True
+
+@event.listens_for(OrmSession, 'after_flush')
+def _track_dashboard_writes(session_db, flush_context):
+    if any(isinstance(obj, DASHBOARD_MODELS)
+           for obj in chain(session_db.new, session_db.dirty, session_db.deleted)):
+        mark_dashboard_dirty(session_db)
+
+@event.listens_for(OrmSession, 'after_commit')
+def _invalidate_dashboard_after_commit(session_db):
+    if session_db.info.pop('dashboard_dirty', False):
+        dashboard_cache.invalidate()
+
+@event.listens_for(OrmSession, 'after_rollback')
+def _discard_dashboard_mark(session_db):
+    session_db.info.pop('dashboard_dirty', None)
+
+def get_cached_dashboard_stats(today):
+    """إحصائيات لوحة التحكم من الذاكرة المؤقتة"""
+    return dashboard_cache.get_or_compute(f"dashboard-stats:{today.isoformat()}",
+                                          lambda: get_dashboard_stats(today))
+
+@app.route('/api/dashboard-cache-stats')
+@role_required(['admin'])
+def api_dashboard_cache_stats():
+    """عدد مرات الإصابة والإخفاق في ذاكرة لوحة التحكم"""
+    return jsonify({
+        'success': True,
+        'data': dashboard_cache.snapshot()
+    })
+
+# ======== تجميع لوحة التحكم بالتوازي ========
+_dashboard_executor = None
+_dashboard_executor_lock = threading.Lock()
+
+def get_dashboard_executor():
+    """مجمع خيوط محدود لاستعلامات لوحات العرض"""
+    global _dashboard_executor
+    with _dashboard_executor_lock:
+        if _dashboard_executor is None:
+            _dashboard_executor = ThreadPoolExecutor(max_workers=app.config['DASHBOARD_PANEL_WORKERS'],
+                                                     thread_name_prefix='dashboard')
+            atexit.register(_dashboard_executor.shutdown, wait=False)
+        return _dashboard_executor
+
+# اللوحات المستقلة وقيمها عند عدم توفرها
+DASHBOARD_PANELS = {
+    'stats': (lambda today: get_cached_dashboard_stats(today), dict),
+    'recommendations': (lambda today: get_system_recommendations(today), list),
+    'charts': (lambda today: get_dashboard_charts(today),
+               lambda: {'sales': {'labels': [], 'data': []}, 'stock': {'labels': [], 'data': []}}),
+    'top_selling': (lambda today: get_top_selling_products(today), list),
+    'top_customers': (lambda today: get_top_customers(today), list)
+}
+
+def _load_dashboard_panel(loader, today, deadline):
+    """تشغيل لوحة واحدة في سياق تطبيق مستقل بجلسة قراءة فقط تُقطع استعلاماتها عند انتهاء مهلتها"""
+    with app.app_context():
+        g.db_read_only = True
+        g.db_statement_deadline = deadline
+        return loader(today)
+
+def assemble_dashboard(today):
+    """تشغيل لوحات لوحة التحكم بالتوازي؛ اللوحة التي تتجاوز مهلتها تُعرض كغير متوفرة ويُقطع استعلامها"""
+    executor = get_dashboard_executor()
+    timeouts = app.config['DASHBOARD_PANEL_TIMEOUTS']
+    started = time.monotonic()
+    futures = {
+        name: executor.submit(_load_dashboard_panel, loader, today,
+                              started + timeouts.get(name, app.config['DASHBOARD_PANEL_TIMEOUT']))
+        for name, (loader, _) in DASHBOARD_PANELS.items()
+    }
+    panels, unavailable = {}, []
+    for name, future in futures.items():
+        timeout = timeouts.get(name, app.config['DASHBOARD_PANEL_TIMEOUT'])
+        try:
+            panels[name] = future.result(timeout=max(0, started + timeout - time.monotonic()))
+        except FuturesTimeoutError:
+            future.cancel()
+            app.logger.warning(f"تجاوزت لوحة {name} المهلة المحددة ({timeout} ثانية)")
+            panels[name] = DASHBOARD_PANELS[name][1]()
+            unavailable.append(name)
+        except Exception as e:
+            app.logger.error(f"خطأ في تحميل لوحة {name}: {e}", exc_info=True)
+            panels[name] = DASHBOARD_PANELS[name][1]()
+            unavailable.append(name)
+    return panels, unavailable
+
+# ======== بث الأحداث المباشرة (SSE) ========
+class EventBus:
+    """ناقل أحداث داخل العملية يوزع كل حدث على طوابير المشتركين
+
+    لكل مشترك طابور محدود؛ إذا امتلأ (متصفح بطيء) تُحذف أحداثه المعلقة ويُرسل له
+    حدث resync ليعيد تحميل البيانات بدلاً من تراكم الذاكرة.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+
+    def has_subscribers(self):
+        return bool(self._subscribers)
+
+    def subscribe(self, topics):
+        with self._lock:
+            if len(self._subscribers) >= app.config['EVENT_STREAM_MAX_CLIENTS']:
+                return None
+            subscriber = queue.Queue(maxsize=app.config['EVENT_STREAM_QUEUE_SIZE'])
+            self._subscribers[subscriber] = set(topics)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.pop(subscriber, None)
+
+    def publish(self, event_type, data):
+        message = f"event: {event_type}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+        with self._lock:
+            subscribers = [sub for sub, topics in self._subscribers.items() if event_type in topics]
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(message)
+            except queue.Full:
+                with subscriber.mutex:
+                    subscriber.queue.clear()
+                subscriber.put_nowait("event: resync\ndata: {}\n\n")
+
+event_bus = EventBus()
+
+EVENT_TOPICS = ('dashboard', 'stock', 'low_stock', 'catalog')
+
+def queue_event(session_db, event_type, data):
+    """تأجيل نشر الحدث حتى نجاح حفظ المعاملة الحالية"""
+    if event_bus.has_subscribers():
+        session_db.info.setdefault('pending_events', []).append((event_type, data))
+
+def queue_stock_events(session_db, quantities):
+    """أحداث تغير أرصدة المخزون وتنبيهات المخزون المنخفض
+
+    quantities: قاموس product_id -> الرصيد بعد الحركة
+    """
+    if not event_bus.has_subscribers() or not quantities:
+        return
+    queue_event(session_db, 'stock', {
+        'products': [{'product_id': pid, 'quantity_on_hand': qty} for pid, qty in quantities.items()]
+    })
+    low = [
+        {'product_id': row.product_id, 'product_name': row.product_name,
+         'quantity_on_hand': quantities[row.product_id], 'min_stock_qty': row.min_stock_qty}
+        for row in session_db.execute(
+            select(Product.product_id, Product.product_name, Product.min_stock_qty)
+            .where(Product.product_id.in_(list(quantities)), Product.min_stock_qty > 0)
+        )
+        if quantities[row.product_id] < row.min_stock_qty
+    ]
+    if low:
+        queue_event(session_db, 'low_stock', {'products': low})
+
+@event.listens_for(OrmSession, 'after_commit')
+def _publish_events_after_commit(session_db):
+    for event_type, data in session_db.info.pop('pending_events', []):
+        event_bus.publish(event_type, data)
+
+@event.listens_for(OrmSession, 'after_rollback')
+def _discard_pending_events(session_db):
+    session_db.info.pop('pending_events', None)
+
+@app.route('/api/events')
+@role_required(['admin', 'manager', 'user'])
+def event_stream():
+    """بث مباشر لتحديثات لوحة التحكم والمخزون (Server-Sent Events)"""
+    requested = request.args.get('topics')
+    topics = [t for t in requested.split(',') if t in EVENT_TOPICS] if requested else list(EVENT_TOPICS)
+    subscriber = event_bus.subscribe(topics)
+    if subscriber is None:
+        return jsonify({'success': False, 'message': 'تم بلوغ الحد الأقصى لعدد الشاشات المتصلة'}), 503
+
+    heartbeat = app.config['EVENT_STREAM_HEARTBEAT']
+
+    def generate():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    yield subscriber.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+        finally:
+            event_bus.unsubscribe(subscriber)
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+# ======== الترتيب المتجدد للأكثر مبيعاً وأفضل العملاء ========
+def run_after_commit(session_db, callback):
+    """تنفيذ دالة بعد نجاح حفظ المعاملة الحالية فقط"""
+    session_db.info.setdefault('after_commit_callbacks', []).append(callback)
+
+@event.listens_for(OrmSession, 'after_commit')
+def _run_after_commit_callbacks(session_db):
+    for callback in session_db.info.pop('after_commit_callbacks', []):
+        try:
+            callback()
+        except Exception as e:
+            app.logger.error(f"خطأ في تنفيذ مهمة ما بعد الحفظ: {e}", exc_info=True)
+
+@event.listens_for(OrmSession, 'after_rollback')
+def _discard_after_commit_callbacks(session_db):
+    session_db.info.pop('after_commit_callbacks', None)
+
+class RollingTopK:
+    """عدادات يومية لنافذة متحركة مع ترتيب الأعلى محفوظ في الذاكرة
+
+    تُحمّل العدادات من قاعدة البيانات مرة واحدة (وكل TOP_K_REFRESH_SECONDS لتصحيح أي انحراف
+    بين العمال)، ثم تُحدّث مع كل فاتورة وتُحذف الأيام الخارجة من النافذة.
+    التحميل يتم خارج القفل حتى آخر رقم فاتورة (العلامة المائية)، والفواتير المضافة أثناءه
+    وبعد العلامة تُعاد على النتيجة المحملة.
+    """
+
+    def __init__(self, load_buckets, load_names, name_field, value_field):
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._load_buckets = load_buckets
+        self._load_names = load_names
+        self.name_field = name_field
+        self.value_field = value_field
+        self._buckets = {}
+        self._totals = {}
+        self._names = {}
+        self._top = {}
+        self._pending = None
+        self._loaded_at = None
+
+    @staticmethod
+    def _window_start(today):
+        return day_key(today - timedelta(days=app.config['TOP_K_WINDOW_DAYS']))
+
+    def _is_fresh(self):
+        return (self._loaded_at is not None
+                and time.monotonic() - self._loaded_at < app.config['TOP_K_REFRESH_SECONDS'])
+
+    def _ensure_loaded(self, today):
+        with self._lock:
+            if self._is_fresh():
+                return
+            loaded = self._loaded_at is not None
+        # عند التحديث الدوري يُخدم الترتيب الحالي إذا كان خيط آخر يحمّل بالفعل
+        if not self._load_lock.acquire(blocking=not loaded):
+            return
+        try:
+            with self._lock:
+                if self._is_fresh():
+                    return
+                self._pending = []
+            with db_session() as session_db:
+                watermark = session_db.execute(select(func.max(FinancialTransaction.transaction_id))).scalar() or 0
+                rows = self._load_buckets(session_db, self._window_start(today), watermark)
+            buckets, totals = {}, {}
+            for day, key, amount in rows:
+                bucket = buckets.setdefault(day, {})
+                bucket[key] = bucket.get(key, 0.0) + float(amount or 0)
+                totals[key] = totals.get(key, 0.0) + float(amount or 0)
+            with self._lock:
+                self._buckets, self._totals, self._top, self._names = buckets, totals, {}, {}
+                for source_id, day, amounts in self._pending:
+                    if source_id > watermark:
+                        self._apply(day, amounts)
+                self._loaded_at = time.monotonic()
+        finally:
+            with self._lock:
+                self._pending = None
+            self._load_lock.release()
+
+    def _expire(self, today):
+        start = self._window_start(today)
+        for day in [day for day in self._buckets if day < start]:
+            for key, amount in self._buckets.pop(day).items():
+                remaining = self._totals.get(key, 0.0) - amount
+                if remaining > 1e-9:
+                    self._totals[key] = remaining
+                else:
+                    self._totals.pop(key, None)
+            self._top = {}
+
+    @staticmethod
+    def _promote(ranked, n, key, total):
+        """تحديث قائمة الأعلى بعد زيادة مجموع مفتاح واحد دون إعادة ترتيب كل المفاتيح"""
+        ranked = [item for item in ranked if item[0] != key]
+        if len(ranked) < n or total > ranked[-1][1]:
+            ranked.append((key, total))
+            ranked.sort(key=lambda item: item[1], reverse=True)
+            del ranked[n:]
+        return ranked
+
+    def _apply(self, day, amounts):
+        bucket = self._buckets.setdefault(day, {})
+        for key, amount in amounts.items():
+            bucket[key] = bucket.get(key, 0.0) + amount
+            self._totals[key] = self._totals.get(key, 0.0) + amount
+            if amount < 0:
+                self._top = {}
+            for n, ranked in self._top.items():
+                self._top[n] = self._promote(ranked, n, key, self._totals[key])
+
+    def add(self, day, amounts, source_id):
+        """إضافة مبالغ فاتورة واحدة: day مفتاح اليوم YYYYMMDD، وamounts قاموس المفتاح -> الكمية أو القيمة، وsource_id رقم الفاتورة"""
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((source_id, day, amounts))
+            if self._loaded_at is not None:
+                self._apply(day, amounts)
+
+    def top(self, n, today):
+        self._ensure_loaded(today)
+        with self._lock:
+            self._expire(today)
+            if n not in self._top:
+                self._top[n] = heapq.nlargest(n, self._totals.items(), key=lambda item: item[1])
+            ranked = self._top[n]
+            missing = [key for key, _ in ranked if key not in self._names]
+        if missing:
+            with db_session() as session_db:
+                names = self._load_names(session_db, missing)
+            with self._lock:
+                self._names.update(names)
+        return [{self.name_field: self._names.get(key), self.value_field: value} for key, value in ranked]
+
+    def invalidate_names(self):
+        """نسيان الأسماء المحفوظة بعد تعديل المنتجات أو العملاء"""
+        with self._lock:
+            self._names = {}
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+            self._names = {}
+
+def build_product_sales_buckets_query(since, watermark):
+    """كميات البيع لكل (يوم، منتج) منذ مفتاح اليوم since عبر فهرس (movement_type, movement_day)"""
+    return (
+        select(InventoryMovement.movement_day, InventoryMovement.product_id,
+               func.sum(func.abs(InventoryMovement.quantity)))
+        .where(InventoryMovement.movement_type == 'sale',
+               InventoryMovement.movement_day >= since,
+               InventoryMovement.transaction_id <= watermark,
+               InventoryMovement.archived == False)
+        .group_by(InventoryMovement.movement_day, InventoryMovement.product_id)
+    )
+
+def build_customer_spend_buckets_query(since, watermark):
+    """مشتريات العملاء لكل (يوم، عميل) منذ مفتاح اليوم since عبر فهرس (transaction_type, transaction_day)"""
+    return (
+        select(FinancialTransaction.transaction_day, FinancialTransaction.entity_id,
+               func.sum(FinancialTransaction.total_amount))
+        .where(FinancialTransaction.transaction_type == 'sale',
+               FinancialTransaction.transaction_day >= since,
+               FinancialTransaction.entity_id.isnot(None),
+               FinancialTransaction.transaction_id <= watermark,
+               FinancialTransaction.archived == False)
+        .group_by(FinancialTransaction.transaction_day, FinancialTransaction.entity_id)
+    )
+
+def _load_product_sales_buckets(session_db, since, watermark):
+    return session_db.execute(build_product_sales_buckets_query(since, watermark)).all()
+
+def _load_customer_spend_buckets(session_db, since, watermark):
+    return session_db.execute(build_customer_spend_buckets_query(since, watermark)).all()
+
+top_selling_products = RollingTopK(
+    _load_product_sales_buckets,
+    lambda session_db, ids: dict(session_db.execute(
+        select(Product.product_id, Product.product_name).where(Product.product_id.in_(ids))).all()),
+    'product_name', 'total_sold'
+)
+
+top_customers_by_spend = RollingTopK(
+    _load_customer_spend_buckets,
+    lambda session_db, ids: dict(session_db.execute(
+        select(Entity.entity_id, Entity.commercial_name).where(Entity.entity_id.in_(ids))).all()),
+    'commercial_name', 'total_purchases'
+)
+
+def record_sale_rankings(session_db, transaction_id, day, quantities, customer_id, total_amount):
+    """تحديث ترتيب الأكثر مبيعاً وأفضل العملاء بعد حفظ الفاتورة"""
+    def apply():
+        top_selling_products.add(day, quantities, transaction_id)
+        if customer_id:
+            top_customers_by_spend.add(day, {int(customer_id): total_amount}, transaction_id)
+    run_after_commit(session_db, apply)
+
+@event.listens_for(OrmSession, 'after_flush')
+def _track_ranking_name_changes(session_db, flush_context):
+    """الأسماء المعروضة في الترتيب تُحمّل من جديد بعد تعديل المنتجات أو الجهات"""
+    changed = set(chain(session_db.dirty, session_db.deleted))
+    for model, ranking in ((Product, top_selling_products), (Entity, top_customers_by_spend)):
+        if any(isinstance(obj, model) for obj in changed):
+            run_after_commit(session_db, ranking.invalidate_names)
+
 # ======== الشاشة الرئيسية ========
 @app.route('/main')
 @role_required(['admin', 'manager', 'user'])
@@ -1274,14 +2316,12 @@ def main_dashboard():
     """لوحة التحكم الرئيسية"""
     try:
         today = datetime.now(timezone.utc).date()
-        stats = get_dashboard_stats(today)
-        recommendations = get_system_recommendations(today)
-        charts = get_dashboard_charts(today)
-        top_selling = get_top_selling_products(today)
-        top_customers = get_top_customers(today)
+        panels, unavailable_panels = assemble_dashboard(today)
+        stats = panels['stats']
 
-        stats['total_sales_today'] = f"{stats['total_sales_today']:,.2f}"
-        stats['total_inventory_value'] = f"{stats['total_inventory_value']:,.2f}"
+        if stats:
+            stats['total_sales_today'] = f"{stats['total_sales_today']:,.2f}"
+            stats['total_inventory_value'] = f"{stats['total_inventory_value']:,.2f}"
 
         return render_template(
             "main.html",
@@ -1290,10 +2330,11 @@ def main_dashboard():
             role=session.get('role'),
             today=today.isoformat(),
             stats=stats,
-            recommendations=recommendations,
-            charts=charts,
-            top_selling=top_selling,
-            top_customers=top_customers
+            recommendations=panels['recommendations'],
+            charts=panels['charts'],
+            top_selling=panels['top_selling'],
+            top_customers=panels['top_customers'],
+            unavailable_panels=unavailable_panels
         )
 
     except Exception as e:
@@ -1301,47 +2342,61 @@ def main_dashboard():
         flash("حدث خطأ غير متوقع في تحضير لوحة التحكم. يرجى إبلاغ الدعم الفني.", "error")
         return redirect('/')
 
+def format_trend(current, previous, label):
+    """نص نسبة التغير مقارنة بالفترة السابقة"""
+    if not previous:
+        return 'لا توجد بيانات للمقارنة'
+    return f"{(current - previous) / previous * 100:+.0f}% {label}"
+
+def build_dashboard_stats_query(today):
+    """استعلام إحصائيات لوحة التحكم كاستعلامات فرعية قياسية مستقلة عن نوع قاعدة البيانات"""
+    today_key = day_key(today)
+    summary = DailySalesSummary
+    levels_with_products = select(func.count()).select_from(InventoryLevel).join(
+        Product, InventoryLevel.product_id == Product.product_id)
+
+    def scalar(query, label):
+        return query.scalar_subquery().label(label)
+
+    def sales_on(day):
+        return select(func.coalesce(func.sum(summary.total_amount), 0)).where(
+            summary.summary_day == day.isoformat(), summary.transaction_type == 'sale')
+
+    def entity_debts(entity_type):
+        return select(func.coalesce(func.sum(Entity.current_balance), 0)).where(
+            Entity.entity_type == entity_type, Entity.current_balance < 0)
+
+    return select(
+        scalar(select(func.count()).select_from(Product).where(Product.archived == False), 'total_products'),
+        scalar(sales_on(today), 'total_sales_today'),
+        scalar(select(func.count(func.distinct(FinancialTransaction.entity_id))).where(
+            FinancialTransaction.transaction_type == 'sale',
+            FinancialTransaction.transaction_day >= day_key(today - timedelta(days=30))), 'active_customers'),
+        scalar(select(func.count()).select_from(InventoryLevel).where(
+            InventoryLevel.expiry_day.between(today_key, day_key(today + timedelta(days=30)))), 'expiry_soon'),
+        scalar(levels_with_products.where(InventoryLevel.quantity_on_hand < Product.min_stock_level), 'low_stock'),
+        scalar(select(func.count()).select_from(FinancialTransaction).where(
+            FinancialTransaction.due_day.between(today_key, day_key(today + timedelta(days=7))),
+            FinancialTransaction.payment_status != 'paid'), 'due_soon'),
+        scalar(select(func.coalesce(func.sum(InventoryLevel.quantity_on_hand * InventoryLevel.average_cost), 0))
+               .select_from(InventoryLevel).join(Product, InventoryLevel.product_id == Product.product_id),
+               'total_inventory_value'),
+        scalar(select(func.count()).select_from(Stocktake).where(Stocktake.status == 'in_progress'), 'pending_tasks'),
+        scalar(select(func.coalesce(func.sum(summary.transaction_count), 0)).where(
+            summary.summary_day == today.isoformat(),
+            summary.transaction_type.in_(SUMMARY_MOVEMENT_TYPES)), 'damaged_returned'),
+        scalar(entity_debts('customer'), 'customer_debts'),
+        scalar(entity_debts('supplier'), 'supplier_debts'),
+        scalar(sales_on(today - timedelta(days=1)), 'total_sales_yesterday'),
+        scalar(select(func.count()).select_from(Product).where(
+            Product.archived == False, Product.created_day < day_key(today.replace(day=1))), 'products_last_month')
+    )
+
 def get_dashboard_stats(today):
     """الحصول على إحصائيات لوحة التحكم"""
     try:
         with db_session() as session_db:
-            result = session_db.execute(text("""
-                SELECT 
-                    (SELECT COUNT(*) FROM products WHERE archived = 0) AS total_products,
-                    (SELECT COALESCE(SUM(total_amount), 0) 
-                     FROM financial_transactions 
-                     WHERE transaction_type = 'sale' AND DATE(transaction_date) = :today) AS total_sales_today,
-                    (SELECT COUNT(DISTINCT entity_id) 
-                     FROM financial_transactions 
-                     WHERE transaction_type = 'sale' AND transaction_date >= DATE(:today, '-30 days')) AS active_customers,
-                    (SELECT COUNT(*) 
-                     FROM inventory_levels 
-                     WHERE expiry_date BETWEEN DATE('now') AND DATE('now', '+30 days')) AS expiry_soon,
-                    (SELECT COUNT(*) 
-                     FROM inventory_levels il
-                     JOIN products p ON il.product_id = p.product_id
-                     WHERE il.quantity_on_hand < p.min_stock_level) AS low_stock,
-                    (SELECT COUNT(*) 
-                     FROM financial_transactions 
-                     WHERE due_date BETWEEN DATE('now') AND DATE('now', '+7 days')
-                     AND payment_status != 'paid') AS due_soon,
-                    (SELECT COALESCE(SUM(il.quantity_on_hand * il.average_cost), 0) 
-                     FROM inventory_levels il
-                     JOIN products p ON il.product_id = p.product_id) AS total_inventory_value,
-                    (SELECT COUNT(*) 
-                     FROM stocktakes 
-                     WHERE status = 'in_progress') AS pending_tasks,
-                    (SELECT COUNT(*) 
-                     FROM inventory_movements 
-                     WHERE movement_type IN ('damaged', 'returned') 
-                     AND DATE(movement_date) = DATE(:today)) AS damaged_returned,
-                    (SELECT COALESCE(SUM(current_balance), 0) 
-                     FROM entities 
-                     WHERE entity_type = 'customer' AND current_balance < 0) AS customer_debts,
-                    (SELECT COALESCE(SUM(current_balance), 0) 
-                     FROM entities 
-                     WHERE entity_type = 'supplier' AND current_balance < 0) AS supplier_debts
-            """), {'today': today.isoformat()}).fetchone()
+            result = session_db.execute(build_dashboard_stats_query(today)).fetchone()
             
             if result:
                 return {
@@ -1355,7 +2410,9 @@ def get_dashboard_stats(today):
                     'pending_tasks': result[7] or 0,
                     'damaged_returned': result[8] or 0,
                     'customer_debts': abs(result[9] or 0),
-                    'supplier_debts': abs(result[10] or 0)
+                    'supplier_debts': abs(result[10] or 0),
+                    'products_trend': format_trend(result[0] or 0, result[12] or 0, 'عن الشهر الماضي'),
+                    'sales_trend': format_trend(result[1] or 0, result[11] or 0, 'عن الأمس')
                 }
             return {}
     except Exception as e:
@@ -1364,14 +2421,12 @@ def get_dashboard_stats(today):
 
 @app.route('/api/dashboard-stats')
 @role_required(['admin', 'manager', 'user'])
+@db_route('read')
 def api_dashboard_stats():
     """نقطة نهاية لإحصائيات لوحة التحكم"""
     try:
         today = datetime.now(timezone.utc).date()
-        stats = get_dashboard_stats(today)
-        
-        stats['products_trend'] = "+12% عن الشهر الماضي"
-        stats['sales_trend'] = "+8% عن الأمس"
+        stats = get_cached_dashboard_stats(today)
         
         return jsonify({
             'success': True,
@@ -1384,68 +2439,114 @@ def api_dashboard_stats():
             'message': 'حدث خطأ في جلب البيانات'
         }), 500
 
+# قواعد التوصيات: كل قاعدة تستقبل حقائق المنتج المحسوبة مسبقاً وتعيد توصية أو None
+RECOMMENDATION_RULES = OrderedDict()
+
+def recommendation_rule(rule_type):
+    """تسجيل قاعدة توصيات جديدة"""
+    def decorator(func):
+        RECOMMENDATION_RULES[rule_type] = func
+        return func
+    return decorator
+
+@recommendation_rule('low_stock')
+def _low_stock_rule(facts, today):
+    if facts['min_stock_qty'] and facts['on_hand'] < facts['min_stock_qty'] * 0.5:
+        return {
+            'message': f"مخزون منخفض جداً ({facts['on_hand']:g} مقابل حد أدنى {facts['min_stock_qty']:g})",
+            'priority': 'critical',
+            'urgency': 1 - facts['on_hand'] / facts['min_stock_qty']
+        }
+
+@recommendation_rule('seasonal')
+def _seasonal_rule(facts, today):
+    # متوسط مبيعات هذا الشهر في السنوات السابقة مقابل المخزون الحالي
+    demand = facts['seasonal_demand']
+    if demand and facts['on_hand'] < demand * 0.5:
+        return {
+            'message': f'زيادة المخزون تحسباً للموسم القادم (مبيعات تاريخية: {int(demand)})',
+            'priority': 'high',
+            'urgency': demand - facts['on_hand']
+        }
+
+def load_recommendation_facts(session_db, today):
+    """حقائق جميع المنتجات النشطة (المخزون والطلب الموسمي والحدود) في استعلام واحد"""
+    years = range(today.year - app.config['RECOMMENDATION_SEASONAL_YEARS'], today.year)
+    on_hand = select(
+        InventoryLevel.product_id,
+        func.sum(InventoryLevel.quantity_on_hand).label('on_hand')
+    ).where(InventoryLevel.archived == False).group_by(InventoryLevel.product_id).subquery()
+    # نطاق من مفاتيح الأيام لهذا الشهر في كل سنة سابقة، ليُخدم من فهرس (movement_type, movement_day)
+    month_ranges = [
+        InventoryMovement.movement_day.between(year * 10000 + today.month * 100 + 1,
+                                               year * 10000 + today.month * 100 + 31)
+        for year in years
+    ]
+    seasonal = select(
+        InventoryMovement.product_id,
+        (func.sum(func.abs(InventoryMovement.quantity))
+         / func.count(func.distinct(InventoryMovement.movement_day // 10000))).label('demand')
+    ).where(
+        InventoryMovement.movement_type == 'sale',
+        InventoryMovement.archived == False,
+        or_(*month_ranges) if month_ranges else false()
+    ).group_by(InventoryMovement.product_id).subquery()
+
+    rows = session_db.execute(
+        select(
+            Product.product_id,
+            Product.product_name,
+            Product.min_stock_qty,
+            func.coalesce(on_hand.c.on_hand, 0).label('on_hand'),
+            func.coalesce(seasonal.c.demand, 0).label('seasonal_demand')
+        ).outerjoin(on_hand, on_hand.c.product_id == Product.product_id
+        ).outerjoin(seasonal, seasonal.c.product_id == Product.product_id
+        ).where(Product.archived == False)
+    )
+    return [
+        {
+            'product_id': row.product_id,
+            'product_name': row.product_name,
+            'min_stock_qty': float(row.min_stock_qty or 0),
+            'on_hand': float(row.on_hand or 0),
+            'seasonal_demand': float(row.seasonal_demand or 0)
+        }
+        for row in rows
+    ]
+
 def get_system_recommendations(today):
-    """الحصول على التوصيات الذكية للنظام"""
+    """التوصيات الذكية للنظام: أكثر المنتجات إلحاحاً لكل نوع، مرتبة حسب الأولوية"""
     recommendations = []
     
     try:
         with db_session() as session_db:
-            current_month = today.month
-            seasonal_products = session_db.query(
-                Product.product_id,
-                Product.product_name,
-                func.sum(func.abs(InventoryMovement.quantity)).label('total_sold')
-            ).join(InventoryMovement, Product.product_id == InventoryMovement.product_id
-            ).filter(
-                InventoryMovement.movement_type == 'sale',
-                extract('month', InventoryMovement.movement_date) == current_month
-            ).group_by(Product.product_id
-            ).order_by(text('total_sold DESC')
-            ).limit(3).all()
-
-            for product in seasonal_products:
-                inventory = session_db.query(
-                    func.sum(InventoryLevel.quantity_on_hand)
-                ).filter(
-                    InventoryLevel.product_id == product.product_id
-                ).scalar() or 0
-                
-                if inventory < product.total_sold * 0.5:
-                    recommendations.append({
-                        'type': 'seasonal',
-                        'product_id': product.product_id,
-                        'product_name': product.product_name,
-                        'message': f'زيادة المخزون تحسباً للموسم القادم (مبيعات تاريخية: {int(product.total_sold)})',
-                        'priority': 'high'
-                    })
-
-            low_stock_products = session_db.query(
-                Product.product_id,
-                Product.product_name,
-                func.sum(InventoryLevel.quantity_on_hand).label('current_qty'),
-                Product.min_stock_qty
-            ).join(InventoryLevel, Product.product_id == InventoryLevel.product_id
-            ).filter(
-                InventoryLevel.quantity_on_hand < Product.min_stock_qty * 0.5,
-                Product.archived == False
-            ).group_by(Product.product_id).limit(3).all()
-
-            for product in low_stock_products:
-                recommendations.append({
-                    'type': 'low_stock',
-                    'product_id': product.product_id,
-                    'product_name': product.product_name,
-                    'message': f'مخزون منخفض جداً ({product.current_qty} مقابل حد أدنى {product.min_stock_qty})',
-                    'priority': 'critical'
-                })
+            all_facts = load_recommendation_facts(session_db, today)
+
+        by_type = {rule_type: [] for rule_type in RECOMMENDATION_RULES}
+        for facts in all_facts:
+            for rule_type, rule in RECOMMENDATION_RULES.items():
+                result = rule(facts, today)
+                if result:
+                    by_type[rule_type].append(dict(
+                        result,
+                        type=rule_type,
+                        product_id=facts['product_id'],
+                        product_name=facts['product_name']
+                    ))
+        for candidates in by_type.values():
+            recommendations.extend(heapq.nlargest(app.config['RECOMMENDATIONS_PER_TYPE'], candidates,
+                                                  key=lambda x: x.get('urgency', 0)))
                 
     except Exception as e:
         app.logger.error(f"خطأ في توليد التوصيات: {e}", exc_info=True)
     
     priority_order = {'critical': 1, 'high': 2, 'medium': 3}
-    recommendations.sort(key=lambda x: priority_order.get(x.get('priority', 'medium'), 3))
+    recommendations.sort(key=lambda x: (priority_order.get(x.get('priority', 'medium'), 3), -x.get('urgency', 0)))
     
-    return recommendations
+    return [
+        {key: value for key, value in item.items() if key != 'urgency'}
+        for item in recommendations[:app.config['RECOMMENDATIONS_LIMIT']]
+    ]
 
 def get_dashboard_charts(today):
     """الحصول على بيانات المخططات للوحة التحكم"""
@@ -1458,20 +2559,19 @@ def get_dashboard_charts(today):
         with db_session() as session_db:
             week_dates = [today - timedelta(days=i) for i in range(6, -1, -1)]
             sales_data = session_db.query(
-                func.date(InventoryMovement.movement_date).label('date'),
+                InventoryMovement.movement_day,
                 func.sum(InventoryMovement.quantity * InventoryMovement.unit_price).label('total_sales')
             ).filter(
                 InventoryMovement.movement_type == 'sale',
-                InventoryMovement.movement_date.between(today - timedelta(days=7), today),
+                InventoryMovement.movement_day.between(day_key(week_dates[0]), day_key(today)),
                 InventoryMovement.archived == False
-            ).group_by(func.date(InventoryMovement.movement_date)
+            ).group_by(InventoryMovement.movement_day
             ).all()
 
-            sales_dict = {str(row.date): row.total_sales for row in sales_data}
-            for date in week_dates:
-                date_str = date.isoformat()
-                charts['sales']['labels'].append(date_str)
-                charts['sales']['data'].append(float(sales_dict.get(date_str, 0)))
+            sales_dict = {row.movement_day: row.total_sales for row in sales_data}
+            for day in week_dates:
+                charts['sales']['labels'].append(day.isoformat())
+                charts['sales']['data'].append(float(sales_dict.get(day_key(day)) or 0))
 
             categories_stock = session_db.query(
                 Category.category_name,
@@ -1497,18 +2597,7 @@ def get_top_selling_products(today):
     """الحصول على المنتجات الأكثر مبيعاً"""
     top_selling = []
     try:
-        with db_session() as session_db:
-            top_selling = session_db.query(
-                Product.product_name,
-                func.sum(func.abs(InventoryMovement.quantity)).label('total_sold')
-            ).join(InventoryMovement, Product.product_id == InventoryMovement.product_id
-            ).filter(
-                InventoryMovement.movement_type == 'sale',
-                InventoryMovement.movement_date >= today - timedelta(days=30),
-                InventoryMovement.archived == False
-            ).group_by(Product.product_name
-            ).order_by(text('total_sold DESC')
-            ).limit(5).all()
+        top_selling = top_selling_products.top(5, today)
     except Exception as e:
         app.logger.error(f"خطأ في جلب أفضل المنتجات مبيعاً: {e}", exc_info=True)
     
@@ -1518,18 +2607,7 @@ def get_top_customers(today):
     """الحصول على أفضل العملاء"""
     top_customers = []
     try:
-        with db_session() as session_db:
-            top_customers = session_db.query(
-                Entity.commercial_name,
-                func.sum(FinancialTransaction.total_amount).label('total_purchases')
-            ).join(FinancialTransaction, FinancialTransaction.entity_id == Entity.entity_id
-            ).filter(
-                FinancialTransaction.transaction_type == 'sale',
-                FinancialTransaction.transaction_date >= today - timedelta(days=30),
-                FinancialTransaction.archived == False
-            ).group_by(Entity.entity_id
-            ).order_by(text('total_purchases DESC')
-            ).limit(5).all()
+        top_customers = top_customers_by_spend.top(5, today)
     except Exception as e:
         app.logger.error(f"خطأ في جلب أفضل العملاء: {e}", exc_info=True)
     
@@ -1576,22 +2654,129 @@ def validate_password(password):
         return False, "كلمة المرور يجب أن تحتوي على رمز خاص واحد على الأقل"
     return True, ""
 
-def log_audit_action(user_id, action_type, action_table, record_id, details):
+class AuditPipeline:
+    """تجميع سجلات النشاط في طابور محدود وكتابتها دفعات بإدخال واحد من خيط في الخلفية
+
+    يُكتب الطابور بالكامل عند إيقاف الخادم. السجل الذي يجب أن يُحفظ مع عملية المستدعي
+    أو لا يُحفظ أبداً يُضاف إلى جلسة المستدعي (session_db) بدل الطابور.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._batch_lock = threading.Lock()
+        self._batch = []  # دفعة أُخذت من الطابور ولم تُكتب بعد (يكتبها العامل أو flush)
+        self._queue = None
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._queue = queue.Queue(maxsize=app.config['AUDIT_QUEUE_SIZE'])
+                self._thread = threading.Thread(target=self._run, name='audit-writer', daemon=True)
+                self._thread.start()
+        return self._queue
+
+    def submit(self, entry, session_db=None):
+        if session_db is not None:
+            session_db.execute(insert(AuditLog.__table__), [entry])
+            return
+        try:
+            self._start().put_nowait(entry)
+        except queue.Full:
+            self._write([entry])
+
+    def _drain(self, limit):
+        batch = []
+        while self._queue is not None and len(batch) < limit:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _insert(self, entries):
+        with self._write_lock, app.app_context(), db.engine.begin() as conn:
+            conn.execute(insert(AuditLog.__table__), entries)
+
+    def _write(self, batch):
+        """كتابة الدفعة؛ أخطاء القفل والاتصال تُرفع لإعادة المحاولة، والسجل التالف وحده يُسقط"""
+        try:
+            self._insert(batch)
+        except OperationalError:
+            raise
+        except SQLAlchemyError as e:
+            app.logger.warning(f"فشلت كتابة دفعة من {len(batch)} سجل نشاط، تُكتب منفردة: {e}")
+            while batch:
+                try:
+                    self._insert(batch[:1])
+                except OperationalError:
+                    # ما كُتب أُزيل من الدفعة، فإعادة المحاولة لا تكرر السجلات
+                    raise
+                except SQLAlchemyError as entry_error:
+                    app.logger.error(f"إسقاط سجل نشاط لا يمكن حفظه {batch[0]!r}: {entry_error}")
+                del batch[0]
+
+    def _run(self):
+        batch_size = app.config['AUDIT_BATCH_SIZE']
+        interval = app.config['AUDIT_FLUSH_INTERVAL']
+        while not self._stopping.is_set():
+            if not self._batch:
+                try:
+                    entry = self._queue.get(timeout=interval)
+                except queue.Empty:
+                    continue
+                with self._batch_lock:
+                    self._batch.append(entry)
+                # انتظار قصير لتجميع السجلات المتلاحقة في إدخال واحد
+                self._stopping.wait(min(interval, 0.05))
+            try:
+                with self._batch_lock:
+                    self._batch.extend(self._drain(batch_size - len(self._batch)))
+                    self._write(self._batch)
+                    self._batch = []
+            except Exception as e:
+                # تبقى الدفعة في الذاكرة وتُعاد كتابتها في الدورة التالية
+                app.logger.error(f"خطأ في كتابة {len(self._batch)} سجل نشاط: {e}", exc_info=True)
+                self._stopping.wait(interval)
+
+    def flush(self):
+        """كتابة الدفعة الجارية وكل ما في الطابور فوراً"""
+        with self._batch_lock:
+            self._batch.extend(self._drain(app.config['AUDIT_BATCH_SIZE']))
+            while self._batch:
+                self._write(self._batch)
+                self._batch = self._drain(app.config['AUDIT_BATCH_SIZE'])
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        try:
+            self.flush()
+        except Exception as e:
+            app.logger.error(f"خطأ في كتابة سجلات النشاط عند الإيقاف: {e}", exc_info=True)
+
+audit_pipeline = AuditPipeline()
+atexit.register(audit_pipeline.stop)
+
+def log_audit_action(user_id, action_type, action_table, record_id, details, session_db=None):
+    """تسجيل نشاط؛ مع session_db يُحفظ ضمن معاملة المستدعي، وبدونها يُكتب لاحقاً في دفعة"""
     try:
-        with db_session() as session_db:
-            audit_log = AuditLog(
-                user_id=user_id,
-                action_type=action_type,
-                action_table=action_table,
-                record_id=record_id,
-                action_details=details,
-                ip_address=request.remote_addr,
-                action_timestamp=get_current_utc_time(),
-                archived=False
-            )
-            session_db.add(audit_log)
-            session_db.commit()
+        audit_pipeline.submit({
+            'user_id': user_id,
+            'action_type': action_type,
+            'action_table': action_table,
+            'record_id': record_id,
+            'action_details': details,
+            'ip_address': request.remote_addr if has_request_context() else None,
+            'action_timestamp': get_current_utc_time(),
+            'archived': False
+        }, session_db=session_db)
     except Exception as e:
+        if session_db is not None:
+            raise
         app.logger.error(f"خطأ في تسجيل النشاط: {e}", exc_info=True)
 
 @users_bp.route('', methods=['GET'])
@@ -1803,6 +2988,8 @@ def api_archive_user(user_id):
 def api_permanent_delete_user(user_id):
     """حذف مستخدم نهائيًا"""
     try:
+        # سجلات النشاط المنتظرة في الطابور يجب أن تُحسب قبل السماح بالحذف
+        audit_pipeline.flush()
         with db_session() as session_db:
             user = session_db.query(User).get(user_id)
             if not user:
@@ -1892,15 +3079,17 @@ def api_assign_permission():
             )
             
             session_db.add(new_assignment)
-            session_db.commit()
+            session_db.flush()
             
             log_audit_action(
                 user_id=session.get('user_id'),
                 action_type='assign_permission',
                 action_table='user_permissions',
                 record_id=new_assignment.user_permission_id,
-                details=f"منح صلاة {permission.permission_name} للمستخدم {user.username}"
+                details=f"منح صلاة {permission.permission_name} للمستخدم {user.username}",
+                session_db=session_db
             )
+            session_db.commit()
             
             return json_response(success=True, message="تم منح الصلاحية بنجاح")
     except CSRFError:
@@ -1923,15 +3112,16 @@ def api_revoke_permission(assignment_id):
             user = session_db.query(User).get(assignment.user_id)
             
             assignment.archived = True
-            session_db.commit()
             
             log_audit_action(
                 user_id=session.get('user_id'),
                 action_type='revoke_permission',
                 action_table='user_permissions',
                 record_id=assignment_id,
-                details=f"سحب صلاحية {permission.permission_name} من المستخدم {user.username}"
+                details=f"سحب صلاحية {permission.permission_name} من المستخدم {user.username}",
+                session_db=session_db
             )
+            session_db.commit()
             
             return json_response(success=True, message="تم سحب الصلاحية بنجاح")
     except Exception as e:
@@ -2465,6 +3655,7 @@ def api_create_product():
                 
             new_product = Product(
                 product_code=data['code'],
+                barcode=data.get('barcode') or None,
                 product_name=data['name'],
                 description=data.get('description', ''),
                 category_id=data['category_id'],
@@ -2478,11 +3669,15 @@ def api_create_product():
                 has_expiry=bool(data.get('has_expiry', False)),
                 is_serialized=bool(data.get('is_serialized', False)),
                 is_batch_tracked=bool(data.get('is_batch_tracked', False)),
+                tax_class=data.get('tax_class') or None,
                 created_at=get_current_utc_time()
             )
             
             session_db.add(new_product)
+            bump_product_version(session_db, new_product)
             session_db.commit()
+            product_barcode_index.apply(new_product)
+            tax_rate_table.invalidate()
             
             app.logger.info(f"تم إنشاء منتج جديد: {new_product.product_name} (ID: {new_product.product_id})")
             
@@ -2530,6 +3725,7 @@ def api_update_product(product_id):
             }
                 
             product.product_code = data.get('code', product.product_code)
+            product.barcode = data.get('barcode', product.barcode) or None
             product.product_name = data.get('name', product.product_name)
             product.description = data.get('description', product.description)
             product.category_id = data.get('category_id', product.category_id)
@@ -2543,9 +3739,21 @@ def api_update_product(product_id):
             product.has_expiry = bool(data.get('has_expiry', product.has_expiry))
             product.is_serialized = bool(data.get('is_serialized', product.is_serialized))
             product.is_batch_tracked = bool(data.get('is_batch_tracked', product.is_batch_tracked))
+            product.tax_class = data.get('tax_class', product.tax_class) or None
             product.updated_at = get_current_utc_time()
+            bump_product_version(session_db, product)
+            if old_data['price'] != product.unit_price:
+                session_db.add(PriceHistory(
+                    product_id=product.product_id,
+                    old_price=old_data['price'],
+                    new_price=product.unit_price,
+                    change_date=product.updated_at,
+                    created_by=session.get('user_id')
+                ))
             
             session_db.commit()
+            product_barcode_index.apply(product)
+            tax_rate_table.invalidate()
             
             changes = []
             if old_data['name'] != product.product_name:
@@ -2596,7 +3804,10 @@ def api_delete_product(product_id):
                 
             product.archived = True
             product.updated_at = get_current_utc_time()
+            bump_product_version(session_db, product)
             session_db.commit()
+            product_barcode_index.apply(product)
+            tax_rate_table.invalidate()
             
             return jsonify({
                 'success': True,
@@ -2710,29 +3921,30 @@ def alerts_activities():
 # ======== مسارات شاشة فئات المنتجات ========
 @app.route('/product_categories')
 @permission_required('can_manage_categories')
+@db_route('read')
 def product_categories():
     try:
         with db_session() as session_db:
-            categories = session_db.execute(text("""
-                SELECT 
-                    c.category_id,
-                    c.category_name,
-                    c.category_type,
-                    c.description,
-                    c.tax_rate,
-                    c.is_active,
-                    p.category_name AS parent_name
-                FROM categories c
-                LEFT JOIN categories p ON c.parent_category_id = p.category_id
-                WHERE c.archived = 0
-                ORDER BY c.category_name
-            """)).fetchall()
-            
-            parent_categories = session_db.execute(text("""
-                SELECT category_id, category_name 
-                FROM categories 
-                WHERE archived = 0 AND parent_category_id IS NULL
-            """)).fetchall()
+            parent = aliased(Category)
+            categories = session_db.query(
+                Category.category_id,
+                Category.category_name,
+                Category.category_type,
+                Category.description,
+                Category.tax_rate,
+                Category.is_active,
+                parent.category_name.label('parent_name')
+            ).outerjoin(parent, Category.parent_category_id == parent.category_id
+            ).filter(Category.archived == False
+            ).order_by(Category.category_name).all()
+            
+            parent_categories = session_db.query(
+                Category.category_id,
+                Category.category_name
+            ).filter(
+                Category.archived == False,
+                Category.parent_category_id.is_(None)
+            ).all()
             
             return render_template('product_categories.html', 
                                   categories=categories,
@@ -2752,19 +3964,21 @@ def units():
 # ======== مسارات إدارة المخزون ========
 @app.route('/inventory')
 @permission_required('can_manage_inventory')
+@db_route('read')
 def inventory_overview():
     try:
         with db_session() as session_db:
-            stats = session_db.execute(text("""
-                SELECT 
-                    COUNT(DISTINCT p.product_id) AS total_products,
-                    COUNT(CASE WHEN il.quantity_on_hand <= 0 THEN 1 END) AS out_of_stock,
-                    SUM(il.quantity_on_hand) AS total_quantity,
-                    SUM(il.quantity_on_hand * il.average_cost) AS total_value
-                FROM inventory_levels il
-                JOIN products p ON il.product_id = p.product_id
-                WHERE il.archived = 0 AND p.archived = 0
-            """)).fetchone()
+            stats = session_db.query(
+                func.count(func.distinct(Product.product_id)).label('total_products'),
+                func.count(case((InventoryLevel.quantity_on_hand <= 0, 1))).label('out_of_stock'),
+                func.sum(InventoryLevel.quantity_on_hand).label('total_quantity'),
+                func.sum(InventoryLevel.quantity_on_hand * InventoryLevel.average_cost).label('total_value')
+            ).select_from(InventoryLevel
+            ).join(Product, InventoryLevel.product_id == Product.product_id
+            ).filter(
+                InventoryLevel.archived == False,
+                Product.archived == False
+            ).one()
         
         return render_template("inventory.html", stats=stats)
     except Exception as e:
@@ -2782,22 +3996,66 @@ MOVEMENT_TYPES = {
     'transfer': {'name': 'تحويل', 'direction': 0}
 }
 
+def build_inventory_movements_query(today, days, before=None):
+    """صفحة من حركات المخزون لآخر days يوماً، الأحدث أولاً
+
+    الترقيم بالمفتاح (movement_day, movement_id): before آخر مفتاح في الصفحة السابقة،
+    ونطاق movement_day يُخدم من فهرس بدل قراءة الجدول كاملاً. تُجلب صفاً زائداً لمعرفة وجود صفحة تالية.
+    """
+    query = select(InventoryMovement, Product, Warehouse).join(
+        Product, InventoryMovement.product_id == Product.product_id
+    ).join(
+        Warehouse, InventoryMovement.warehouse_id == Warehouse.warehouse_id
+    ).where(
+        InventoryMovement.archived == False,
+        InventoryMovement.movement_day >= day_key(today - timedelta(days=days))
+    )
+    if before is not None:
+        before_day, before_id = before
+        query = query.where(
+            InventoryMovement.movement_day <= before_day,
+            or_(InventoryMovement.movement_day < before_day, InventoryMovement.movement_id < before_id)
+        )
+    return query.order_by(
+        InventoryMovement.movement_day.desc(), InventoryMovement.movement_id.desc()
+    ).limit(app.config['INVENTORY_MOVEMENTS_PAGE_SIZE'] + 1)
+
+def _parse_movements_cursor(value):
+    """مؤشر الصفحة التالية بصيغة YYYYMMDD-movement_id"""
+    if not value:
+        return None
+    try:
+        before_day, before_id = (int(part) for part in value.split('-'))
+    except ValueError:
+        raise ValueError('مؤشر الصفحة غير صالح')
+    return before_day, before_id
+
 @app.route('/inventory_movements')
 @permission_required('can_manage_inventory')
+@db_route('read')
 def inventory_movements():
     try:
+        days = request.args.get('days', app.config['INVENTORY_MOVEMENTS_DAYS'], type=int)
+        days = min(max(days, 1), app.config['INVENTORY_MOVEMENTS_MAX_DAYS'])
+        before = _parse_movements_cursor(request.args.get('before'))
+        today = datetime.now(timezone.utc).date()
         with db_session() as session_db:
-            movements = session_db.query(
-                InventoryMovement, Product, Warehouse
-            ).join(Product, InventoryMovement.product_id == Product.product_id
-            ).join(Warehouse, InventoryMovement.warehouse_id == Warehouse.warehouse_id
-            ).filter(InventoryMovement.archived == False
-            ).order_by(InventoryMovement.movement_date.desc()).all()
+            movements = session_db.execute(build_inventory_movements_query(today, days, before)).all()
+            truncated = len(movements) > app.config['INVENTORY_MOVEMENTS_PAGE_SIZE']
+            movements = movements[:app.config['INVENTORY_MOVEMENTS_PAGE_SIZE']]
+            next_cursor = None
+            if truncated:
+                last = movements[-1][0]
+                next_cursor = f"{last.movement_day}-{last.movement_id}"
             
             for movement, product, warehouse in movements:
                 movement.type_name = MOVEMENT_TYPES.get(movement.movement_type, {}).get('name', movement.movement_type)
         
-        return render_template("inventory_movements.html", movements=movements)
+        return render_template("inventory_movements.html", movements=movements, days=days,
+                               truncated=truncated, next_cursor=next_cursor)
+    except ValueError as e:
+        flash(f"❌ {e}", "error")
+        return redirect('/inventory_movements')
     except Exception as e:
         app.logger.error(f"خطأ في جلب الحركات المخزنية: {e}", exc_info=True)
         flash("❌ حدث خطأ أثناء جلب بيانات الحركات", "error")
@@ -2815,34 +4073,39 @@ def stocktake():
 def reports():
     return render_template("reports.html")
 
+def build_low_stock_query():
+    """أرصدة المستودعات النافذة أو الأقل من الحد الأدنى للمنتج"""
+    return select(
+        Product.product_id,
+        Product.product_code,
+        Product.product_name,
+        Product.min_stock_level,
+        InventoryLevel.quantity_on_hand,
+        Warehouse.warehouse_name,
+        case(
+            (InventoryLevel.quantity_on_hand <= 0, 'نفاذ'),
+            (InventoryLevel.quantity_on_hand < Product.min_stock_level, 'تحذير'),
+            else_='طبيعي'
+        ).label('alert_level')
+    ).join(InventoryLevel, Product.product_id == InventoryLevel.product_id
+    ).join(Warehouse, InventoryLevel.warehouse_id == Warehouse.warehouse_id
+    ).where(
+        or_(
+            InventoryLevel.quantity_on_hand <= 0,
+            InventoryLevel.quantity_on_hand < Product.min_stock_level
+        ),
+        Product.archived == False,
+        InventoryLevel.archived == False,
+        Warehouse.archived == False
+    ).order_by(text('alert_level DESC, quantity_on_hand ASC'))
+
 @app.route('/low-stock-report')
 @permission_required('can_view_reports')
+@db_route('read')
 def low_stock_report():
     try:
         with db_session() as session_db:
-            alerts = session_db.query(
-                Product.product_id,
-                Product.product_code,
-                Product.product_name,
-                Product.min_stock_level,
-                InventoryLevel.quantity_on_hand,
-                Warehouse.warehouse_name,
-                case(
-                    [(InventoryLevel.quantity_on_hand <= 0, 'نفاذ')],
-                    [(InventoryLevel.quantity_on_hand < Product.min_stock_level, 'تحذير')],
-                    else_='طبيعي'
-                ).label('alert_level')
-            ).join(InventoryLevel, Product.product_id == InventoryLevel.product_id
-            ).join(Warehouse, InventoryLevel.warehouse_id == Warehouse.warehouse_id
-            ).filter(
-                or_(
-                    InventoryLevel.quantity_on_hand <= 0,
-                    InventoryLevel.quantity_on_hand < Product.min_stock_level
-                ),
-                Product.archived == False,
-                InventoryLevel.archived == False,
-                Warehouse.archived == False
-            ).order_by(text('alert_level DESC, quantity_on_hand ASC')).all()
+            alerts = session_db.execute(build_low_stock_query()).all()
         
         return render_template("low_stock_report.html", alerts=alerts)
     except Exception as e:
@@ -2850,15 +4113,2773 @@ def low_stock_report():
         flash("❌ حدث خطأ أثناء جلب التقرير", "error")
         return redirect('/reports')
 
-#@app.route('/users/')
-#def users_page():
-#    return render_template('users.html')
+# ======== فهرس الباركود في الذاكرة ========
+def bump_product_version(session_db, product):
+    """منح المنتج رقم إصدار جديد من عداد الكتالوج لإبطال النسخ المخزنة مؤقتاً
+
+    الزيادة بجملة واحدة مع RETURNING تقفل صف العداد حتى نهاية المعاملة، فلا يحصل
+    تعديلان متزامنان على نفس الإصدار ولا يُحفظ إصدار أعلى قبل إصدار أدنى.
+    """
+    table = CatalogVersion.__table__
+    version = session_db.execute(
+        update(table).where(table.c.counter_id == 1)
+        .values(version=table.c.version + 1).returning(table.c.version)
+    ).scalar()
+    if version is None:
+        # أول استخدام: يبدأ العداد بعد أعلى إصدار محفوظ في المنتجات
+        seed = (session_db.query(func.max(Product.version)).scalar() or 0) + 1
+        stmt = upsert_insert(session_db, table).values(counter_id=1, version=seed)
+        version = session_db.execute(
+            stmt.on_conflict_do_update(index_elements=['counter_id'], set_={'version': table.c.version + 1})
+            .returning(table.c.version)
+        ).scalar_one()
+    product.version = version
+    queue_event(session_db, 'catalog', {'version': product.version})
+    return product.version
+
+class ProductBarcodeIndex:
+    """فهرس في ذاكرة العملية يربط الباركود وكود المنتج ببيانات البيع
+
+    قبل الخدمة يُقارن إصدار الفهرس بعداد الكتالوج المحفوظ (مرة كل BARCODE_INDEX_CHECK_SECONDS)،
+    فإذا عدّل عامل آخر منتجاً تُجلب المنتجات ذات الإصدار الأحدث فقط. القراءة عبر اتصال مستقل
+    حتى لا تُغلق جلسة المستدعي (مثل ترحيل الفاتورة).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_code = {}
+        self._by_id = {}
+        self._loaded = False
+        self._checked_at = 0.0
+        self.version = 0
+
+    @staticmethod
+    def _make_entry(product_id, code, barcode, name, price, unit, version):
+        return {
+            'id': product_id,
+            'code': code,
+            'barcode': barcode,
+            'name': name,
+            'price': float(price or 0),
+            'unit': unit,
+            'version': version or 0
+        }
+
+    @staticmethod
+    def _select_products():
+        return select(
+            Product.product_id,
+            Product.product_code,
+            Product.barcode,
+            Product.product_name,
+            Product.unit_price,
+            Product.version,
+            Product.archived,
+            Product.is_active,
+            Unit.unit_name
+        ).outerjoin(Unit, Product.unit_id == Unit.unit_id)
+
+    def _store(self, row):
+        self._remove(row.product_id)
+        if row.archived or row.is_active is False:
+            return
+        entry = self._make_entry(row.product_id, row.product_code, row.barcode,
+                                 row.product_name, row.unit_price, row.unit_name, row.version)
+        self._by_id[row.product_id] = entry
+        self._by_code[row.product_code] = entry
+        if row.barcode:
+            self._by_code[row.barcode] = entry
+
+    def _load(self):
+        with db.engine.connect() as conn:
+            rows = conn.execute(self._select_products().where(Product.archived == False)).all()
+            persisted = conn.execute(
+                select(CatalogVersion.version).where(CatalogVersion.counter_id == 1)
+            ).scalar()
+
+        self._by_code, self._by_id = {}, {}
+        for row in rows:
+            self._store(row)
+        self.version = max([persisted or 0] + [row.version or 0 for row in rows])
+        self._checked_at = time.monotonic()
+        self._loaded = True
+        app.logger.info(f"تم تحميل فهرس الباركود: {len(self._by_id)} منتج (إصدار الكتالوج {self.version})")
+
+    def _refresh(self):
+        """جلب المنتجات التي تغيرت في عمليات أخرى منذ إصدار الفهرس"""
+        with db.engine.connect() as conn:
+            persisted = conn.execute(
+                select(CatalogVersion.version).where(CatalogVersion.counter_id == 1)
+            ).scalar() or 0
+            if persisted <= self.version:
+                return
+            rows = conn.execute(self._select_products().where(Product.version > self.version)).all()
+        for row in rows:
+            current = self._by_id.get(row.product_id)
+            if not current or current['version'] < (row.version or 0):
+                self._store(row)
+        self.version = max(self.version, persisted)
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self._load()
+            return
+        if time.monotonic() - self._checked_at >= app.config['BARCODE_INDEX_CHECK_SECONDS']:
+            with self._lock:
+                if time.monotonic() - self._checked_at >= app.config['BARCODE_INDEX_CHECK_SECONDS']:
+                    self._refresh()
+                    self._checked_at = time.monotonic()
+
+    def lookup(self, code):
+        """البحث عن منتج بالباركود أو كود المنتج دون الرجوع لقاعدة البيانات"""
+        self._ensure_loaded()
+        entry = self._by_code.get(code)
+        return dict(entry) if entry else None
+
+    def get(self, product_id):
+        """بيانات المنتج برقمه الداخلي من الفهرس"""
+        self._ensure_loaded()
+        entry = self._by_id.get(product_id)
+        return dict(entry) if entry else None
+
+    def _remove(self, product_id):
+        entry = self._by_id.pop(product_id, None)
+        if entry:
+            for key in (entry['code'], entry['barcode']):
+                if key and self._by_code.get(key) is entry:
+                    del self._by_code[key]
+
+    def apply(self, product):
+        """تطبيق تغيير منتج بعد حفظه، مع تجاهل الإصدارات الأقدم من المخزنة"""
+        if not self._loaded:
+            return
+        with self._lock:
+            version = product.version or 0
+            current = self._by_id.get(product.product_id)
+            if current and current['version'] >= version:
+                return
+            self._remove(product.product_id)
+            if not product.archived and product.is_active is not False:
+                entry = self._make_entry(product.product_id, product.product_code, product.barcode,
+                                         product.product_name, product.unit_price,
+                                         product.unit.unit_name if product.unit else None, version)
+                self._by_id[product.product_id] = entry
+                self._by_code[product.product_code] = entry
+                if product.barcode:
+                    self._by_code[product.barcode] = entry
+
+    def invalidate(self):
+        """إسقاط الفهرس بالكامل ليعاد تحميله عند أول طلب"""
+        with self._lock:
+            self._loaded = False
+
+product_barcode_index = ProductBarcodeIndex()
+
+# ======== مسارات شاشة البيع بالباركود ========
+barcode_sales_bp = Blueprint('barcode_sales', __name__, url_prefix='/barcode_sales')
+
+@barcode_sales_bp.route('/api/products/barcode/<barcode>', methods=['GET'])
+@role_required(['admin', 'manager', 'user'])
+def api_product_by_barcode(barcode):
+    """جلب منتج بالباركود من الفهرس في الذاكرة"""
+    try:
+        product = product_barcode_index.lookup(barcode.strip())
+        if not product:
+            return jsonify({
+                'success': False,
+                'message': 'لم يتم العثور على المنتج'
+            }), 404
+        return jsonify({
+            'success': True,
+            'product': product
+        })
+    except Exception as e:
+        app.logger.error(f"خطأ في البحث بالباركود {barcode}: {e}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'message': 'حدث خطأ أثناء جلب بيانات المنتج'
+        }), 500
+
+@barcode_sales_bp.route('/api/products/lookup', methods=['POST'])
+@role_required(['admin', 'manager', 'user'])
+def api_products_batch_lookup():
+    """البحث عن مجموعة باركودات أو أكواد منتجات في طلب واحد واستعلام واحد"""
+    try:
+        data = request.get_json() or {}
+        validate_pos_csrf(data)
+        codes = data.get('codes')
+        if not isinstance(codes, list) or not codes:
+            return jsonify({'success': False, 'message': 'يرجى إرسال قائمة الأكواد'}), 400
+        codes = [str(code).strip() for code in codes]
+        unique_codes = list(dict.fromkeys(code for code in codes if code))
+        if len(unique_codes) > app.config['POS_LOOKUP_MAX_CODES']:
+            return jsonify({
+                'success': False,
+                'message': f"الحد الأقصى {app.config['POS_LOOKUP_MAX_CODES']} كود في الطلب الواحد"
+            }), 400
+
+        found = {}
+        if unique_codes:
+            with db_session() as session_db:
+                rows = session_db.query(
+                    Product.product_id,
+                    Product.product_code,
+                    Product.barcode,
+                    Product.product_name,
+                    Product.unit_price,
+                    Product.version,
+                    Unit.unit_name
+                ).outerjoin(Unit, Product.unit_id == Unit.unit_id
+                ).filter(
+                    or_(Product.barcode.in_(unique_codes), Product.product_code.in_(unique_codes)),
+                    Product.archived == False,
+                    or_(Product.is_active == True, Product.is_active.is_(None))
+                ).all()
+            for row in rows:
+                entry = ProductBarcodeIndex._make_entry(row.product_id, row.product_code, row.barcode,
+                                                        row.product_name, row.unit_price, row.unit_name,
+                                                        row.version)
+                found.setdefault(row.product_code, entry)
+                if row.barcode:
+                    found[row.barcode] = entry
+
+        results = []
+        for code in codes:
+            if code in found:
+                results.append({'code': code, 'found': True, 'product': found[code]})
+            else:
+                results.append({'code': code, 'found': False, 'message': 'لم يتم العثور على المنتج'})
+
+        return jsonify({
+            'success': True,
+            'results': results,
+            'not_found': [code for code in unique_codes if code not in found]
+        })
+    except (CSRFError, ValidationError):
+        return jsonify({
+            'success': False,
+            'message': 'رمز CSRF غير صالح'
+        }), 400
+    except Exception as e:
+        app.logger.error(f"خطأ في البحث المجمّع عن المنتجات: {e}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'message': 'حدث خطأ أثناء جلب بيانات المنتجات'
+        }), 500
+
+CATALOG_FIELDS = ['id', 'code', 'barcode', 'name', 'price', 'unit']
+
+@barcode_sales_bp.route('/api/catalog', methods=['GET'])
+@role_required(['admin', 'manager', 'user'])
+def api_catalog_changes():
+    """تغييرات الكتالوج منذ إصدار معين لتحديث النسخة المحلية على أجهزة البيع"""
+    since = request.args.get('since', 0, type=int)
+    try:
+        with db_session() as session_db:
+            query = session_db.query(
+                Product.product_id,
+                Product.product_code,
+                Product.barcode,
+                Product.product_name,
+                Product.unit_price,
+                Product.version,
+                Product.archived,
+                Product.is_active,
+                Unit.unit_name
+            ).outerjoin(Unit, Product.unit_id == Unit.unit_id)
+            if since > 0:
+                query = query.filter(Product.version > since)
+            else:
+                query = query.filter(Product.archived == False)
+            rows = query.all()
+
+        products, deleted, version = [], [], since
+        for row in rows:
+            version = max(version, row.version or 0)
+            if row.archived or row.is_active is False:
+                deleted.append(row.product_id)
+                continue
+            products.append([row.product_id, row.product_code, row.barcode, row.product_name,
+                             float(row.unit_price or 0), row.unit_name])
+
+        return jsonify({
+            'success': True,
+            'full': since <= 0,
+            'version': version,
+            'fields': CATALOG_FIELDS,
+            'products': products,
+            'deleted': deleted
+        })
+    except Exception as e:
+        app.logger.error(f"خطأ في جلب تغييرات الكتالوج: {e}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'message': 'حدث خطأ أثناء جلب الكتالوج'
+        }), 500
+
+# ======== محرك الضريبة والإجماليات ========
+def resolve_tax_rate(tax_class, category_rate):
+    """نسبة الضريبة للمنتج: فئة ضريبية ثابتة، ثم نسبة التصنيف، ثم النسبة الافتراضية
+
+    التصنيفات القديمة حُفظت بنسبة 0 افتراضياً، لذلك تُعامل النسبة الصفرية كغير محددة؛
+    السلع المعفاة أو الصفرية تُحدد بالفئة الضريبية exempt أو zero على المنتج.
+    """
+    class_rates = app.config['TAX_CLASS_RATES']
+    tax_class = (tax_class or '').strip().lower()
+    if tax_class in class_rates:
+        return float(class_rates[tax_class])
+    if category_rate:
+        return float(category_rate)
+    return float(app.config['DEFAULT_TAX_RATE'])
+
+def _money(value):
+    return Decimal(str(value)).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+
+class TaxRateTable:
+    """جدول نسب الضريبة لكل منتج، محسوب مسبقاً ومحفوظ في الذاكرة"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rates = {}
+        self._loaded_at = None
+
+    def _load(self):
+        # اتصال مستقل حتى لا يُغلق التحميل جلسة الطلب الجارية (مثل ترحيل فاتورة)
+        with db.engine.connect() as conn:
+            rows = conn.execute(
+                select(Product.product_id, Product.tax_class, Category.tax_rate)
+                .outerjoin(Category, Product.category_id == Category.category_id)
+            ).all()
+        self._rates = {row.product_id: resolve_tax_rate(row.tax_class, row.tax_rate) for row in rows}
+        self._loaded_at = time.monotonic()
+
+    def rates(self):
+        with self._lock:
+            if self._loaded_at is None or time.monotonic() - self._loaded_at > app.config['TAX_RATE_TABLE_TTL']:
+                self._load()
+            return self._rates
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+tax_rate_table = TaxRateTable()
+
+@event.listens_for(OrmSession, 'after_flush')
+def _track_category_writes(session_db, flush_context):
+    """إبطال جدول النسب بعد حفظ أي تعديل على التصنيفات (النسبة أو الأرشفة)"""
+    if session_db.info.get('tax_rates_dirty'):
+        return
+    if any(isinstance(obj, Category) for obj in chain(session_db.new, session_db.dirty, session_db.deleted)):
+        session_db.info['tax_rates_dirty'] = True
+        run_after_commit(session_db, tax_rate_table.invalidate)
+
+@event.listens_for(OrmSession, 'after_commit')
+@event.listens_for(OrmSession, 'after_rollback')
+def _clear_category_writes(session_db):
+    session_db.info.pop('tax_rates_dirty', None)
+
+class TaxEngine:
+    """حساب إجماليات السلة والضريبة لكل الأسطر في تمريرة واحدة"""
+
+    def __init__(self, rate_table):
+        self.rate_table = rate_table
+
+    def price_basket(self, lines):
+        """lines: قائمة (product_id, quantity, unit_price)"""
+        rates = self.rate_table.rates()
+        default_rate = float(app.config['DEFAULT_TAX_RATE'])
+        priced, subtotal, tax_total = [], Decimal('0'), Decimal('0')
+        for product_id, quantity, unit_price in lines:
+            rate = rates.get(product_id, default_rate)
+            net = _money(Decimal(str(quantity)) * Decimal(str(unit_price or 0)))
+            tax = _money(net * Decimal(str(rate)))
+            subtotal += net
+            tax_total += tax
+            priced.append({
+                'product_id': product_id,
+                'quantity': quantity,
+                'unit_price': float(unit_price or 0),
+                'tax_rate': rate,
+                'net_amount': float(net),
+                'tax_amount': float(tax),
+                'total_amount': float(net + tax)
+            })
+        return {
+            'lines': priced,
+            'subtotal': float(subtotal),
+            'tax_amount': float(tax_total),
+            'total_amount': float(subtotal + tax_total)
+        }
+
+tax_engine = TaxEngine(tax_rate_table)
+
+@barcode_sales_bp.route('/calculate-totals', methods=['POST'])
+@role_required(['admin', 'manager', 'user'])
+def calculate_totals():
+    """حساب إجماليات السلة والضريبة من أسعار الكتالوج (يُستدعى عند كل تغيير في السلة)"""
+    try:
+        data = request.get_json() or {}
+        validate_pos_csrf(data)
+        lines = _parse_sale_items(data.get('items'))
+        basket_lines = []
+        for product_id, quantity in lines.items():
+            product = product_barcode_index.get(product_id)
+            if not product:
+                return jsonify({'success': False, 'message': f'منتج غير موجود: {product_id}'}), 400
+            basket_lines.append((product_id, quantity, product['price']))
+        return jsonify(dict(tax_engine.price_basket(basket_lines), success=True))
+    except (CSRFError, ValidationError):
+        return jsonify({
+            'success': False,
+            'message': 'رمز CSRF غير صالح'
+        }), 400
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        app.logger.error(f"خطأ في حساب إجماليات السلة: {e}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'message': 'حدث خطأ أثناء حساب الإجماليات'
+        }), 500
+
+# ======== محرك ترحيل فواتير البيع ========
+def validate_pos_csrf(data):
+    """التحقق من رمز الحماية المرسل من شاشة البيع (في الجسم أو الترويسة)"""
+    validate_csrf(data.get('_csrf_token') or request.headers.get('X-CSRFToken', ''))
+
+def get_default_warehouse_id(session_db):
+    """المستودع الافتراضي لنقطة البيع"""
+    warehouse_id = session_db.query(Warehouse.warehouse_id).filter(
+        Warehouse.archived == False,
+        or_(Warehouse.is_active == True, Warehouse.is_active.is_(None))
+    ).order_by(Warehouse.is_default.desc(), Warehouse.warehouse_id).limit(1).scalar()
+    if warehouse_id is None:
+        raise ValueError('لا يوجد مستودع نشط لتسجيل الحركة')
+    return warehouse_id
+
+def _parse_sale_items(items):
+    """دمج أسطر الفاتورة حسب المنتج والتحقق من الكميات"""
+    if not isinstance(items, list) or not items:
+        raise ValueError('يرجى إضافة منتجات قبل الترحيل')
+    lines = {}
+    for item in items:
+        try:
+            product_id = int(item['product_id'])
+            quantity = float(item['quantity'])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('بيانات أحد أسطر الفاتورة غير صالحة')
+        if quantity <= 0:
+            raise ValueError('الكمية يجب أن تكون أكبر من صفر')
+        lines[product_id] = lines.get(product_id, 0.0) + quantity
+    return lines
+
+def _parse_client_timestamp(value):
+    """وقت البيع المسجل على الجهاز (للفواتير المرحلة بعد انقطاع الاتصال)"""
+    if not value:
+        return None
+    try:
+        sold_at = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        raise ValueError('وقت البيع غير صالح')
+    if sold_at.tzinfo is None:
+        sold_at = sold_at.replace(tzinfo=timezone.utc)
+    return sold_at.astimezone(timezone.utc).isoformat()
+
+def _parse_optional_id(value, message):
+    """تحويل معرف اختياري قادم من الطلب إلى رقم صحيح"""
+    if value in (None, ''):
+        return None
+    try:
+        parsed = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(message)
+    if parsed <= 0 or str(parsed) != str(value).strip():
+        raise ValueError(message)
+    return parsed
+
+def post_sale(session_db, sale_data, created_by):
+    """ترحيل فاتورة بيع كاملة داخل معاملة المستدعي باستخدام إدخالات وتحديثات مجمّعة
+
+    جميع أخطاء التحقق (ValueError) تُرفع قبل أول عملية كتابة، لذلك يمكن ترحيل
+    عدة فواتير في معاملة واحدة وتجاوز المرفوض منها دون نقاط حفظ.
+    المبلغ غير المدفوع يُقيد على رصيد العميل (بالسالب) ضمن حد الائتمان إن وُجد.
+    """
+    lines = _parse_sale_items(sale_data.get('items'))
+    product_ids = list(lines)
+    payment_type = sale_data.get('payment_type') or 'cash'
+    customer_id = _parse_optional_id(sale_data.get('customer_id'), 'رقم العميل غير صالح')
+    warehouse_id = _parse_optional_id(sale_data.get('warehouse_id'), 'رقم المستودع غير صالح')
+    if payment_type == 'credit' and not customer_id:
+        raise ValueError('يجب اختيار العميل في البيع الآجل')
+
+    products = {
+        row.product_id: row for row in session_db.execute(
+            select(Product.product_id, Product.product_name, Product.unit_price)
+            .where(Product.product_id.in_(product_ids), Product.archived == False)
+        )
+    }
+    missing = [pid for pid in product_ids if pid not in products]
+    if missing:
+        raise ValueError(f'منتجات غير موجودة: {", ".join(map(str, missing))}')
+
+    if warehouse_id is None:
+        warehouse_id = get_default_warehouse_id(session_db)
+    elif session_db.execute(
+        select(Warehouse.warehouse_id).where(Warehouse.warehouse_id == warehouse_id, Warehouse.archived == False)
+    ).first() is None:
+        raise ValueError('المستودع غير موجود')
+    customer = None
+    if customer_id is not None:
+        customer = session_db.execute(for_update(session_db,
+            select(Entity.current_balance, Entity.credit_limit).where(
+                Entity.entity_id == customer_id,
+                Entity.entity_type == 'customer',
+                Entity.archived == False)
+        )).first()
+        if customer is None:
+            raise ValueError('العميل غير موجود')
+
+    levels = {}
+    for row in session_db.execute(for_update(session_db,
+        select(InventoryLevel.inventory_id, InventoryLevel.product_id, InventoryLevel.quantity_on_hand)
+        .where(InventoryLevel.warehouse_id == warehouse_id,
+               InventoryLevel.product_id.in_(product_ids),
+               InventoryLevel.archived == False)
+        .order_by(InventoryLevel.inventory_id)
+    )):
+        levels.setdefault(row.product_id, row)
+
+    now = get_current_utc_time()
+    sold_at = _parse_client_timestamp(sale_data.get('sold_at')) or now
+    basket = tax_engine.price_basket(
+        [(product_id, quantity, products[product_id].unit_price) for product_id, quantity in lines.items()]
+    )
+    subtotal, tax_amount, total_amount = basket['subtotal'], basket['tax_amount'], basket['total_amount']
+    amount_paid = round(float(sale_data.get('amount_paid') or 0), 2)
+    if payment_type != 'credit' and not amount_paid:
+        amount_paid = total_amount
+    if amount_paid >= total_amount:
+        payment_status = 'paid'
+    elif amount_paid > 0:
+        payment_status = 'partial'
+    else:
+        payment_status = 'unpaid'
+    balance_due = round(max(total_amount - amount_paid, 0), 2) if customer else 0
+    if balance_due and customer.credit_limit and \
+            balance_due - float(customer.current_balance or 0) > customer.credit_limit:
+        raise ValueError('المبلغ يتجاوز حد الائتمان المسموح للعميل')
+    invoice_number = (sale_data.get('invoice_number') or '').strip() or None
+
+    transaction_id = session_db.execute(
+        insert(FinancialTransaction.__table__).values(
+            transaction_code=invoice_number,
+            transaction_type='sale',
+            entity_id=customer_id,
+            transaction_date=sold_at,
+            reference_number=invoice_number,
+            subtotal=subtotal,
+            tax_amount=tax_amount,
+            total_amount=total_amount,
+            amount_paid=amount_paid,
+            payment_status=payment_status,
+            status='posted',
+            notes=payment_type,
+            created_by=created_by,
+            created_at=now,
+            archived=False,
+            version=1
+        )
+    ).inserted_primary_key[0]
+
+    detail_rows, movement_rows, level_updates, level_inserts, stock_updates = [], [], [], [], []
+    for line in basket['lines']:
+        product_id, quantity, unit_price = line['product_id'], line['quantity'], line['unit_price']
+        level = levels.get(product_id)
+        quantity_before = float(level.quantity_on_hand or 0) if level else 0.0
+        detail_rows.append({
+            'transaction_id': transaction_id,
+            'product_id': product_id,
+            'item_description': products[product_id].product_name,
+            'quantity': quantity,
+            'unit_price': unit_price,
+            'tax_amount': line['tax_amount'],
+            'created_at': now,
+            'archived': False
+        })
+        movement_rows.append({
+            'product_id': product_id,
+            'warehouse_id': warehouse_id,
+            'movement_type': 'sale',
+            'transaction_id': transaction_id,
+            'movement_date': sold_at,
+            'quantity_before': quantity_before,
+            'quantity_change': -quantity,
+            'quantity_after': quantity_before - quantity,
+            'quantity': quantity,
+            'unit_price': unit_price,
+            'total_cost': line['net_amount'],
+            'reference': invoice_number,
+            'created_by': created_by,
+            'created_at': now,
+            'archived': False,
+            'customer_id': customer_id
+        })
+        if level:
+            level_updates.append({'b_inventory_id': level.inventory_id, 'b_quantity': quantity,
+                                  'b_transaction_id': transaction_id})
+        else:
+            level_inserts.append({
+                'product_id': product_id,
+                'warehouse_id': warehouse_id,
+                'quantity_on_hand': -quantity,
+                'last_transaction_id': transaction_id,
+                'created_at': now,
+                'archived': False
+            })
+        stock_updates.append({'b_product_id': product_id, 'b_quantity': quantity})
+
+    session_db.execute(insert(TransactionDetail.__table__), detail_rows)
+    session_db.execute(insert(InventoryMovement.__table__), movement_rows)
+    if level_updates:
+        levels_table = InventoryLevel.__table__
+        session_db.execute(
+            update(levels_table)
+            .where(levels_table.c.inventory_id == bindparam('b_inventory_id'))
+            .values(quantity_on_hand=levels_table.c.quantity_on_hand - bindparam('b_quantity'),
+                    last_transaction_id=bindparam('b_transaction_id')),
+            level_updates
+        )
+    if level_inserts:
+        session_db.execute(insert(InventoryLevel.__table__), level_inserts)
+    products_table = Product.__table__
+    session_db.execute(
+        update(products_table)
+        .where(products_table.c.product_id == bindparam('b_product_id'))
+        .values(stock_qty=func.coalesce(products_table.c.stock_qty, 0) - bindparam('b_quantity')),
+        stock_updates
+    )
+    if balance_due:
+        session_db.execute(
+            update(Entity.__table__)
+            .where(Entity.__table__.c.entity_id == customer_id)
+            .values(current_balance=func.coalesce(Entity.__table__.c.current_balance, 0) - balance_due,
+                    updated_at=now)
+        )
+    mark_dashboard_dirty(session_db)
+    record_sale_rankings(session_db, transaction_id, day_key(sold_at),
+                         {row['product_id']: row['quantity'] for row in movement_rows}, customer_id, total_amount)
+    queue_stock_events(session_db, {row['product_id']: row['quantity_after'] for row in movement_rows})
+    if _summary_day(sold_at) == _summary_day(now):
+        queue_event(session_db, 'dashboard', {'delta': {'total_sales_today': total_amount}})
+    record_daily_summary(session_db, [{
+        'summary_day': _summary_day(sold_at),
+        'transaction_type': 'sale',
+        'transaction_count': 1,
+        'total_amount': total_amount,
+        'tax_amount': tax_amount
+    }])
+
+    return {
+        'transaction_id': transaction_id,
+        'invoice_number': invoice_number,
+        'transaction_date': sold_at,
+        'warehouse_id': warehouse_id,
+        'customer_id': customer_id,
+        'subtotal': subtotal,
+        'tax_amount': tax_amount,
+        'total_amount': total_amount,
+        'amount_paid': amount_paid,
+        'lines': [
+            {'product_id': row['product_id'], 'quantity': row['quantity'], 'unit_price': row['unit_price'],
+             'quantity_after': row['quantity_after']}
+            for row in movement_rows
+        ]
+    }
+
+@barcode_sales_bp.route('/create-sale', methods=['POST'])
+@role_required(['admin', 'manager', 'user'])
+def create_sale():
+    """ترحيل فاتورة البيع من شاشة الباركود"""
+    try:
+        data = request.get_json() or {}
+        validate_pos_csrf(data)
+
+        receipt_phone = (data.get('receipt_phone') or '').strip()
+
+        def send_receipt(session_db, posted):
+            if receipt_phone:
+                sale = session_db.get(FinancialTransaction, posted['transaction_id'])
+                enqueue_receipt_message(session_db, sale, receipt_phone)
+
+        key = str(data.get('idempotency_key') or '').strip()[:64]
+        if key:
+            # إعادة الطلب بنفس المفتاح (بعد انقطاع الرد) تعيد نتيجة الترحيل الأول
+            outcome = post_sale_once(data, key, get_terminal_id(), session.get('user_id'),
+                                     after_post=send_receipt, remember_rejection=False)
+            if outcome['status'] == 'rejected':
+                raise ValueError(outcome['message'])
+            with db_session() as session_db:
+                sale = session_db.get(FinancialTransaction, outcome['sale_id'])
+                posted = {'transaction_id': sale.transaction_id, 'invoice_number': sale.transaction_code,
+                          'total_amount': sale.total_amount}
+        else:
+            with db_session() as session_db:
+                posted = post_sale(session_db, data, session.get('user_id'))
+                send_receipt(session_db, posted)
+
+        if receipt_phone:
+            outbox_dispatcher.notify()
+        app.logger.info(f"تم ترحيل فاتورة البيع {posted['invoice_number']} (ID: {posted['transaction_id']})")
+        return jsonify({
+            'success': True,
+            'message': 'تم ترحيل الفاتورة بنجاح',
+            'sale_id': posted['transaction_id'],
+            'invoice_number': posted['invoice_number'],
+            'total_amount': posted['total_amount']
+        })
+    except (CSRFError, ValidationError):
+        return jsonify({
+            'success': False,
+            'message': 'رمز CSRF غير صالح'
+        }), 400
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        app.logger.error(f"خطأ في ترحيل فاتورة البيع: {e}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'message': 'حدث خطأ أثناء الترحيل'
+        }), 500
+
+# ======== مزامنة فواتير نقاط البيع غير المتصلة ========
+def _previous_outcome(key):
+    keys_table = PosIdempotencyKey.__table__
+    with db_session() as session_db:
+        row = session_db.execute(
+            select(keys_table.c.transaction_id, keys_table.c.status, keys_table.c.message)
+            .where(keys_table.c.idempotency_key == key)
+        ).first()
+    if not row:
+        return None
+    return {'idempotency_key': key, 'status': row.status, 'sale_id': row.transaction_id,
+            'message': row.message, 'duplicate': True}
+
+def post_sale_once(sale, key, terminal_id, user_id, after_post=None, remember_rejection=True):
+    """ترحيل فاتورة مرة واحدة لكل مفتاح عدم تكرار، في معاملة مستقلة عن بقية الفواتير
+
+    المفتاح يُدرج في معاملة الفاتورة نفسها، فالإعادة المتزامنة لنفس المفتاح تفشل بتعارض المفتاح
+    وتُلغى فاتورتها وتعيد نتيجة الترحيل الأول.
+    """
+    keys_table = PosIdempotencyKey.__table__
+    previous = _previous_outcome(key)
+    if previous:
+        return previous
+    try:
+        with db_session() as session_db:
+            posted = post_sale(session_db, sale, user_id)
+            if after_post:
+                after_post(session_db, posted)
+            session_db.execute(insert(keys_table).values(
+                idempotency_key=key, terminal_id=terminal_id, status='posted',
+                transaction_id=posted['transaction_id'], created_at=get_current_utc_time()
+            ))
+        return {'idempotency_key': key, 'status': 'posted', 'sale_id': posted['transaction_id'],
+                'message': None, 'duplicate': False}
+    except ValueError as e:
+        outcome = {'idempotency_key': key, 'status': 'rejected', 'sale_id': None,
+                   'message': str(e)[:255], 'duplicate': False}
+        if remember_rejection:
+            try:
+                with db_session() as session_db:
+                    session_db.execute(insert(keys_table).values(
+                        idempotency_key=key, terminal_id=terminal_id, status='rejected',
+                        message=outcome['message'], created_at=get_current_utc_time()
+                    ))
+            except IntegrityError:
+                return _previous_outcome(key) or outcome
+        return outcome
+    except IntegrityError:
+        previous = _previous_outcome(key)
+        if previous:
+            return previous
+        raise
+
+@barcode_sales_bp.route('/sync-sales', methods=['POST'])
+@role_required(['admin', 'manager', 'user'])
+def sync_sales():
+    """ترحيل دفعة من الفواتير المخزنة على الجهاز دون تكرار؛ كل فاتورة تُحفظ أو تُرفض وحدها"""
+    try:
+        data = request.get_json() or {}
+        validate_pos_csrf(data)
+        sales = data.get('sales')
+        if not isinstance(sales, list) or not sales:
+            return jsonify({'success': False, 'message': 'لا توجد فواتير للمزامنة'}), 400
+        if len(sales) > app.config['POS_SYNC_MAX_BATCH']:
+            return jsonify({
+                'success': False,
+                'message': f"الحد الأقصى {app.config['POS_SYNC_MAX_BATCH']} فاتورة في الطلب الواحد"
+            }), 400
+
+        keys = []
+        for sale in sales:
+            key = str(sale.get('idempotency_key') or '').strip()[:64] if isinstance(sale, dict) else ''
+            if not key:
+                return jsonify({'success': False, 'message': 'مفتاح عدم التكرار مطلوب لكل فاتورة'}), 400
+            keys.append(key)
+
+        terminal_id = get_terminal_id()
+        results = []
+        for key, sale in zip(keys, sales):
+            try:
+                results.append(post_sale_once(sale, key, terminal_id, session.get('user_id')))
+            except Exception as e:
+                app.logger.error(f"خطأ في مزامنة الفاتورة {key}: {e}", exc_info=True)
+                results.append({'idempotency_key': key, 'status': 'error', 'sale_id': None,
+                                'message': 'حدث خطأ أثناء ترحيل الفاتورة', 'duplicate': False})
+
+        posted_count = sum(1 for r in results if r['status'] == 'posted' and not r['duplicate'])
+        app.logger.info(f"مزامنة الجهاز {terminal_id}: {posted_count} فاتورة جديدة من أصل {len(sales)}")
+        return jsonify({
+            'success': True,
+            'results': results
+        })
+    except (CSRFError, ValidationError):
+        return jsonify({
+            'success': False,
+            'message': 'رمز CSRF غير صالح'
+        }), 400
+    except Exception as e:
+        app.logger.error(f"خطأ في مزامنة فواتير نقطة البيع: {e}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'message': 'حدث خطأ أثناء المزامنة'
+        }), 500
+
+# ======== المرتجعات والتالف من شاشة نقاط البيع ========
+def _parse_adjustment_lines(data):
+    """أسطر المرتجع أو التالف: قائمة items أو سطر واحد في جسم الطلب"""
+    items = data.get('items')
+    if items is None:
+        items = [data]
+    if not isinstance(items, list) or not items:
+        raise ValueError('يرجى إدخال منتج واحد على الأقل')
+    if len(items) > app.config['POS_ADJUSTMENT_MAX_LINES']:
+        raise ValueError(f"الحد الأقصى {app.config['POS_ADJUSTMENT_MAX_LINES']} سطر في الطلب الواحد")
+    lines = []
+    for item in items:
+        try:
+            code = str(item.get('barcode') or '').strip()
+            quantity = float(item.get('quantity'))
+        except (AttributeError, TypeError, ValueError):
+            raise ValueError('بيانات أحد الأسطر غير صالحة')
+        if not code:
+            raise ValueError('الباركود مطلوب لكل سطر')
+        if quantity <= 0:
+            raise ValueError('الكمية يجب أن تكون أكبر من صفر')
+        lines.append(dict(item, barcode=code, quantity=quantity))
+    return lines
+
+def _resolve_product_codes(session_db, codes):
+    """تحويل الباركودات وأكواد المنتجات إلى أرقام المنتجات باستعلام واحد"""
+    codes = set(codes)
+    resolved = {}
+    for row in session_db.execute(
+        select(Product.product_id, Product.product_code, Product.barcode)
+        .where(or_(Product.barcode.in_(codes), Product.product_code.in_(codes)))
+    ):
+        if row.product_code in codes:
+            resolved[row.product_code] = row.product_id
+        if row.barcode in codes:
+            resolved[row.barcode] = row.product_id
+    missing = sorted(codes - set(resolved))
+    if missing:
+        raise ValueError(f'منتجات غير موجودة: {", ".join(missing)}')
+    return resolved
+
+def post_stock_adjustments(session_db, movement_type, lines, warehouse_id, created_by):
+    """ترحيل حركات مخزنية (مرتجع/تالف) وتعديل الأرصدة بإدخالات وتحديثات مجمّعة
+
+    lines: قوائم تحتوي product_id وquantity وunit_price وtransaction_id وreference وnotes
+    """
+    direction = MOVEMENT_TYPES[movement_type]['direction']
+    totals = OrderedDict()
+    for line in lines:
+        totals[line['product_id']] = totals.get(line['product_id'], 0.0) + line['quantity']
+
+    levels = {}
+    for row in session_db.execute(for_update(session_db,
+        select(InventoryLevel.inventory_id, InventoryLevel.product_id, InventoryLevel.quantity_on_hand)
+        .where(InventoryLevel.warehouse_id == warehouse_id,
+               InventoryLevel.product_id.in_(list(totals)),
+               InventoryLevel.archived == False)
+        .order_by(InventoryLevel.inventory_id)
+    )):
+        levels.setdefault(row.product_id, row)
+
+    now = get_current_utc_time()
+    running = {pid: float(level.quantity_on_hand or 0) for pid, level in levels.items()}
+    movement_rows = []
+    for line in lines:
+        product_id, quantity = line['product_id'], line['quantity']
+        quantity_before = running.get(product_id, 0.0)
+        running[product_id] = quantity_before + direction * quantity
+        unit_price = float(line.get('unit_price') or 0)
+        movement_rows.append({
+            'product_id': product_id,
+            'warehouse_id': warehouse_id,
+            'movement_type': movement_type,
+            'transaction_id': line.get('transaction_id'),
+            'movement_date': now,
+            'quantity_before': quantity_before,
+            'quantity_change': direction * quantity,
+            'quantity_after': running[product_id],
+            'quantity': quantity,
+            'unit_price': unit_price,
+            'total_cost': round(quantity * unit_price, 2),
+            'reference': line.get('reference'),
+            'notes': line.get('notes'),
+            'created_by': created_by,
+            'created_at': now,
+            'archived': False,
+            'customer_id': line.get('customer_id')
+        })
+    session_db.execute(insert(InventoryMovement.__table__), movement_rows)
+
+    level_updates = [{'b_inventory_id': levels[pid].inventory_id, 'b_change': direction * qty}
+                     for pid, qty in totals.items() if pid in levels]
+    level_inserts = [{'product_id': pid, 'warehouse_id': warehouse_id, 'quantity_on_hand': direction * qty,
+                      'created_at': now, 'archived': False}
+                     for pid, qty in totals.items() if pid not in levels]
+    if level_updates:
+        levels_table = InventoryLevel.__table__
+        session_db.execute(
+            update(levels_table)
+            .where(levels_table.c.inventory_id == bindparam('b_inventory_id'))
+            .values(quantity_on_hand=levels_table.c.quantity_on_hand + bindparam('b_change')),
+            level_updates
+        )
+    if level_inserts:
+        session_db.execute(insert(InventoryLevel.__table__), level_inserts)
+    products_table = Product.__table__
+    session_db.execute(
+        update(products_table)
+        .where(products_table.c.product_id == bindparam('b_product_id'))
+        .values(stock_qty=func.coalesce(products_table.c.stock_qty, 0) + bindparam('b_change')),
+        [{'b_product_id': pid, 'b_change': direction * qty} for pid, qty in totals.items()]
+    )
+    mark_dashboard_dirty(session_db)
+    queue_stock_events(session_db, {pid: running[pid] for pid in totals})
+    if movement_type in SUMMARY_MOVEMENT_TYPES:
+        queue_event(session_db, 'dashboard', {'delta': {'damaged_returned': len(movement_rows)}})
+        record_daily_summary(session_db, [{
+            'summary_day': _summary_day(now),
+            'transaction_type': movement_type,
+            'transaction_count': len(movement_rows),
+            'total_amount': round(sum(row['total_cost'] for row in movement_rows), 2),
+            'tax_amount': 0
+        }])
+    return movement_rows
+
+def post_return(session_db, lines, default_warehouse_id, created_by):
+    """ترحيل أسطر مرتجع من فاتورة بيع أو أكثر وإرجاع مبلغ الاسترداد المحسوب
+
+    lines: أسطر _parse_adjustment_lines مع invoice_number وreason. تعود الكمية إلى المستودع
+    الذي خرجت منه في حركة البيع الأصلية، وdefault_warehouse_id للفواتير القديمة بلا حركة بيع.
+    مبلغ الاسترداد للعرض فقط: لا يُسجل قيد مالي ولا يُخصم من مبيعات اليوم أو رصيد العميل.
+    """
+    product_ids = _resolve_product_codes(session_db, [line['barcode'] for line in lines])
+    invoices = {line['invoice_number'] for line in lines}
+
+    if session_db.get_bind().dialect.name != 'sqlite':
+        # قفل رؤوس الفواتير أولاً: مرتجعان متزامنان لنفس الفاتورة لا يتجاوزان الكمية المباعة
+        session_db.execute(
+            select(FinancialTransaction.transaction_id)
+            .where(FinancialTransaction.transaction_code.in_(invoices),
+                   FinancialTransaction.transaction_type == 'sale')
+            .order_by(FinancialTransaction.transaction_id)
+            .with_for_update()
+        ).all()
+
+    # سطور الفواتير المطلوبة عبر فهرس (transaction_code) ثم (transaction_id, product_id)
+    sold = {}
+    for row in session_db.execute(
+        select(FinancialTransaction.transaction_id, FinancialTransaction.transaction_code,
+               FinancialTransaction.entity_id, TransactionDetail.product_id,
+               func.sum(TransactionDetail.quantity).label('quantity'),
+               func.max(TransactionDetail.unit_price).label('unit_price'),
+               func.sum(TransactionDetail.tax_amount).label('tax_amount'))
+        .join(TransactionDetail, TransactionDetail.transaction_id == FinancialTransaction.transaction_id)
+        .where(FinancialTransaction.transaction_code.in_(invoices),
+               FinancialTransaction.transaction_type == 'sale',
+               FinancialTransaction.archived == False,
+               TransactionDetail.product_id.in_(set(product_ids.values())),
+               TransactionDetail.archived == False)
+        .group_by(FinancialTransaction.transaction_id, FinancialTransaction.transaction_code,
+                  FinancialTransaction.entity_id, TransactionDetail.product_id)
+    ):
+        sold[(row.transaction_code, row.product_id)] = row
+
+    # الكميات المرتجعة سابقاً ومستودع البيع الأصلي لكل (فاتورة، منتج) في استعلام واحد
+    returned, sold_from = {}, {}
+    sale_ids = {row.transaction_id for row in sold.values()}
+    if sale_ids:
+        for row in session_db.execute(
+            select(InventoryMovement.transaction_id, InventoryMovement.product_id,
+                   InventoryMovement.movement_type,
+                   func.max(InventoryMovement.warehouse_id).label('warehouse_id'),
+                   func.sum(InventoryMovement.quantity).label('quantity'))
+            .where(InventoryMovement.transaction_id.in_(sale_ids),
+                   InventoryMovement.movement_type.in_(('sale', 'return')),
+                   InventoryMovement.archived == False)
+            .group_by(InventoryMovement.transaction_id, InventoryMovement.product_id,
+                      InventoryMovement.movement_type)
+        ):
+            key = (row.transaction_id, row.product_id)
+            if row.movement_type == 'sale':
+                sold_from[key] = row.warehouse_id
+            else:
+                returned[key] = float(row.quantity or 0)
+
+    adjustments, refund_amount = OrderedDict(), 0.0
+    fallback_warehouse_id = None
+    for line in lines:
+        product_id = product_ids[line['barcode']]
+        detail = sold.get((line['invoice_number'], product_id))
+        if detail is None:
+            raise ValueError(f"المنتج {line['barcode']} غير موجود في الفاتورة {line['invoice_number']}")
+        key = (detail.transaction_id, product_id)
+        available = float(detail.quantity or 0) - returned.get(key, 0.0)
+        if line['quantity'] > available:
+            raise ValueError(
+                f"الكمية المرتجعة للمنتج {line['barcode']} تتجاوز المتبقي في الفاتورة ({available:g})"
+            )
+        returned[key] = returned.get(key, 0.0) + line['quantity']
+        unit_tax = float(detail.tax_amount or 0) / float(detail.quantity) if detail.quantity else 0.0
+        refund_amount += line['quantity'] * (float(detail.unit_price or 0) + unit_tax)
+        warehouse_id = sold_from.get(key)
+        if warehouse_id is None:
+            # فواتير قديمة بلا حركة بيع مسجلة
+            if fallback_warehouse_id is None:
+                fallback_warehouse_id = _parse_optional_id(
+                    default_warehouse_id, 'رقم المستودع غير صالح'
+                ) or get_default_warehouse_id(session_db)
+            warehouse_id = fallback_warehouse_id
+        adjustments.setdefault(warehouse_id, []).append({
+            'product_id': product_id,
+            'quantity': line['quantity'],
+            'unit_price': detail.unit_price,
+            'transaction_id': detail.transaction_id,
+            'customer_id': detail.entity_id,
+            'reference': line['invoice_number'],
+            'notes': line['reason']
+        })
+
+    for warehouse_id, warehouse_lines in adjustments.items():
+        post_stock_adjustments(session_db, 'return', warehouse_lines, warehouse_id, created_by)
+    return round(refund_amount, 2)
+
+@barcode_sales_bp.route('/return-item', methods=['POST'])
+@role_required(['admin', 'manager', 'user'])
+def return_item():
+    """إرجاع منتج أو أكثر من فاتورة بيع أو عدة فواتير في معاملة واحدة"""
+    try:
+        data = request.get_json() or {}
+        validate_pos_csrf(data)
+        lines = _parse_adjustment_lines(data)
+        for line in lines:
+            line['invoice_number'] = str(line.get('invoice_number') or data.get('invoice_number') or '').strip()
+            if not line['invoice_number']:
+                raise ValueError('رقم الفاتورة مطلوب لكل سطر')
+            line['reason'] = line.get('reason') or data.get('reason')
+
+        with db_session() as session_db:
+            refund_amount = post_return(session_db, lines, data.get('warehouse_id'), session.get('user_id'))
+
+        app.logger.info(f"تم تسجيل مرتجع {len(lines)} سطر من {len({line['invoice_number'] for line in lines})} فاتورة")
+        return jsonify({
+            'success': True,
+            'message': 'تم معالجة الإرجاع بنجاح',
+            'lines': len(lines),
+            'refund_amount': refund_amount
+        })
+    except (CSRFError, ValidationError):
+        return jsonify({
+            'success': False,
+            'message': 'رمز CSRF غير صالح'
+        }), 400
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        app.logger.error(f"خطأ في معالجة المرتجع: {e}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'message': 'حدث خطأ أثناء معالجة الإرجاع'
+        }), 500
+
+@barcode_sales_bp.route('/record-damaged', methods=['POST'])
+@role_required(['admin', 'manager', 'user'])
+def record_damaged():
+    """تسجيل منتجات تالفة (سطر واحد أو رف كامل) في معاملة واحدة"""
+    try:
+        data = request.get_json() or {}
+        validate_pos_csrf(data)
+        lines = _parse_adjustment_lines(data)
+
+        with db_session() as session_db:
+            product_ids = _resolve_product_codes(session_db, [line['barcode'] for line in lines])
+            costs = dict(session_db.execute(
+                select(Product.product_id, Product.purchase_price)
+                .where(Product.product_id.in_(set(product_ids.values())))
+            ).all())
+            adjustments = []
+            for line in lines:
+                product_id = product_ids[line['barcode']]
+                reason = line.get('reason') or data.get('reason')
+                notes = line.get('notes') or data.get('notes')
+                adjustments.append({
+                    'product_id': product_id,
+                    'quantity': line['quantity'],
+                    'unit_price': costs.get(product_id),
+                    'reference': reason,
+                    'notes': notes
+                })
+            warehouse_id = data.get('warehouse_id') or get_default_warehouse_id(session_db)
+            post_stock_adjustments(session_db, 'damage', adjustments, warehouse_id, session.get('user_id'))
+
+        app.logger.info(f"تم تسجيل {len(adjustments)} سطر تالف")
+        return jsonify({
+            'success': True,
+            'message': 'تم تسجيل المنتج التالف بنجاح',
+            'lines': len(adjustments)
+        })
+    except (CSRFError, ValidationError):
+        return jsonify({
+            'success': False,
+            'message': 'رمز CSRF غير صالح'
+        }), 400
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        app.logger.error(f"خطأ في تسجيل المنتجات التالفة: {e}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'message': 'حدث خطأ أثناء التسجيل'
+        }), 500
+
+# ======== ملخص المبيعات اليومي ========
+def upsert_insert(session_db, table):
+    """جملة إدخال تدعم on_conflict_do_update حسب نوع قاعدة البيانات (SQLite أو PostgreSQL)"""
+    if session_db.get_bind().dialect.name == 'postgresql':
+        return postgresql_insert(table)
+    return sqlite_insert(table)
+
+def _summary_day(timestamp):
+    """يوم التجميع من طابع زمني ISO بتوقيت UTC"""
+    return str(timestamp)[:10]
+
+def record_daily_summary(session_db, rows):
+    """إضافة حركات مرحّلة إلى ملخص اليوم داخل معاملة الترحيل نفسها
+
+    rows: قوائم تحتوي summary_day وtransaction_type وtransaction_count وtotal_amount وtax_amount
+    """
+    summary_table = DailySalesSummary.__table__
+    now = get_current_utc_time()
+    stmt = upsert_insert(session_db, summary_table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['summary_day', 'branch_code', 'transaction_type'],
+        set_={
+            'transaction_count': summary_table.c.transaction_count + stmt.excluded.transaction_count,
+            'total_amount': summary_table.c.total_amount + stmt.excluded.total_amount,
+            'tax_amount': summary_table.c.tax_amount + stmt.excluded.tax_amount,
+            'updated_at': stmt.excluded.updated_at
+        }
+    )
+    branch_code = app.config['POS_BRANCH_CODE']
+    session_db.execute(stmt, [dict(row, branch_code=branch_code, updated_at=now) for row in rows])
+
+def rebuild_daily_summary(session_db, since=None):
+    """إعادة احتساب الملخص اليومي من الفواتير والحركات (للتعبئة الأولية أو التصحيح)"""
+    summary_table = DailySalesSummary.__table__
+    delete_stmt = summary_table.delete()
+    if since:
+        delete_stmt = delete_stmt.where(summary_table.c.summary_day >= since)
+    session_db.execute(delete_stmt)
+
+    ft_day = func.substr(FinancialTransaction.transaction_date, 1, 10)
+    query = select(
+        ft_day.label('summary_day'),
+        FinancialTransaction.transaction_type,
+        func.count().label('transaction_count'),
+        func.coalesce(func.sum(FinancialTransaction.total_amount), 0).label('total_amount'),
+        func.coalesce(func.sum(FinancialTransaction.tax_amount), 0).label('tax_amount')
+    ).where(FinancialTransaction.archived == False).group_by(ft_day, FinancialTransaction.transaction_type)
+    if since:
+        query = query.where(FinancialTransaction.transaction_date >= since)
+    rows = [dict(row._mapping) for row in session_db.execute(query)]
+
+    movement_day = func.substr(InventoryMovement.movement_date, 1, 10)
+    query = select(
+        movement_day.label('summary_day'),
+        InventoryMovement.movement_type.label('transaction_type'),
+        func.count().label('transaction_count'),
+        func.coalesce(func.sum(InventoryMovement.total_cost), 0).label('total_amount')
+    ).where(
+        InventoryMovement.movement_type.in_(SUMMARY_MOVEMENT_TYPES),
+        InventoryMovement.archived == False
+    ).group_by(movement_day, InventoryMovement.movement_type)
+    if since:
+        query = query.where(InventoryMovement.movement_date >= since)
+    rows.extend(dict(row._mapping, tax_amount=0) for row in session_db.execute(query))
+
+    rows = [row for row in rows if row['summary_day'] and row['transaction_type']]
+    if rows:
+        record_daily_summary(session_db, rows)
+    return len(rows)
+
+@app.cli.command('rebuild-sales-summary')
+@click.option('--since', default=None, help='إعادة الاحتساب من هذا اليوم (YYYY-MM-DD) فقط')
+def rebuild_sales_summary_command(since):
+    """إعادة بناء جدول ملخص المبيعات اليومي"""
+    with db_session() as session_db:
+        count = rebuild_daily_summary(session_db, since)
+    print(f"تم احتساب {count} صف في ملخص المبيعات اليومي")
+
+# ======== فهرس البحث عن العملاء ========
+ARABIC_DIACRITICS = re.compile(r'[\u0610-\u061A\u064B-\u065F\u0670\u06D6-\u06ED\u0640]')
+ARABIC_LETTER_MAP = str.maketrans({
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا',
+    'ى': 'ي', 'ئ': 'ي', 'ؤ': 'و', 'ة': 'ه'
+})
+ARABIC_DIGITS_MAP = str.maketrans('٠١٢٣٤٥٦٧٨٩۰۱۲۳۴۵۶۷۸۹', '01234567890123456789')
+
+def normalize_arabic_text(value):
+    """توحيد النص العربي للبحث: حذف التشكيل والتطويل وتوحيد الهمزات والتاء المربوطة"""
+    value = ARABIC_DIACRITICS.sub('', value or '')
+    return value.translate(ARABIC_LETTER_MAP).translate(ARABIC_DIGITS_MAP).lower().strip()
+
+def normalize_phone(value):
+    """توحيد رقم الهاتف: أرقام فقط دون مفتاح الدولة أو الصفر البادئ"""
+    digits = re.sub(r'\D', '', (value or '').translate(ARABIC_DIGITS_MAP))
+    if digits.startswith('00'):
+        digits = digits[2:]
+    country_code = app.config['PHONE_COUNTRY_CODE']
+    if country_code and digits.startswith(country_code) and len(digits) > len(country_code) + 6:
+        digits = digits[len(country_code):]
+    return digits.lstrip('0')
+
+def _prefix_upper_bound(prefix):
+    """أصغر نص أكبر من كل النصوص التي تبدأ بالبادئة: زيادة آخر حرف قابل للزيادة"""
+    while prefix and ord(prefix[-1]) >= sys.maxunicode:
+        prefix = prefix[:-1]
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1) if prefix else None
+
+def _prefix_range(column, prefix):
+    """شرط بادئة قابل لاستخدام الفهرس (بدلاً من LIKE) لا يعتمد على ترتيب الحروف الثنائي"""
+    upper = _prefix_upper_bound(prefix)
+    return column >= prefix if upper is None else and_(column >= prefix, column < upper)
+
+def index_entity_search_terms(session_db, entity_ids):
+    """إعادة بناء مصطلحات البحث (الأسماء والهواتف) لمجموعة من الجهات"""
+    entity_ids = list(entity_ids)
+    if not entity_ids:
+        return 0
+    terms_table = EntitySearchTerm.__table__
+    session_db.execute(terms_table.delete().where(terms_table.c.entity_id.in_(entity_ids)))
+
+    rows = set()
+    for entity in session_db.execute(
+        select(Entity.entity_id, Entity.legal_name, Entity.commercial_name)
+        .where(Entity.entity_id.in_(entity_ids), Entity.archived == False)
+    ):
+        for name in (entity.legal_name, entity.commercial_name):
+            for token in normalize_arabic_text(name).split():
+                rows.add((entity.entity_id, token[:255], 'name'))
+                if token.startswith('ال') and len(token) > 3:
+                    rows.add((entity.entity_id, token[2:257], 'name'))
+    for contact in session_db.execute(
+        select(EntityContact.entity_id, EntityContact.primary_phone, EntityContact.secondary_phone)
+        .where(EntityContact.entity_id.in_(entity_ids), EntityContact.archived == False)
+    ):
+        for phone in (contact.primary_phone, contact.secondary_phone):
+            phone = normalize_phone(phone)
+            if phone:
+                rows.add((contact.entity_id, phone, 'phone'))
+
+    if rows:
+        session_db.execute(insert(terms_table), [
+            {'entity_id': entity_id, 'term': term, 'term_type': term_type}
+            for entity_id, term, term_type in rows
+        ])
+    return len(rows)
+
+def search_customers(session_db, search_term, limit):
+    """أفضل العملاء المطابقين للهاتف أو لبدايات كلمات الاسم باستعلام مفهرس واحد"""
+    terms = EntitySearchTerm.__table__
+    compact = re.sub(r'[\s+\-()]', '', (search_term or '').translate(ARABIC_DIGITS_MAP))
+    if compact.isdigit():
+        phone = normalize_phone(compact)
+        if not phone:
+            return []
+        tokens = [phone]
+        conditions = [and_(terms.c.term_type == 'phone', _prefix_range(terms.c.term, phone))]
+    else:
+        tokens = list(dict.fromkeys(normalize_arabic_text(search_term).split()))[:5]
+        if not tokens:
+            return []
+        conditions = [and_(terms.c.term_type == 'name', _prefix_range(terms.c.term, token)) for token in tokens]
+
+    matched_token = case(*[(condition, index) for index, condition in enumerate(conditions)])
+    matches = select(terms.c.entity_id).where(or_(*conditions)).group_by(
+        terms.c.entity_id
+    ).having(func.count(func.distinct(matched_token)) == len(tokens)).subquery()
+
+    return session_db.query(
+        Entity.entity_id,
+        Entity.legal_name,
+        Entity.commercial_name,
+        Entity.current_balance,
+        Entity.credit_limit
+    ).join(matches, matches.c.entity_id == Entity.entity_id
+    ).filter(
+        Entity.archived == False,
+        Entity.entity_type == 'customer'
+    ).order_by(Entity.commercial_name, Entity.legal_name).limit(limit).all()
+
+@barcode_sales_bp.route('/search-customer', methods=['POST'])
+@role_required(['admin', 'manager', 'user'])
+def search_customer():
+    """البحث السريع عن العملاء بالهاتف أو الاسم في شاشة البيع"""
+    search_term = request.form.get('search_term', '').strip()
+    if not search_term:
+        return jsonify({'success': False, 'message': 'يرجى إدخال مصطلح البحث', 'results': []}), 400
+    try:
+        with db_session() as session_db:
+            customers = search_customers(session_db, search_term, app.config['CUSTOMER_SEARCH_LIMIT'])
+            results = [{
+                'id': c.entity_id,
+                'name': c.commercial_name or c.legal_name,
+                'balance': c.current_balance or 0,
+                'credit_limit': c.credit_limit or 0
+            } for c in customers]
+        return jsonify({
+            'success': True,
+            'results': results
+        })
+    except Exception as e:
+        app.logger.error(f"خطأ في البحث عن العملاء: {e}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'message': 'حدث خطأ أثناء البحث',
+            'results': []
+        }), 500
+
+@barcode_sales_bp.route('/add-customer', methods=['POST'])
+@role_required(['admin', 'manager', 'user'])
+def add_customer():
+    """إضافة عميل جديد من شاشة البيع وفهرسته للبحث"""
+    try:
+        data = request.get_json() or {}
+        validate_pos_csrf(data)
+        name = (data.get('name') or '').strip()
+        phone = (data.get('phone') or '').strip()
+        email = (data.get('email') or '').strip()
+        if not name or not phone:
+            return jsonify({'success': False, 'message': 'يرجى إدخال الاسم والهاتف'}), 400
+        try:
+            credit_limit = float(data.get('credit_limit') or 0)
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'message': 'حد الائتمان غير صالح'}), 400
+
+        with db_session() as session_db:
+            normalized_phone = normalize_phone(phone)
+            if normalized_phone and session_db.query(EntitySearchTerm.term_id).filter(
+                EntitySearchTerm.term_type == 'phone',
+                EntitySearchTerm.term == normalized_phone
+            ).first():
+                return jsonify({'success': False, 'message': 'رقم الهاتف مسجل مسبقاً'}), 400
+
+            entity_type = session_db.query(EntityType).filter(
+                or_(EntityType.type_class == 'customer', EntityType.type_name == 'customer'),
+                EntityType.archived == False
+            ).first()
+            if not entity_type:
+                entity_type = EntityType(type_name='customer', type_class='customer')
+                session_db.add(entity_type)
+                session_db.flush()
+
+            now = get_current_utc_time()
+            customer = Entity(
+                entity_type_id=entity_type.type_id,
+                entity_type='customer',
+                legal_name=name,
+                commercial_name=name,
+                credit_limit=credit_limit,
+                current_balance=0,
+                is_active=True,
+                created_at=now,
+                version=1
+            )
+            session_db.add(customer)
+            session_db.flush()
+            customer.entity_code = f"C{customer.entity_id:06d}"
+            session_db.add(EntityContact(
+                entity_id=customer.entity_id,
+                contact_name=name,
+                primary_phone=phone,
+                email=email or None,
+                is_primary=True,
+                created_at=now
+            ))
+            session_db.flush()
+            index_entity_search_terms(session_db, [customer.entity_id])
+            session_db.commit()
+
+            return jsonify({
+                'success': True,
+                'message': 'تم حفظ العميل بنجاح',
+                'customer': {'id': customer.entity_id, 'name': name}
+            })
+    except (CSRFError, ValidationError):
+        return jsonify({
+            'success': False,
+            'message': 'رمز CSRF غير صالح'
+        }), 400
+    except Exception as e:
+        app.logger.error(f"خطأ في إضافة العميل: {e}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'message': 'حدث خطأ أثناء حفظ العميل'
+        }), 500
+
+def rebuild_customer_search_index(batch_size=500):
+    """إعادة بناء مصطلحات البحث لجميع الجهات على دفعات"""
+    with db_session() as session_db:
+        entity_ids = [row[0] for row in session_db.execute(select(Entity.entity_id))]
+        total = 0
+        for start in range(0, len(entity_ids), batch_size):
+            total += index_entity_search_terms(session_db, entity_ids[start:start + batch_size])
+    return len(entity_ids), total
+
+def ensure_customer_search_index():
+    """فهرسة العملاء مرة واحدة عند الإقلاع إذا كان جدول مصطلحات البحث فارغاً (قواعد بيانات سابقة للفهرس)"""
+    with db.engine.connect() as conn:
+        if conn.execute(select(EntitySearchTerm.term_id).limit(1)).first() is not None:
+            return 0
+        if conn.execute(select(Entity.entity_id).limit(1)).first() is None:
+            return 0
+    entities, total = rebuild_customer_search_index()
+    app.logger.info(f"تمت فهرسة {entities} جهة للبحث عند الإقلاع ({total} مصطلح)")
+    return total
+
+@app.cli.command('rebuild-customer-index')
+def rebuild_customer_index_command():
+    """إعادة بناء فهرس البحث عن العملاء لجميع الجهات"""
+    entities, total = rebuild_customer_search_index()
+    print(f"تمت فهرسة {entities} جهة ({total} مصطلح بحث)")
+
+# ======== صندوق الرسائل الصادرة وعمال الإرسال ========
+class FileOutboxTransport:
+    """ناقل تجريبي يكتب الرسائل في ملف JSON Lines محلي"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def send(self, message):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(message, ensure_ascii=False) + '\n')
+
+class HttpOutboxTransport:
+    """ناقل يرسل الرسالة كـ JSON إلى بوابة HTTP (مزود واتساب أو جهاز Termux)"""
+
+    def __init__(self, url, timeout):
+        if not url:
+            raise ValueError('OUTBOX_HTTP_URL غير مضبوط')
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, message):
+        req = urllib.request.Request(
+            self.url,
+            data=json.dumps(message, ensure_ascii=False).encode('utf-8'),
+            headers={'Content-Type': 'application/json'},
+            method='POST'
+        )
+        with urllib.request.urlopen(req, timeout=self.timeout) as response:
+            if response.status >= 400:
+                raise RuntimeError(f'HTTP {response.status}')
+
+OUTBOX_TRANSPORTS = {
+    'file': lambda config: FileOutboxTransport(config['OUTBOX_FILE_PATH']),
+    'http': lambda config: HttpOutboxTransport(config['OUTBOX_HTTP_URL'], config['OUTBOX_HTTP_TIMEOUT'])
+}
+
+def enqueue_outbox_message(session_db, channel, recipient, payload, transaction_id=None):
+    """إضافة رسالة إلى الصندوق داخل معاملة المستدعي؛ الإرسال يتم لاحقاً في الخلفية"""
+    message = OutboxMessage(
+        channel=channel,
+        recipient=recipient,
+        payload=json.dumps(payload, ensure_ascii=False),
+        status='pending',
+        attempts=0,
+        next_attempt_at=int(time.time()),
+        transaction_id=transaction_id,
+        created_at=get_current_utc_time()
+    )
+    session_db.add(message)
+    return message
+
+class OutboxDispatcher:
+    """مجموعة عمال في الخلفية ترسل الرسائل المستحقة مع إعادة المحاولة والتأخير المتزايد"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._transport = None
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            self._transport = OUTBOX_TRANSPORTS[app.config['OUTBOX_TRANSPORT']](app.config)
+            for i in range(app.config['OUTBOX_WORKERS']):
+                thread = threading.Thread(target=self._run, name=f'outbox-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def notify(self):
+        """إيقاظ العمال فور إضافة رسائل جديدة"""
+        self.start()
+        self._wakeup.set()
+
+    def stop(self):
+        self._stopping.set()
+        self._wakeup.set()
+
+    def _claim(self):
+        """حجز رسالة مستحقة أو رسالة انتهت مهلة حجزها لدى عامل توقف (في هذه العملية أو غيرها)"""
+        table = OutboxMessage.__table__
+        now = int(time.time())
+        columns = (table.c.message_id, table.c.channel, table.c.recipient, table.c.payload,
+                   table.c.attempts, table.c.status, table.c.claimed_at)
+        due = table.c.status == 'pending', table.c.next_attempt_at <= now
+        expired = table.c.status == 'sending', or_(table.c.claimed_at.is_(None),
+                                                  table.c.claimed_at < now - app.config['OUTBOX_LEASE_SECONDS'])
+        with app.app_context(), db_session() as session_db:
+            row = session_db.execute(
+                select(*columns).where(*due).order_by(table.c.next_attempt_at).limit(1)
+            ).first() or session_db.execute(
+                select(*columns).where(*expired).order_by(table.c.claimed_at).limit(1)
+            ).first()
+            if not row:
+                return None
+            if row.status == 'sending':
+                app.logger.warning(f"استعادة الرسالة {row.message_id} بعد انتهاء مهلة حجزها")
+            # الشرط على الحالة ووقت الحجز السابق يضمن أن عاملاً واحداً فقط يفوز بالرسالة
+            claimed = session_db.execute(
+                update(table).where(table.c.message_id == row.message_id, table.c.status == row.status,
+                                    table.c.claimed_at.is_(None) if row.claimed_at is None
+                                    else table.c.claimed_at == row.claimed_at)
+                .values(status='sending', claimed_at=now, attempts=table.c.attempts + 1)
+                .returning(*columns)
+            ).first()
+        return claimed or False
+
+    def _finish(self, message, error=None):
+        table = OutboxMessage.__table__
+        attempts = message.attempts or 0
+        if error is None:
+            values = {'status': 'sent', 'sent_at': get_current_utc_time(), 'last_error': None}
+        elif attempts >= app.config['OUTBOX_MAX_ATTEMPTS']:
+            values = {'status': 'failed', 'last_error': str(error)[:1000]}
+        else:
+            delay = app.config['OUTBOX_RETRY_BASE_SECONDS'] * (2 ** (attempts - 1))
+            values = {'status': 'pending', 'next_attempt_at': int(time.time()) + delay,
+                      'last_error': str(error)[:1000]}
+        values['claimed_at'] = None
+        with app.app_context(), db_session() as session_db:
+            owned = session_db.execute(update(table).where(
+                table.c.message_id == message.message_id,
+                table.c.status == 'sending',
+                table.c.claimed_at == message.claimed_at
+            ).values(**values)).rowcount
+        if not owned:
+            app.logger.warning(f"انتهت مهلة حجز الرسالة {message.message_id} قبل تسجيل نتيجة إرسالها")
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                message = self._claim()
+                if message is None:
+                    self._wakeup.wait(app.config['OUTBOX_POLL_SECONDS'])
+                    self._wakeup.clear()
+                    continue
+                if message is False:
+                    continue
+                try:
+                    self._transport.send({
+                        'message_id': message.message_id,
+                        'channel': message.channel,
+                        'recipient': message.recipient,
+                        'payload': json.loads(message.payload or '{}')
+                    })
+                except Exception as e:
+                    app.logger.warning(f"فشل إرسال الرسالة {message.message_id}: {e}")
+                    self._finish(message, e)
+                else:
+                    self._finish(message)
+            except Exception as e:
+                app.logger.error(f"خطأ في عامل صندوق الرسائل: {e}", exc_info=True)
+                self._stopping.wait(app.config['OUTBOX_POLL_SECONDS'])
+
+outbox_dispatcher = OutboxDispatcher()
+atexit.register(outbox_dispatcher.stop)
+
+def find_sale(session_db, sale_ref):
+    """البحث عن فاتورة البيع برقمها الداخلي أو برقم الفاتورة"""
+    query = session_db.query(FinancialTransaction).filter(
+        FinancialTransaction.transaction_type == 'sale',
+        FinancialTransaction.archived == False
+    )
+    if str(sale_ref).isdigit():
+        sale = query.filter(FinancialTransaction.transaction_id == int(sale_ref)).first()
+        if sale:
+            return sale
+    return query.filter(FinancialTransaction.transaction_code == str(sale_ref)).order_by(
+        FinancialTransaction.transaction_id.desc()
+    ).first()
+
+def enqueue_receipt_message(session_db, sale, recipient):
+    """وضع إيصال الفاتورة في صندوق الرسائل لإرساله عبر واتساب"""
+    return enqueue_outbox_message(session_db, 'whatsapp', recipient, {
+        'type': 'receipt',
+        'transaction_id': sale.transaction_id,
+        'invoice_number': sale.transaction_code,
+        'total_amount': sale.total_amount,
+        'text': f"شكراً لتسوقكم. فاتورة رقم {sale.transaction_code} بمبلغ {sale.total_amount or 0:,.2f}"
+    }, transaction_id=sale.transaction_id)
+
+@barcode_sales_bp.route('/send-whatsapp/<sale_ref>', methods=['POST'])
+@role_required(['admin', 'manager', 'user'])
+def send_whatsapp(sale_ref):
+    """جدولة إرسال إيصال الفاتورة عبر واتساب دون انتظار مزود الرسائل"""
+    try:
+        data = request.get_json(silent=True) or {}
+        validate_pos_csrf(data)
+        with db_session() as session_db:
+            sale = find_sale(session_db, sale_ref)
+            if not sale:
+                return jsonify({'success': False, 'message': 'الفاتورة غير موجودة'}), 404
+
+            recipient = (data.get('phone') or '').strip()
+            if not recipient and sale.entity_id:
+                recipient = session_db.query(EntityContact.primary_phone).filter(
+                    EntityContact.entity_id == sale.entity_id,
+                    EntityContact.archived == False,
+                    EntityContact.primary_phone.isnot(None)
+                ).order_by(EntityContact.is_primary.desc()).limit(1).scalar() or ''
+            if not recipient:
+                return jsonify({'success': False, 'message': 'لا يوجد رقم هاتف لإرسال الفاتورة'}), 400
+
+            message = enqueue_receipt_message(session_db, sale, recipient)
+            session_db.commit()
+            message_id = message.message_id
+
+        outbox_dispatcher.notify()
+        return jsonify({
+            'success': True,
+            'message': 'تمت جدولة إرسال الفاتورة عبر واتساب',
+            'message_id': message_id
+        })
+    except (CSRFError, ValidationError):
+        return jsonify({
+            'success': False,
+            'message': 'رمز CSRF غير صالح'
+        }), 400
+    except Exception as e:
+        app.logger.error(f"خطأ في جدولة رسالة واتساب: {e}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'message': 'فشل الإرسال عبر واتساب'
+        }), 500
+
+@barcode_sales_bp.route('/outbox/<int:message_id>', methods=['GET'])
+@role_required(['admin', 'manager', 'user'])
+def outbox_message_status(message_id):
+    """حالة رسالة في صندوق الرسائل الصادرة"""
+    try:
+        with db_session() as session_db:
+            message = session_db.query(OutboxMessage).filter_by(message_id=message_id).first()
+            if not message:
+                return jsonify({'success': False, 'message': 'الرسالة غير موجودة'}), 404
+            return jsonify({
+                'success': True,
+                'data': {
+                    'message_id': message.message_id,
+                    'channel': message.channel,
+                    'status': message.status,
+                    'attempts': message.attempts,
+                    'last_error': message.last_error,
+                    'created_at': message.created_at,
+                    'sent_at': message.sent_at
+                }
+            })
+    except Exception as e:
+        app.logger.error(f"خطأ في جلب حالة الرسالة: {e}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'message': 'حدث خطأ أثناء جلب البيانات'
+        }), 500
+
+# ======== تنسيق الإيصالات وطباعتها ========
+RECEIPT_TEMPLATE = """<div class="receipt" dir="rtl">
+  <h3>{{ store_name }}</h3>
+  <div>فاتورة رقم: {{ sale.invoice_number or sale.transaction_id }}</div>
+  <div>التاريخ: {{ sale.transaction_date[:16].replace('T', ' ') }}</div>
+  {% if sale.customer_name %}<div>العميل: {{ sale.customer_name }}</div>{% endif %}
+  <table>
+    <tr><th>الصنف</th><th>الكمية</th><th>السعر</th><th>الإجمالي</th></tr>
+    {% for line in sale.lines %}
+    <tr>
+      <td>{{ line.name }}</td>
+      <td>{{ '%g' % line.quantity }}</td>
+      <td>{{ '%.2f' % line.unit_price }}</td>
+      <td>{{ '%.2f' % (line.quantity * line.unit_price) }}</td>
+    </tr>
+    {% endfor %}
+  </table>
+  <div>المجموع: {{ '%.2f' % sale.subtotal }}</div>
+  <div>الضريبة: {{ '%.2f' % sale.tax_amount }}</div>
+  <div><strong>الإجمالي: {{ '%.2f' % sale.total_amount }}</strong></div>
+  <div>المدفوع: {{ '%.2f' % sale.amount_paid }}</div>
+</div>"""
+
+RECEIPT_PAGE_BREAK = '<div style="page-break-after: always"></div>'
+
+class ReceiptRenderer:
+    """تنسيق الإيصالات من قالب مُجمّع مرة واحدة مع ذاكرة مؤقتة حسب رقم وإصدار الفاتورة"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._template = None
+
+    @property
+    def template(self):
+        if self._template is None:
+            self._template = app.jinja_env.from_string(RECEIPT_TEMPLATE)
+        return self._template
+
+    @staticmethod
+    def _fetch(session_db, *conditions):
+        """جلب الفواتير وأسطرها وأسماء المنتجات باستعلام مدمج واحد"""
+        rows = session_db.query(
+            FinancialTransaction.transaction_id,
+            FinancialTransaction.transaction_code,
+            FinancialTransaction.transaction_date,
+            FinancialTransaction.subtotal,
+            FinancialTransaction.tax_amount,
+            FinancialTransaction.total_amount,
+            FinancialTransaction.amount_paid,
+            FinancialTransaction.version,
+            Entity.commercial_name,
+            Entity.legal_name,
+            TransactionDetail.quantity,
+            TransactionDetail.unit_price,
+            TransactionDetail.item_description,
+            Product.product_name
+        ).outerjoin(Entity, Entity.entity_id == FinancialTransaction.entity_id
+        ).outerjoin(TransactionDetail, and_(
+            TransactionDetail.transaction_id == FinancialTransaction.transaction_id,
+            TransactionDetail.archived == False
+        )).outerjoin(Product, Product.product_id == TransactionDetail.product_id
+        ).filter(*conditions
+        ).order_by(FinancialTransaction.transaction_id, TransactionDetail.detail_id).all()
+
+        sales = OrderedDict()
+        for row in rows:
+            sale = sales.get(row.transaction_id)
+            if sale is None:
+                sale = sales[row.transaction_id] = {
+                    'transaction_id': row.transaction_id,
+                    'invoice_number': row.transaction_code,
+                    'transaction_date': row.transaction_date or '',
+                    'customer_name': row.commercial_name or row.legal_name,
+                    'subtotal': row.subtotal or 0,
+                    'tax_amount': row.tax_amount or 0,
+                    'total_amount': row.total_amount or 0,
+                    'amount_paid': row.amount_paid or 0,
+                    'version': row.version or 0,
+                    'lines': []
+                }
+            if row.quantity is not None:
+                sale['lines'].append({
+                    'name': row.product_name or row.item_description,
+                    'quantity': row.quantity or 0,
+                    'unit_price': row.unit_price or 0
+                })
+        return list(sales.values())
+
+    def _cached(self, key):
+        with self._lock:
+            html = self._cache.get(key)
+            if html is not None:
+                self._cache.move_to_end(key)
+            return html
+
+    def _render(self, sale):
+        key = (sale['transaction_id'], sale['version'])
+        html = self._cached(key)
+        if html is None:
+            html = self.template.render(sale=sale, store_name=app.config['POS_STORE_NAME'])
+            with self._lock:
+                self._cache[key] = html
+                while len(self._cache) > app.config['RECEIPT_CACHE_SIZE']:
+                    self._cache.popitem(last=False)
+        return html
+
+    def render(self, session_db, transaction_id):
+        """إيصال فاتورة واحدة؛ يُعاد التنسيق فقط عند تغير إصدار الفاتورة"""
+        version = session_db.query(FinancialTransaction.version).filter(
+            FinancialTransaction.transaction_id == transaction_id
+        ).scalar()
+        html = self._cached((transaction_id, version or 0))
+        if html is not None:
+            return html
+        sales = self._fetch(session_db, FinancialTransaction.transaction_id == transaction_id)
+        return self._render(sales[0]) if sales else None
+
+    def render_day(self, session_db, day):
+        """إيصالات جميع فواتير البيع في يوم واحد بتمريرة واحدة"""
+        sales = self._fetch(
+            session_db,
+            FinancialTransaction.transaction_type == 'sale',
+            FinancialTransaction.archived == False,
+            FinancialTransaction.transaction_date >= day.isoformat(),
+            FinancialTransaction.transaction_date < (day + timedelta(days=1)).isoformat()
+        )
+        return [self._render(sale) for sale in sales]
+
+receipt_renderer = ReceiptRenderer()
+
+@barcode_sales_bp.route('/print-receipt/<sale_ref>', methods=['POST'])
+@role_required(['admin', 'manager', 'user'])
+def print_receipt(sale_ref):
+    """إيصال الفاتورة المنسق للطباعة"""
+    try:
+        data = request.get_json(silent=True) or {}
+        validate_pos_csrf(data)
+        with db_session() as session_db:
+            if str(sale_ref).isdigit():
+                transaction_id = int(sale_ref)
+            else:
+                sale = find_sale(session_db, sale_ref)
+                transaction_id = sale.transaction_id if sale else None
+            receipt_html = receipt_renderer.render(session_db, transaction_id) if transaction_id else None
+        if not receipt_html:
+            return jsonify({'success': False, 'message': 'الفاتورة غير موجودة'}), 404
+        return jsonify({
+            'success': True,
+            'transaction_id': transaction_id,
+            'receipt_html': receipt_html
+        })
+    except (CSRFError, ValidationError):
+        return jsonify({
+            'success': False,
+            'message': 'رمز CSRF غير صالح'
+        }), 400
+    except Exception as e:
+        app.logger.error(f"خطأ في تجهيز الإيصال {sale_ref}: {e}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'message': 'حدث خطأ أثناء الطباعة'
+        }), 500
+
+@barcode_sales_bp.route('/receipts', methods=['GET'])
+@role_required(['admin', 'manager'])
+@db_route('read')
+def print_day_receipts():
+    """جميع إيصالات يوم معين في صفحة واحدة لإعادة الطباعة أو الأرشفة"""
+    try:
+        day_arg = request.args.get('date')
+        day = datetime.strptime(day_arg, '%Y-%m-%d').date() if day_arg else datetime.now(timezone.utc).date()
+    except ValueError:
+        return jsonify({'success': False, 'message': 'صيغة التاريخ غير صحيحة (YYYY-MM-DD)'}), 400
+    try:
+        with db_session() as session_db:
+            receipts = receipt_renderer.render_day(session_db, day)
+        body = RECEIPT_PAGE_BREAK.join(receipts) or '<p>لا توجد فواتير في هذا اليوم</p>'
+        return f'<!DOCTYPE html><html lang="ar" dir="rtl"><head><meta charset="utf-8">' \
+               f'<title>إيصالات {day.isoformat()}</title></head><body>{body}</body></html>'
+    except Exception as e:
+        app.logger.error(f"خطأ في تجهيز إيصالات اليوم: {e}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'message': 'حدث خطأ أثناء تجهيز الإيصالات'
+        }), 500
+
+# ======== مولد أرقام الفواتير بالحجز المسبق ========
+class InvoiceNumberAllocator:
+    """توزيع أرقام الفواتير على الأجهزة من كتل محجوزة مسبقاً لكل فرع ويوم"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._terminal_locks = {}
+        self._blocks = {}
+
+    @staticmethod
+    def make_prefix(branch_code, day):
+        return f"INV{branch_code}-{day:%y%m%d}"
+
+    def _reserve_block(self, prefix, size, terminal_id, day):
+        """حجز كتلة أرقام متتالية وتسجيلها كمحجوزة في معاملة واحدة"""
+        now = get_current_utc_time()
+        with app.app_context(), db_session() as session_db:
+            table = InvoiceSequence.__table__
+            stmt = upsert_insert(session_db, table).values(prefix=prefix, next_value=1 + size, updated_at=now)
+            next_value = session_db.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=['prefix'],
+                    set_={'next_value': table.c.next_value + size, 'updated_at': now}
+                ).returning(table.c.next_value)
+            ).scalar_one()
+            first, last = next_value - size, next_value - 1
+            block_id = session_db.execute(
+                insert(InvoiceNumberBlock.__table__).values(
+                    prefix=prefix, block_day=day_key(day), terminal_id=terminal_id,
+                    first_number=first, last_number=last, status='open', reserved_at=now
+                ).returning(InvoiceNumberBlock.__table__.c.block_id)
+            ).scalar_one()
+        return {'id': block_id, 'prefix': prefix, 'next': first, 'last': last}
+
+    def _close_block(self, block, reason):
+        """إغلاق الكتلة مع حفظ آخر رقم صُرف منها؛ المطابقة تتم لاحقاً في reconcile"""
+        try:
+            with app.app_context(), db_session() as session_db:
+                table = InvoiceNumberBlock.__table__
+                session_db.execute(
+                    update(table).where(table.c.block_id == block['id'], table.c.status == 'open').values(
+                        status='closed', close_reason=reason,
+                        issued_through=block['next'] - 1, closed_at=get_current_utc_time()
+                    )
+                )
+        except Exception as e:
+            app.logger.error(f"خطأ في إغلاق كتلة أرقام الفواتير: {e}", exc_info=True)
+
+    @staticmethod
+    def _unused_ranges(block, used):
+        """نطاقات الأرقام غير المستخدمة في الكتلة مع سبب كل نطاق"""
+        ranges = []
+        for number in range(block.first_number, block.last_number + 1):
+            if number in used:
+                continue
+            if block.status == 'open':
+                reason = 'not_closed'  # توقف الخادم قبل إغلاق الكتلة
+            elif block.issued_through is not None and number <= block.issued_through:
+                reason = 'issued_unused'  # صُرف للجهاز ولم تُرحّل به فاتورة
+            else:
+                reason = block.close_reason
+            if ranges and ranges[-1][1] == number - 1 and ranges[-1][2] == reason:
+                ranges[-1][1] = number
+            else:
+                ranges.append([number, number, reason])
+        return ranges
+
+    def reconcile(self):
+        """مطابقة الكتل المغلقة (بعد المهلة) وكتل الأيام السابقة مع الفواتير وتسجيل الأرقام غير المستخدمة"""
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=app.config['INVOICE_GAP_GRACE_SECONDS'])
+        reconciled = 0
+        with app.app_context(), db_session() as session_db:
+            blocks = session_db.query(InvoiceNumberBlock).filter(or_(
+                and_(InvoiceNumberBlock.status == 'closed', InvoiceNumberBlock.closed_at < cutoff.isoformat()),
+                and_(InvoiceNumberBlock.status == 'open', InvoiceNumberBlock.block_day < day_key(cutoff))
+            )).order_by(InvoiceNumberBlock.block_id).limit(500).all()
+            for block in blocks:
+                codes = session_db.execute(
+                    select(FinancialTransaction.transaction_code).where(FinancialTransaction.transaction_code.between(
+                        f"{block.prefix}-{block.first_number:05d}", f"{block.prefix}-{block.last_number:05d}"
+                    ))
+                ).scalars().all()
+                used = {int(code.rsplit('-', 1)[1]) for code in codes if code.rsplit('-', 1)[1].isdigit()}
+                for first, last, reason in self._unused_ranges(block, used):
+                    session_db.add(InvoiceNumberGap(
+                        prefix=block.prefix, terminal_id=block.terminal_id,
+                        first_number=first, last_number=last, reason=reason,
+                        reported_at=get_current_utc_time()
+                    ))
+                    app.logger.warning(
+                        f"أرقام فواتير غير مستخدمة {block.prefix}-{first:05d}..{last:05d} "
+                        f"للجهاز {block.terminal_id} ({reason})"
+                    )
+                block.status = 'reconciled'
+                reconciled += 1
+        return reconciled
+
+    def _terminal_lock(self, terminal_id):
+        with self._lock:
+            return self._terminal_locks.setdefault(terminal_id, threading.Lock())
+
+    def next_number(self, terminal_id, branch_code):
+        """إصدار الرقم التالي للجهاز، مع حجز كتلة جديدة عند نفاد الكتلة الحالية"""
+        today = datetime.now(timezone.utc).date()
+        prefix = self.make_prefix(branch_code, today)
+        with self._terminal_lock(terminal_id):
+            block = self._blocks.get(terminal_id)
+            if block and block['prefix'] != prefix:
+                same_day = block['prefix'].endswith(f"-{today:%y%m%d}")
+                self._close_block(block, 'branch_change' if same_day else 'day_rollover')
+                block = None
+            if block and block['next'] > block['last']:
+                self._close_block(block, 'block_exhausted')
+                block = None
+            if not block:
+                block = self._reserve_block(prefix, app.config['INVOICE_BLOCK_SIZE'], terminal_id, today)
+                self._blocks[terminal_id] = block
+            number = block['next']
+            block['next'] += 1
+        return f"{prefix}-{number:05d}"
+
+    def release_all(self, reason='shutdown'):
+        """إغلاق الكتل المفتوحة عند إيقاف الخادم؛ ما لم يُستخدم منها يُسجل عند المطابقة"""
+        for terminal_id, block in list(self._blocks.items()):
+            self._close_block(block, reason)
+        self._blocks.clear()
+
+invoice_number_allocator = InvoiceNumberAllocator()
+atexit.register(invoice_number_allocator.release_all)
+
+def get_terminal_id():
+    """معرف جهاز نقطة البيع من الترويسة أو من جلسة المتصفح"""
+    terminal_id = request.headers.get('X-Terminal-Id') or request.args.get('terminal_id')
+    if not terminal_id:
+        terminal_id = session.setdefault('terminal_id', secrets.token_hex(4))
+    return re.sub(r'[^A-Za-z0-9_-]', '', terminal_id)[:50]
+
+@barcode_sales_bp.route('/get-next-invoice-number', methods=['GET'])
+@role_required(['admin', 'manager', 'user'])
+def get_next_invoice_number():
+    """رقم الفاتورة التالي للجهاز الحالي"""
+    try:
+        branch_code = request.args.get('branch') or app.config['POS_BRANCH_CODE']
+        branch_code = re.sub(r'[^A-Za-z0-9]', '', branch_code)[:6]
+        number = invoice_number_allocator.next_number(get_terminal_id(), branch_code)
+        return jsonify({
+            'success': True,
+            'next_invoice_number': number
+        })
+    except Exception as e:
+        app.logger.error(f"خطأ في توليد رقم الفاتورة: {e}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'message': 'حدث خطأ أثناء توليد رقم الفاتورة'
+        }), 500
+
+@barcode_sales_bp.route('/invoice-number-gaps', methods=['GET'])
+@role_required(['admin', 'manager'])
+@db_route('read')
+def invoice_number_gaps():
+    """تقرير أرقام الفواتير المحجوزة التي لم تُستخدم"""
+    try:
+        with db_session() as session_db:
+            query = session_db.query(InvoiceNumberGap)
+            prefix = request.args.get('prefix', '').strip()
+            if prefix:
+                query = query.filter(InvoiceNumberGap.prefix == prefix)
+            gaps = query.order_by(InvoiceNumberGap.gap_id.desc()).limit(500).all()
+            return jsonify({
+                'success': True,
+                'data': [{
+                    'prefix': gap.prefix,
+                    'terminal_id': gap.terminal_id,
+                    'first_number': gap.first_number,
+                    'last_number': gap.last_number,
+                    'count': gap.last_number - gap.first_number + 1,
+                    'reason': gap.reason,
+                    'reported_at': gap.reported_at
+                } for gap in gaps]
+            })
+    except Exception as e:
+        app.logger.error(f"خطأ في جلب فجوات أرقام الفواتير: {e}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'message': 'حدث خطأ أثناء جلب التقرير'
+        }), 500
+
+app.register_blueprint(barcode_sales_bp)
+
+#@app.route('/users/')
+#def users_page():
+#    return render_template('users.html')
+
+# ======== أرشفة السجلات المحذوفة منطقياً (فصل البيانات الحية عن التاريخية) ========
+ARCHIVE_TABLES = {}
+
+def archive_mirror(model):
+    """جدول أرشيف بنفس أعمدة جدول النموذج دون قيود أو فهارس، مع وقت النقل"""
+    source = model.__table__
+    if source.name not in ARCHIVE_TABLES:
+        ARCHIVE_TABLES[source.name] = db.Table(
+            f'{source.name}_archive',
+            *[db.Column(column.name, column.type, primary_key=column.primary_key, autoincrement=False)
+              for column in source.columns],
+            db.Column('archive_moved_at', db.Text)
+        )
+    return ARCHIVE_TABLES[source.name]
+
+class ArchivePolicy:
+    """سياسة أرشفة جدول: عمود العمر، والجداول التابعة التي تُنقل معه، والجداول المرجعية التي تمنع نقله"""
+
+    def __init__(self, model, age_column, children=(), blockers=()):
+        self.table = model.__table__
+        self.archive = archive_mirror(model)
+        self.age_column = self.table.c[age_column]
+        self.children = [(child.__table__, child.__table__.c[fk], archive_mirror(child)) for child, fk in children]
+        self.blockers = [blocker.__table__.c[fk] for blocker, fk in blockers]
+
+    def cutoff_value(self, cutoff):
+        if isinstance(self.age_column.type, db.Integer):
+            return day_key(cutoff)
+        return cutoff.isoformat()
+
+ARCHIVE_POLICIES = OrderedDict([
+    ('financial_transactions', ArchivePolicy(
+        FinancialTransaction, 'transaction_day',
+        children=[(TransactionDetail, 'transaction_id'), (Payment, 'transaction_id')],
+        blockers=[(JournalEntry, 'transaction_id'), (PosIdempotencyKey, 'transaction_id'),
+                  (OutboxMessage, 'transaction_id')]
+    )),
+    ('inventory_movements', ArchivePolicy(InventoryMovement, 'movement_day')),
+    ('price_history', ArchivePolicy(PriceHistory, 'change_date')),
+    ('audit_log', ArchivePolicy(AuditLog, 'action_timestamp'))
+])
+
+def _move_to_archive(conn, source, archive, condition, moved_at):
+    columns = [column.name for column in source.columns]
+    conn.execute(archive.insert().from_select(
+        columns + ['archive_moved_at'],
+        select(*source.columns, literal(moved_at)).where(condition)
+    ))
+    conn.execute(source.delete().where(condition))
+
+def archive_old_records(retention_days=None, batch_size=None):
+    """نقل السجلات المؤرشفة الأقدم من مدة الاحتفاظ إلى جداول الأرشيف على دفعات، كل دفعة في معاملة مستقلة"""
+    retention_days = app.config['ARCHIVE_RETENTION_DAYS'] if retention_days is None else retention_days
+    batch_size = batch_size or app.config['ARCHIVE_BATCH_SIZE']
+    cutoff = datetime.now(timezone.utc).date() - timedelta(days=retention_days)
+    moved = {}
+    for name, policy in ARCHIVE_POLICIES.items():
+        table = policy.table
+        pk = list(table.primary_key.columns)[0]
+        conditions = [table.c.archived == True, policy.age_column < policy.cutoff_value(cutoff)]
+        conditions += [~exists().where(column == pk) for column in policy.blockers]
+        total = 0
+        while True:
+            with db.engine.begin() as conn:
+                ids = conn.execute(select(pk).where(*conditions).order_by(pk).limit(batch_size)).scalars().all()
+                if not ids:
+                    break
+                moved_at = get_current_utc_time()
+                for child, foreign_key, child_archive in policy.children:
+                    _move_to_archive(conn, child, child_archive, foreign_key.in_(ids), moved_at)
+                _move_to_archive(conn, table, policy.archive, pk.in_(ids), moved_at)
+                total += len(ids)
+        moved[name] = total
+    return moved
+
+def history_select(table_name, filters, include_live=True):
+    """استعلام صريح للسجل التاريخي: السجلات المنقولة إلى الأرشيف مع السجلات الحية اختيارياً"""
+    source = db.metadata.tables[table_name]
+    archive = ARCHIVE_TABLES[table_name]
+
+    def part(table, moved_at):
+        return select(*[table.c[column.name] for column in source.columns], moved_at.label('archive_moved_at')) \
+            .where(*[table.c[name] == value for name, value in filters.items()])
+
+    archived = part(archive, archive.c.archive_moved_at)
+    return union_all(part(source, null()), archived).subquery() if include_live else archived.subquery()
+
+@app.route('/api/history/<table_name>')
+@role_required(['admin', 'manager'])
+@db_route('read')
+def api_history(table_name):
+    """السجل التاريخي لجدول مؤرشف مع التصفية بالأعمدة (مثل ?transaction_id=5)"""
+    try:
+        if table_name not in ARCHIVE_TABLES:
+            raise ValueError('الجدول لا يدعم السجل التاريخي')
+        source = db.metadata.tables[table_name]
+        filters = {}
+        for name, value in request.args.items():
+            if name in ('include_live', 'limit'):
+                continue
+            if name not in source.c:
+                raise ValueError(f'عمود غير معروف: {name}')
+            python_type = source.c[name].type.python_type
+            filters[name] = python_type(value) if python_type in (int, float) else value
+        include_live = request.args.get('include_live', '1') != '0'
+        limit = min(request.args.get('limit', 100, type=int), app.config['ARCHIVE_HISTORY_LIMIT'])
+
+        history = history_select(table_name, filters, include_live)
+        pk = list(source.primary_key.columns)[0].name
+        with db_session() as session_db:
+            rows = session_db.execute(
+                select(history).order_by(history.c[pk].desc()).limit(limit)
+            ).mappings().all()
+            return jsonify({'success': True, 'data': [dict(row) for row in rows]})
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    except Exception as e:
+        app.logger.error(f"خطأ في جلب السجل التاريخي: {e}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'message': 'حدث خطأ أثناء جلب السجل التاريخي'
+        }), 500
+
+@app.cli.command('archive-old-records')
+@click.option('--days', type=int, default=None, help='مدة الاحتفاظ بالأيام (الافتراضي ARCHIVE_RETENTION_DAYS)')
+def archive_old_records_command(days):
+    """نقل السجلات المؤرشفة القديمة إلى جداول الأرشيف"""
+    for name, count in archive_old_records(days).items():
+        print(f"{name}: نُقل {count} سجل إلى الأرشيف")
+
+# ======== الصيانة الدورية: الاحتفاظ بالسجلات واستعادة المساحة ========
+def _rollup_audit_rows(session_db, table, ids):
+    """إضافة أعداد سجلات النشاط المحذوفة إلى التجميع اليومي قبل حذفها"""
+    counts = Counter()
+    for row in session_db.execute(
+        select(table.c.action_timestamp, table.c.user_id, table.c.action_table, table.c.action_type)
+        .where(table.c.log_id.in_(ids))
+    ):
+        rollup_day = day_key(row.action_timestamp)
+        if rollup_day is not None:
+            counts[(rollup_day, row.user_id or 0, row.action_table or '', row.action_type or '')] += 1
+    if not counts:
+        return 0
+    rollup_table = AuditLogRollup.__table__
+    stmt = upsert_insert(session_db, rollup_table)
+    session_db.execute(
+        stmt.on_conflict_do_update(
+            index_elements=['rollup_day', 'user_id', 'action_table', 'action_type'],
+            set_={'action_count': rollup_table.c.action_count + stmt.excluded.action_count}
+        ),
+        [{'rollup_day': key[0], 'user_id': key[1], 'action_table': key[2], 'action_type': key[3],
+          'action_count': count} for key, count in counts.items()]
+    )
+    return len(counts)
+
+# الجداول التي تُطبق عليها MAINTENANCE_POLICIES: (الجدول، عمود العمر، شرط إضافي، دالة التجميع)
+MAINTENANCE_TABLES = OrderedDict([
+    ('audit_log', (AuditLog.__table__, 'action_timestamp', None, _rollup_audit_rows)),
+    ('audit_log_archive', (ARCHIVE_TABLES['audit_log'], 'action_timestamp', None, _rollup_audit_rows)),
+    ('user_sessions', (UserSession.__table__, 'login_time',
+                       lambda table, now: or_(table.c.is_active == False, table.c.expiry_time < now), None))
+])
+
+def prune_table(name, keep_days, rollup=False):
+    """حذف السجلات الأقدم من مدة الاحتفاظ على دفعات قصيرة، كل دفعة في معاملة مستقلة"""
+    table, age_column, extra_condition, rollup_rows = MAINTENANCE_TABLES[name]
+    pk = list(table.primary_key.columns)[0]
+    now = datetime.now(timezone.utc)
+    conditions = [table.c[age_column] < (now - timedelta(days=keep_days)).isoformat()]
+    if extra_condition is not None:
+        conditions.append(extra_condition(table, now.isoformat()))
+    pruned = rolled_up = 0
+    while True:
+        with app.app_context(), db_session() as session_db:
+            ids = session_db.execute(
+                select(pk).where(*conditions).limit(app.config['MAINTENANCE_CHUNK_SIZE'])
+            ).scalars().all()
+            if not ids:
+                break
+            if rollup and rollup_rows is not None:
+                rolled_up += rollup_rows(session_db, table, ids)
+            session_db.execute(table.delete().where(pk.in_(ids)))
+        pruned += len(ids)
+        time.sleep(app.config['MAINTENANCE_CHUNK_PAUSE'])
+    return {'pruned': pruned, 'rolled_up': rolled_up}
+
+def _log_files_size():
+    directory, name = os.path.split(log_path)
+    return sum(os.path.getsize(os.path.join(directory, entry)) for entry in os.listdir(directory)
+               if entry.startswith(name))
+
+def database_space():
+    """حجم قاعدة البيانات والصفحات الحرة فيها بالبايت (SQLite)، أو أحجام جداول الصيانة (PostgreSQL)"""
+    with db.engine.connect() as conn:
+        if conn.dialect.name == 'sqlite':
+            page_size = conn.exec_driver_sql('PRAGMA page_size').scalar()
+            return {
+                'database_bytes': conn.exec_driver_sql('PRAGMA page_count').scalar() * page_size,
+                'free_bytes': conn.exec_driver_sql('PRAGMA freelist_count').scalar() * page_size,
+                'auto_vacuum': conn.exec_driver_sql('PRAGMA auto_vacuum').scalar()
+            }
+        return {name: conn.execute(text('SELECT pg_total_relation_size(:name)'), {'name': name}).scalar()
+                for name in MAINTENANCE_TABLES}
+
+def incremental_vacuum():
+    """إعادة الصفحات الحرة إلى نظام الملفات على خطوات قصيرة (يتطلب auto_vacuum=INCREMENTAL)"""
+    steps = 0
+    while True:
+        with db.engine.connect() as conn:
+            if conn.dialect.name != 'sqlite' or conn.exec_driver_sql('PRAGMA auto_vacuum').scalar() != 2:
+                return steps
+            if not conn.exec_driver_sql('PRAGMA freelist_count').scalar():
+                conn.exec_driver_sql('PRAGMA wal_checkpoint(PASSIVE)').fetchall()
+                return steps
+            # تنفيذ الجملة مرة واحدة يحرر صفحة واحدة فقط؛ executescript يكملها حتى النهاية
+            conn.connection.dbapi_connection.executescript(
+                f"PRAGMA incremental_vacuum({int(app.config['MAINTENANCE_VACUUM_PAGES'])});"
+            )
+        steps += 1
+        time.sleep(app.config['MAINTENANCE_CHUNK_PAUSE'])
+
+def enable_incremental_vacuum():
+    """تحويل قاعدة SQLite قائمة إلى auto_vacuum=INCREMENTAL (VACUUM كامل لمرة واحدة يحجب الكتابة أثناءه)"""
+    with db.engine.connect() as conn:
+        if conn.dialect.name != 'sqlite':
+            return False
+        conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+        conn.exec_driver_sql('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.exec_driver_sql('VACUUM')
+        return conn.exec_driver_sql('PRAGMA auto_vacuum').scalar() == 2
+
+def run_maintenance(tables=None, vacuum=True):
+    """تطبيق سياسات الاحتفاظ ثم التفريغ التدريجي، وإعادة تقرير بالمساحة المستعادة"""
+    started = time.monotonic()
+    space_before, logs_before = database_space(), _log_files_size()
+    report = {'tables': {}}
+    for name, policy in app.config['MAINTENANCE_POLICIES'].items():
+        if (tables and name not in tables) or name not in MAINTENANCE_TABLES or policy.get('keep_days') is None:
+            continue
+        report['tables'][name] = prune_table(name, policy['keep_days'], policy.get('rollup', False))
+    report['invoice_blocks_reconciled'] = invoice_number_allocator.reconcile()
+    report['vacuum_steps'] = incremental_vacuum() if vacuum else 0
+    space_after, logs_after = database_space(), _log_files_size()
+    report['space'] = {'before': space_before, 'after': space_after}
+    if 'database_bytes' in space_before:
+        report['reclaimed_bytes'] = space_before['database_bytes'] - space_after['database_bytes']
+    report['log_bytes'] = logs_after
+    report['log_reclaimed_bytes'] = max(logs_before - logs_after, 0)
+    report['finished_at'] = get_current_utc_time()
+    report['duration_seconds'] = round(time.monotonic() - started, 2)
+    app.logger.info(f"الصيانة الدورية: {json.dumps(report, ensure_ascii=False)}")
+    return report
+
+class MaintenanceScheduler:
+    """تشغيل مهام الإقلاع ثم run_maintenance في خيط خلفي كل MAINTENANCE_INTERVAL_HOURS"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._lock_file = None
+        self.last_report = None
+
+    def _acquire_process_lock(self):
+        """قفل ملف يمنع تشغيل الجدولة في أكثر من عملية (عمال gunicorn أو عملية المراقبة في وضع التطوير)"""
+        if fcntl is None:
+            return True
+        lock_file = open(app.config['MAINTENANCE_LOCK_PATH'], 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        # يبقى الملف مفتوحاً طوال عمر العملية؛ يُحرر القفل تلقائياً عند خروجها
+        self._lock_file = lock_file
+        return True
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            if not self._acquire_process_lock():
+                app.logger.info("الصيانة الدورية تعمل في عملية أخرى")
+                self._thread = False
+                return
+            self._thread = threading.Thread(target=self._run, name='maintenance', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+
+    def _run(self):
+        # مهام الإقلاع لمرة واحدة تعمل في العملية الحاملة للقفل فقط
+        try:
+            with app.app_context():
+                ensure_customer_search_index()
+                # السجلات القديمة بلا مفتاح يوم لا تظهر في الاستعلامات المعتمدة على movement_day وأمثاله
+                filled = {column: count for column, count in backfill_day_keys().items() if count}
+                if filled:
+                    app.logger.info(f"تمت تعبئة مفاتيح الأيام عند الإقلاع: {filled}")
+        except Exception as e:
+            app.logger.error(f"خطأ في مهام الإقلاع: {e}", exc_info=True)
+        if not app.config['MAINTENANCE_INTERVAL_HOURS']:
+            return
+        delay = app.config['MAINTENANCE_INITIAL_DELAY_SECONDS']
+        while not self._stopping.wait(delay):
+            try:
+                with app.app_context():
+                    self.last_report = run_maintenance()
+            except Exception as e:
+                app.logger.error(f"خطأ في الصيانة الدورية: {e}", exc_info=True)
+            delay = app.config['MAINTENANCE_INTERVAL_HOURS'] * 3600
+
+maintenance_scheduler = MaintenanceScheduler()
+atexit.register(maintenance_scheduler.stop)
+
+@app.route('/api/maintenance-status')
+@role_required(['admin'])
+def api_maintenance_status():
+    """آخر تقرير صيانة والمساحة الحالية لقاعدة البيانات"""
+    try:
+        return jsonify({
+            'success': True,
+            'data': {'last_report': maintenance_scheduler.last_report, 'space': database_space()}
+        })
+    except Exception as e:
+        app.logger.error(f"خطأ في جلب حالة الصيانة: {e}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'message': 'حدث خطأ في جلب حالة الصيانة'
+        }), 500
+
+@app.cli.command('run-maintenance')
+@click.option('--table', 'tables', multiple=True, help='تقييد الصيانة بجدول معين (يتكرر)')
+@click.option('--no-vacuum', is_flag=True, help='تخطي التفريغ التدريجي')
+@click.option('--enable-incremental-vacuum', 'enable_incremental', is_flag=True,
+              help='تحويل قاعدة SQLite قائمة إلى التفريغ التدريجي (VACUUM كامل لمرة واحدة)')
+def run_maintenance_command(tables, no_vacuum, enable_incremental):
+    """تطبيق سياسات الاحتفاظ بالسجلات واستعادة المساحة"""
+    if enable_incremental:
+        print("تم تفعيل التفريغ التدريجي" if enable_incremental_vacuum() else "التفريغ التدريجي غير مدعوم")
+    report = run_maintenance(tables or None, vacuum=not no_vacuum)
+    for name, result in report['tables'].items():
+        print(f"{name}: حُذف {result['pruned']} سجل، وأضيف {result['rolled_up']} صف تجميع")
+    if 'reclaimed_bytes' in report:
+        print(f"المساحة المستعادة: {report['reclaimed_bytes']} بايت في {report['vacuum_steps']} خطوة تفريغ")
+    print(f"حجم ملفات السجل: {report['log_bytes']} بايت")
+
+# ======== فهارس قاعدة البيانات ========
+# فهارس كاملة استُبدلت بفهارس جزئية على السجلات الحية وتُحذف من قواعد البيانات القائمة
+REPLACED_INDEXES = {
+    'inventory_movements': ('ix_inventory_movements_type_date', 'ix_inventory_movements_type_day'),
+    'financial_transactions': ('ix_financial_transactions_type_date',)
+}
+
+def ensure_indexes():
+    """إنشاء الفهارس المعرفة في النماذج على الجداول الموجودة مسبقاً (create_all لا يضيفها)"""
+    created = 0
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            existing = {index['name'] for index in sqlalchemy_inspect(conn).get_indexes(table.name)}
+            for name in REPLACED_INDEXES.get(table.name, ()):
+                if name in existing:
+                    conn.execute(text(f'DROP INDEX {name}'))
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(conn)
+                    created += 1
+    return created
+
+def ensure_columns():
+    """إضافة الأعمدة الجديدة القابلة للقيم الفارغة إلى الجداول الموجودة مسبقاً"""
+    added = 0
+    with db.engine.begin() as conn:
+        inspector = sqlalchemy_inspect(conn)
+        existing_tables = set(inspector.get_table_names())
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing and column.nullable and not column.primary_key:
+                    column_type = column.type.compile(dialect=conn.dialect)
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                    added += 1
+    return added
+
+@app.cli.command('ensure-indexes')
+def ensure_indexes_command():
+    """إضافة الأعمدة والفهارس الناقصة إلى قاعدة بيانات قائمة"""
+    print(f"تم إضافة {ensure_columns()} عمود وإنشاء {ensure_indexes()} فهرس")
+
+def backfill_day_keys(batch_size=1000):
+    """تعبئة مفاتيح الأيام الفارغة من أعمدة التواريخ النصية على دفعات"""
+    filled = {}
+    for model, date_column, key_column in DAY_KEY_COLUMNS:
+        table = model.__table__
+        pk = list(table.primary_key.columns)[0]
+        source, target = table.c[date_column], table.c[key_column]
+        total, last_id = 0, 0
+        while True:
+            with db.engine.begin() as conn:
+                rows = conn.execute(
+                    select(pk, source)
+                    .where(target.is_(None), source.isnot(None), pk > last_id)
+                    .order_by(pk).limit(batch_size)
+                ).all()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                updates = [{'b_id': row[0], 'b_day': day_key(row[1])} for row in rows]
+                updates = [row for row in updates if row['b_day'] is not None]
+                if updates:
+                    conn.execute(update(table).where(pk == bindparam('b_id')).values({key_column: bindparam('b_day')}),
+                                 updates)
+                total += len(updates)
+        filled[f'{table.name}.{key_column}'] = total
+    return filled
+
+@app.cli.command('backfill-day-keys')
+@click.option('--batch-size', default=1000, help='عدد الصفوف في كل دفعة')
+def backfill_day_keys_command(batch_size):
+    """إضافة أعمدة مفاتيح الأيام لقاعدة بيانات قائمة وتعبئتها من التواريخ النصية"""
+    ensure_columns()
+    ensure_indexes()
+    for column, count in backfill_day_keys(batch_size).items():
+        print(f"{column}: {count}")
+
+# الجداول المتنامية التي لا يُسمح بمسحها في أي مسار ساخن، ولو بالمرور على فهرس كامل
+HOT_TABLES = ('inventory_movements', 'financial_transactions', 'transaction_details', 'payments',
+              'daily_sales_summary', 'entity_search_terms', 'audit_log', 'user_sessions', 'outbox_messages')
+
+# مسارات الوصول الساخنة التي يجب أن تُخدم من فهرس (الاسم، الجدول المتوقع، الاستعلام، المعاملات)
+# الاستعلام نص SQL، أو دالة تبني جملة SQLAlchemy الفعلية المستخدمة في التطبيق (تستقبل تاريخ اليوم)
+# الجدول None: يُسمح بمسح جداول الكتالوج (تقرير يعرض كل الأرصدة) ويُمنع مسح الجداول المتنامية فقط
+HOT_QUERY_PLANS = [
+    ('dashboard_stats', 'financial_transactions', build_dashboard_stats_query, None),
+    ('low_stock_report', None, lambda today: build_low_stock_query(), None),
+    ('inventory_movements', 'inventory_movements',
+     lambda today: build_inventory_movements_query(today, app.config['INVENTORY_MOVEMENTS_DAYS']), None),
+    ('dashboard_sales_today', 'daily_sales_summary',
+     "SELECT SUM(total_amount) FROM daily_sales_summary WHERE summary_day = :day AND transaction_type = 'sale'",
+     {'day': '2024-01-01'}),
+    ('dashboard_charts_sales', 'inventory_movements',
+     "SELECT movement_day, SUM(quantity * unit_price) FROM inventory_movements "
+     "WHERE movement_type = 'sale' AND movement_day BETWEEN :start AND :end AND archived = 0 "
+     "GROUP BY movement_day",
+     {'start': 20240101, 'end': 20240107}),
+    ('dashboard_active_customers', 'financial_transactions',
+     "SELECT COUNT(DISTINCT entity_id) FROM financial_transactions "
+     "WHERE transaction_type = 'sale' AND transaction_day >= :since",
+     {'since': 20240101}),
+    ('dashboard_expiry_soon', 'inventory_levels',
+     "SELECT COUNT(*) FROM inventory_levels WHERE expiry_day BETWEEN :start AND :end",
+     {'start': 20240101, 'end': 20240131}),
+    ('dashboard_due_soon', 'financial_transactions',
+     "SELECT COUNT(*) FROM financial_transactions WHERE due_day BETWEEN :start AND :end AND payment_status != 'paid'",
+     {'start': 20240101, 'end': 20240108}),
+    ('top_selling_warmup', 'inventory_movements',
+     lambda today: build_product_sales_buckets_query(RollingTopK._window_start(today), sys.maxsize), None),
+    ('top_customers_warmup', 'financial_transactions',
+     lambda today: build_customer_spend_buckets_query(RollingTopK._window_start(today), sys.maxsize), None),
+    ('sale_levels', 'inventory_levels',
+     "SELECT inventory_id, quantity_on_hand FROM inventory_levels "
+     "WHERE warehouse_id = :warehouse AND product_id IN (1, 2, 3) AND archived = 0",
+     {'warehouse': 1}),
+    ('user_permissions', 'user_permissions',
+     "SELECT p.permission_name FROM permissions p JOIN user_permissions up ON up.permission_id = p.permission_id "
+     "WHERE up.user_id = :user_id AND up.archived = 0",
+     {'user_id': 1}),
+    ('barcode_lookup', 'products',
+     "SELECT product_id FROM products WHERE barcode = :code OR product_code = :code",
+     {'code': '6280000000001'}),
+    ('invoice_lookup', 'financial_transactions',
+     "SELECT transaction_id FROM financial_transactions WHERE transaction_code = :code",
+     {'code': 'INV01-240101-00001'}),
+    ('receipt_lines', 'transaction_details',
+     "SELECT product_id, quantity FROM transaction_details WHERE transaction_id = :tid",
+     {'tid': 1}),
+    ('return_lines', 'inventory_movements',
+     "SELECT SUM(quantity) FROM inventory_movements "
+     "WHERE transaction_id IN (1, 2) AND movement_type = 'return' AND archived = 0 "
+     "GROUP BY transaction_id, product_id",
+     {}),
+    ('customer_search', 'entity_search_terms',
+     "SELECT entity_id FROM entity_search_terms WHERE term_type = 'name' AND term >= :p AND term < :q",
+     {'p': 'ab', 'q': 'ac'}),
+    ('user_audit_count', 'audit_log',
+     "SELECT COUNT(*) FROM audit_log WHERE user_id = :user_id AND archived = 0",
+     {'user_id': 1}),
+    ('user_active_sessions', 'user_sessions',
+     "SELECT COUNT(*) FROM user_sessions WHERE user_id = :user_id AND is_active = 1",
+     {'user_id': 1}),
+    ('audit_retention', 'audit_log',
+     "SELECT log_id FROM audit_log WHERE action_timestamp < :cutoff LIMIT 500",
+     {'cutoff': '2024-01-01'}),
+]
+
+def check_query_plans(today=None):
+    """تشغيل EXPLAIN QUERY PLAN على المسارات الساخنة وإرجاع التي تمسح جدولها أو جدولاً متنامياً (SQLite فقط)"""
+    today = today or datetime.now(timezone.utc).date()
+    failures = []
+    with db.engine.connect() as conn:
+        for name, table, query, params in HOT_QUERY_PLANS:
+            if callable(query):
+                sql = query(today).compile(dialect=conn.dialect,
+                                           compile_kwargs={'literal_binds': True, 'render_postcompile': True})
+                rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}")
+            else:
+                rows = conn.execute(text(f"EXPLAIN QUERY PLAN {query}"), params)
+            plan = [row[-1] for row in rows]
+            # أي SCAN (ولو USING INDEX أو COVERING INDEX) يمر على كل صفوف الجدول أو الفهرس
+            scanned = {table, *HOT_TABLES} if table else set(HOT_TABLES)
+            scans = [step for step in plan
+                     if (match := re.match(r"SCAN (\w+)", step)) and match.group(1) in scanned]
+            if scans:
+                failures.append((name, plan))
+    return failures
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    """التحقق من أن استعلامات اللوحات والتقارير والبحث تستخدم الفهارس"""
+    if db.engine.dialect.name != 'sqlite':
+        print("فحص خطط الاستعلام متاح لـ SQLite فقط؛ استخدم flask check-backend لقواعد البيانات الأخرى")
+        return
+    failures = check_query_plans()
+    for name, plan in failures:
+        print(f"❌ {name}: {' | '.join(plan)}")
+    print(f"{len(HOT_QUERY_PLANS) - len(failures)}/{len(HOT_QUERY_PLANS)} استعلام يستخدم الفهارس")
+    if failures:
+        raise SystemExit(1)
+
+# ======== فحص توافق قاعدة البيانات ========
+def _check_summary_upsert(session_db, today):
+    row = {'summary_day': today.isoformat(), 'transaction_type': '__check__',
+           'transaction_count': 1, 'total_amount': 0, 'tax_amount': 0}
+    record_daily_summary(session_db, [row])
+    record_daily_summary(session_db, [row])
+
+def _check_write_fixture(session_db):
+    """منتج ومستودع مؤقتان لفحص مسارات الكتابة؛ يُحذفان مع التراجع عن معاملة الفحص"""
+    unit = Unit(unit_name='__check__', unit_symbol='chk')
+    category = Category(category_name='__check__')
+    warehouse = Warehouse(warehouse_name='__check__', archived=False)
+    session_db.add_all([unit, category, warehouse])
+    session_db.flush()
+    product = Product(product_code='__check__', barcode='__check__', product_name='__check__',
+                      category_id=category.category_id, unit_id=unit.unit_id, unit_price=10, archived=False)
+    session_db.add(product)
+    session_db.flush()
+    return product, warehouse.warehouse_id
+
+def _check_sale_write(session_db, today, invoice_number='__check__'):
+    product, warehouse_id = _check_write_fixture(session_db)
+    posted = post_sale(session_db, {'items': [{'product_id': product.product_id, 'quantity': 2}],
+                                    'warehouse_id': warehouse_id, 'invoice_number': invoice_number}, None)
+    return product, posted
+
+def _check_return_write(session_db, today):
+    product, posted = _check_sale_write(session_db, today)
+    post_return(session_db, [{'barcode': product.barcode, 'quantity': 1, 'invoice_number': '__check__',
+                              'reason': None}], None, None)
+    # الكمية المتبقية للإرجاع يجب أن تُحسب من المرتجع السابق في نفس المعاملة
+    try:
+        post_return(session_db, [{'barcode': product.barcode, 'quantity': 2, 'invoice_number': '__check__',
+                                  'reason': None}], None, None)
+    except ValueError:
+        return
+    raise AssertionError('تم قبول مرتجع يتجاوز الكمية المباعة')
+
+def _check_sync_write(session_db, today):
+    _, posted = _check_sale_write(session_db, today)
+    keys_table = PosIdempotencyKey.__table__
+    row = {'idempotency_key': '__check__', 'terminal_id': '__check__', 'status': 'posted',
+           'transaction_id': posted['transaction_id'], 'created_at': get_current_utc_time()}
+    session_db.execute(insert(keys_table).values(row))
+    # الإعادة بنفس المفتاح يجب أن تفشل بتعارض المفتاح حتى تُلغى فاتورتها المكررة
+    try:
+        with session_db.begin_nested():
+            session_db.execute(insert(keys_table).values(row))
+    except IntegrityError:
+        return
+    raise AssertionError('تم قبول مفتاح عدم تكرار مكرر')
+
+# الاستعلامات المعتمدة على خصائص قاعدة البيانات (التواريخ، التجميع، الإدخال مع التحديث، أقفال الكتابة)
+BACKEND_CHECKS = [
+    ('dashboard_stats', lambda session_db, today: session_db.execute(build_dashboard_stats_query(today)).one()),
+    ('recommendations', load_recommendation_facts),
+    ('top_selling', lambda session_db, today: _load_product_sales_buckets(
+        session_db, RollingTopK._window_start(today), sys.maxsize)),
+    ('top_customers', lambda session_db, today: _load_customer_spend_buckets(
+        session_db, RollingTopK._window_start(today), sys.maxsize)),
+    ('daily_summary_upsert', _check_summary_upsert),
+    ('sale_write', _check_sale_write),
+    ('return_write', _check_return_write),
+    ('sync_write', _check_sync_write),
+]
+
+def check_backend(today):
+    """تشغيل الاستعلامات الحساسة لنوع قاعدة البيانات داخل معاملات يتم التراجع عنها"""
+    results = []
+    for name, check in BACKEND_CHECKS:
+        session_db = OrmSession(bind=db.engine)
+        try:
+            check(session_db, today)
+            results.append((name, None))
+        except Exception as e:
+            results.append((name, e))
+        finally:
+            session_db.rollback()
+            session_db.close()
+    return results
+
+@app.cli.command('check-backend')
+def check_backend_command():
+    """التحقق من عمل الاستعلامات على قاعدة البيانات المهيأة (SQLite أو PostgreSQL)"""
+    results = check_backend(datetime.now(timezone.utc).date())
+    print(f"قاعدة البيانات: {db.engine.dialect.name}")
+    for name, error in results:
+        print(f"{'✅' if error is None else '❌'} {name}{'' if error is None else f': {error}'}")
+    if any(error is not None for _, error in results):
+        raise SystemExit(1)
+
+# ======== تشغيل التطبيق ========
+_background_services_started = False
+
+def start_background_services():
+    """تشغيل خدمات الخلفية مرة واحدة في العملية التي تخدم الطلبات"""
+    global _background_services_started
+    if _background_services_started:
+        return
+    _background_services_started = True
+    outbox_dispatcher.start()
+    maintenance_scheduler.start()
+
+@app.before_request
+def _start_background_services_once():
+    # خوادم WSGI (مثل gunicorn) لا تمر بـ __main__؛ تبدأ الخدمات مع أول طلب في كل عامل
+    if not _background_services_started:
+        start_background_services()
 
-# ======== تشغيل التطبيق ========
 if __name__ == '__main__':
     os.makedirs(os.path.join(basedir, 'data'), exist_ok=True)
+    debug = True
     
     with app.app_context():
         db.create_all()
+        ensure_columns()
+        ensure_indexes()
+    # في وضع التطوير تعيد عملية المراقبة تشغيل التطبيق في عملية فرعية؛ الخدمات تعمل في الفرعية فقط
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_services()
     
-    app.run(host='0.0.0.0', port=5001, debug=True)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5001, debug=debug)
\ No newline at end of file